@@ -0,0 +1,120 @@
+#fold_cache.py
+#Disk-backed cache of ViennaRNA results, shared across runs and between the transcriptional and translational predictors
+#Enabled by setting the environment variable TBOX_FOLD_CACHE to the path of an SQLite database (or with --cache)
+#TBOX_FOLD_CACHE_MB sets the maximum size in megabytes (default 1024); the least recently used results are evicted first
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+
+#Most keys looked up in one query (SQLite limits the number of query parameters)
+LOOKUP_BATCH = 500
+
+#Fraction of the maximum size that is kept after eviction
+EVICT_TO = 0.9
+
+#Open connections, by process and path. SQLite connections can't be used by forked worker processes,
+#so each process opens its own
+connections = {}
+
+def enabled():
+    return os.environ.get('TBOX_FOLD_CACHE', '') != ''
+
+def max_size():
+    return int(float(os.environ.get('TBOX_FOLD_CACHE_MB', 1024)) * 1024 * 1024)
+
+#Opens the cache database, creating it if needed
+#The total size is kept up to date by triggers, so it doesn't need to be recounted
+def get_connection():
+    path = os.environ.get('TBOX_FOLD_CACHE', '')
+    key = (os.getpid(), path)
+    if key not in connections:
+        connection = sqlite3.connect(path, timeout = 60)
+        connection.execute('PRAGMA journal_mode = WAL') #Worker processes can read while another one writes
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value TEXT, size INTEGER, used REAL);
+            CREATE INDEX IF NOT EXISTS results_used ON results (used);
+            CREATE TABLE IF NOT EXISTS total (size INTEGER);
+            INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT * FROM total);
+            CREATE TRIGGER IF NOT EXISTS add_size AFTER INSERT ON results
+                BEGIN UPDATE total SET size = size + new.size; END;
+            CREATE TRIGGER IF NOT EXISTS remove_size AFTER DELETE ON results
+                BEGIN UPDATE total SET size = size - old.size; END;
+        ''')
+        connection.commit()
+        connections[key] = connection
+    return connections[key]
+
+#Only records of strings are cached (missing values are not)
+def cacheable(record):
+    return all(isinstance(item, str) for item in record)
+
+#The key is a hash of the program, its options, and the inputs
+def record_key(vienna_args, record):
+    return hashlib.sha1('\0'.join(list(vienna_args) + list(record)).encode('utf-8')).digest()
+
+#Looks up the results of a list of records
+#Returns a list with the cached result of each record, or None if it is not cached
+def lookup(vienna_args, records):
+    results = [None] * len(records)
+    if not enabled():
+        return results
+    rows = {} #Rows of each key (the same record can appear more than once)
+    for i, record in enumerate(records):
+        if cacheable(record):
+            rows.setdefault(record_key(vienna_args, record), []).append(i)
+
+    connection = get_connection()
+    keys = list(rows)
+    found = []
+    for start in range(0, len(keys), LOOKUP_BATCH):
+        batch = keys[start:(start + LOOKUP_BATCH)]
+        query = 'SELECT key, value FROM results WHERE key IN (%s)' % ','.join('?' * len(batch))
+        for key, value in connection.execute(query, batch):
+            key = bytes(key)
+            result = tuple(json.loads(value))
+            for i in rows[key]:
+                results[i] = result
+            found.append(key)
+    if len(found) > 0: #Mark as recently used
+        now = time.time()
+        connection.executemany('UPDATE results SET used = ? WHERE key = ?', [(now, key) for key in found])
+        connection.commit()
+    return results
+
+#Adds the results of a list of records to the cache, then evicts old results if it is too large
+def store(vienna_args, records, results):
+    if not enabled():
+        return
+    now = time.time()
+    rows = []
+    for record, result in zip(records, results):
+        if cacheable(record):
+            value = json.dumps(result)
+            key = record_key(vienna_args, record)
+            rows.append((key, value, len(key) + len(value), now))
+    if len(rows) == 0:
+        return
+    connection = get_connection()
+    connection.executemany('INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)', rows) #Results don't change, so keep the first
+    connection.commit()
+    evict(connection)
+
+#Removes the least recently used results until the cache is below EVICT_TO of its maximum size
+def evict(connection):
+    limit = max_size()
+    size = connection.execute('SELECT size FROM total').fetchone()[0]
+    if size <= limit:
+        return
+    excess = size - int(limit * EVICT_TO)
+    remove = []
+    for key, key_size in connection.execute('SELECT key, size FROM results ORDER BY used'):
+        if excess <= 0:
+            break
+        remove.append((key,))
+        excess -= key_size
+    connection.executemany('DELETE FROM results WHERE key = ?', remove)
+    connection.commit()
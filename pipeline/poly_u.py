@@ -0,0 +1,92 @@
+#poly_u.py
+#Index of the poly U tracts (runs of T) of a column of sequences, for finding terminators
+#The sequences are encoded once, and the terminator poly U motif is found from the runs of T for all rows together,
+#instead of with a regular expression on a slice of each sequence
+
+from collections import namedtuple
+import numpy as np
+
+#The motif that is found: [T]{3,}[ACGT]{,1}[T]{1,}[ACGT]{,1}[T]{1,}
+#A match lies in one run of T, or crosses to the next runs over "bridges" (a single A, C or G between two runs):
+#from a run with r Ts left, there is a match if r >= 5, or if there is a bridge and r >= 4, or r == 3 and the next
+#run has at least 2 Ts or another bridge. Like the regular expression, the match ends at the end of the last run reached
+#(the runs are taken whole, as the greedy quantifiers do)
+TERM_POLY_U = '[T]{3,}[ACGT]{,1}[T]{1,}[ACGT]{,1}[T]{1,}'
+
+#Characters that can bridge two runs of T (other characters, and the separator between sequences, can't)
+BRIDGES = np.zeros(256, dtype = bool)
+BRIDGES[np.frombuffer(b'ACG', dtype = np.uint8)] = True
+
+#offsets, lengths: where each sequence starts in the encoded column (the sequences are joined with a separator), and its length
+#run_starts, run_ends: the runs of T in the encoded column, [start, end), followed by two empty runs past the end
+#bridges: whether each run is bridged to the next one
+#valid: the runs that have a match from their first T
+PolyUIndex = namedtuple('PolyUIndex', ['offsets', 'lengths', 'run_starts', 'run_ends', 'bridges', 'valid'])
+
+#Builds the index of a column of sequences (missing sequences are empty)
+def poly_u_index(sequences):
+    sequences = [seq if isinstance(seq, str) else '' for seq in sequences]
+    lengths = np.array([len(seq) for seq in sequences], dtype = np.int64)
+    offsets = np.zeros(len(sequences), dtype = np.int64)
+    offsets[1:] = np.cumsum(lengths[:-1] + 1)
+    codes = np.frombuffer('\0'.join(sequences).encode('latin-1', 'replace'), dtype = np.uint8)
+
+    is_t = np.zeros(len(codes) + 2, dtype = np.int8)
+    is_t[1:-1] = codes == ord('T')
+    edges = np.flatnonzero(np.diff(is_t)) #the runs start and end in turn
+    end = len(codes) + 1
+    run_starts = np.concatenate((edges[0::2], [end, end]))
+    run_ends = np.concatenate((edges[1::2], [end, end]))
+    count = len(run_starts) - 2
+    bridges = np.zeros(count + 2, dtype = bool)
+    if count > 1:
+        bridges[:(count - 1)] = (run_starts[1:count] - run_ends[:(count - 1)] == 1) & BRIDGES[codes[run_ends[:(count - 1)]]]
+
+    run_lengths = run_ends - run_starts
+    valid = poly_u_match(run_lengths[:count], run_lengths[1:(count + 1)], bridges[:count], bridges[:count] & bridges[1:(count + 1)])
+    return PolyUIndex(offsets, lengths, run_starts, run_ends, bridges, np.flatnonzero(valid))
+
+#Whether there is a match from a run, given the number of Ts left in it and in the next run, and the bridges to the next two runs
+def poly_u_match(left, next_left, bridge, second_bridge):
+    return (left >= 5) | (bridge & ((left >= 4) | ((left == 3) & ((next_left >= 2) | second_bridge))))
+
+#Checks for a match from position starts (in run runs), without going past limits (all positions in the encoded column)
+#Returns whether there is a match, and its end
+def match_runs(index, runs, starts, limits):
+    run_starts, run_ends, bridges = index.run_starts, index.run_ends, index.bridges
+    left = np.minimum(run_ends[runs], limits) - starts
+    bridge = bridges[runs] & (run_starts[runs + 1] < limits)
+    second_bridge = bridge & bridges[runs + 1] & (run_starts[runs + 2] < limits)
+    next_left = np.minimum(run_ends[runs + 1], limits) - run_starts[runs + 1]
+    matched = poly_u_match(left, next_left, bridge, second_bridge)
+    ends = np.where(second_bridge, run_ends[runs + 2], np.where(bridge, run_ends[runs + 1], run_ends[runs]))
+    return matched, np.minimum(ends, limits)
+
+#Finds the first match of each query: in sequence rows, from position starts, ending before position limits
+#(the end of the sequence by default), like re.compile(TERM_POLY_U).search(sequence, start, limit)
+#Returns the start and end of each match, or -1 if there is none
+def first_poly_u(index, rows, starts, limits = None):
+    rows = np.asarray(rows, dtype = np.int64)
+    offsets, lengths = index.offsets[rows], index.lengths[rows]
+    if limits is None:
+        limits = lengths
+    limits = offsets + np.clip(np.asarray(limits, dtype = np.int64), 0, lengths)
+    starts = offsets + np.clip(np.asarray(starts, dtype = np.int64), 0, lengths)
+    match_starts = np.full(len(rows), -1, dtype = np.int64)
+    match_ends = np.full(len(rows), -1, dtype = np.int64)
+
+    runs = np.searchsorted(index.run_ends, starts, side = 'right') #first run that ends after the start
+    pending = np.arange(len(rows))
+    while len(pending) > 0:
+        pending = pending[index.run_starts[runs[pending]] < limits[pending]] #runs of the next sequence start after the limit
+        run = runs[pending]
+        positions = np.maximum(index.run_starts[run], starts[pending])
+        matched, ends = match_runs(index, run, positions, limits[pending])
+        found = pending[matched]
+        match_starts[found] = positions[matched] - offsets[found]
+        match_ends[found] = ends[matched] - offsets[found]
+        #Skip to the next run that has a match when it isn't cut short
+        pending = pending[~matched]
+        next_valid = np.searchsorted(index.valid, runs[pending] + 1)
+        runs[pending] = np.append(index.valid, len(index.run_starts) - 2)[next_valid]
+    return match_starts, match_ends
@@ -0,0 +1,31 @@
+#rna_structure.py
+#Base pair tables of dot-bracket structures, shared by the T-box predictors and the postprocessing
+#The table is built in one pass with a stack, instead of a forward bracket count from every '('
+
+from array import array
+
+#Pair table of a dot-bracket structure: the index of the partner of each position, or -1 if it is unpaired
+#Brackets without a partner (in unbalanced structures) are also -1
+def pair_table(structure, open_bracket = '(', close_bracket = ')'):
+    table = array('i', [-1]) * len(structure)
+    stack = []
+    for index, character in enumerate(structure):
+        if character == open_bracket:
+            stack.append(index)
+        elif character == close_bracket and stack:
+            partner = stack.pop()
+            table[index] = partner
+            table[partner] = index
+    return table
+
+#Outermost base pairs of a pair table (the stems of the structure), as [start, end] with 1-indexed positions
+def outer_pairs(table):
+    stems = []
+    index = 0
+    while index < len(table) - 1:
+        partner = table[index]
+        if partner > index:
+            stems.append([index + 1, partner + 1])
+            index = partner # go to the paired bracket
+        index += 1
+    return stems
@@ -0,0 +1,452 @@
+#tbox_io.py
+#Input readers shared by the transcriptional and translational T-box predictors
+#INFERNAL (cmsearch) hits are parsed one at a time, so large outputs can be processed in bounded chunks
+#All inputs may be plain text, gzip, or bgzip compressed
+
+import os
+import io
+import re
+import gzip
+import zlib
+import mmap
+import struct
+import itertools
+from collections import namedtuple, deque
+from multiprocessing import Pool
+import pandas as pd
+from Bio import SeqIO
+from Bio import bgzf
+
+#Approximate size of the pieces a cmsearch output is split into for parallel parsing
+SHARD_BYTES = 16 * 1024 * 1024
+
+#One hit from the cmsearch output. Metadata is as described in the INFERNAL manual
+InfernalHit = namedtuple('InfernalHit', ['Name', 'Rank', 'E_value', 'Score', 'Bias', 'Tbox_start', 'Tbox_end',
+                                         'CM_accuracy', 'GC', 'Sequence', 'Structure'])
+HIT_COLUMNS = list(InfernalHit._fields)
+
+#Checks the first bytes of a file for compression
+#Returns None for plain text, 'gzip', or 'bgzf' for block gzip (bgzip) files, which allow random access
+def compression(file):
+    with open(file, 'rb') as f:
+        header = f.read(18)
+    if header[:2] != b'\x1f\x8b':
+        return None
+    if len(header) == 18 and header[3] & 4 and header[12:14] == b'BC': #FEXTRA with the BGZF subfield
+        return 'bgzf'
+    return 'gzip'
+
+#Opens an input file for reading text, decompressing it on the fly if needed
+#bgzip files are valid multi-member gzip files, so both are read sequentially with gzip
+def open_input(file):
+    if compression(file) is None:
+        return open(file)
+    return gzip.open(file, 'rt')
+
+#Generator over the hits in the lines of an INFERNAL output file
+#Yields one InfernalHit per '>>' hit, as soon as its alignment has been read
+def parse_INFERNAL(lines):
+    name = ""
+    metadata = []
+    Tbox_start = -1
+    Tbox_end = -1
+    structure = ""
+
+    metadataLine = -1
+    structLine = -1
+    seqLine = -1
+
+    for lineCount, line in enumerate(lines):
+        if line.startswith(">>"): #We found a match!
+            name = line.split(" ")[1]
+
+            metadataLine = lineCount + 3
+            structLine = lineCount + 6
+            seqLine = lineCount + 9
+
+        if lineCount == metadataLine:
+            metadata = list(filter(None, line.split(' '))) #Splits by spaces, and strips empty strings
+            Tbox_start = metadata[9]
+            Tbox_end = metadata[10]
+
+        if lineCount == structLine:
+            sp = list(filter(None,line.split(' ')))
+            structure = sp[0]
+
+        if lineCount == seqLine:
+            seq_line = list(filter(None, line.strip().split(' ')))
+            sequence = ' '.join(seq_line[2:len(seq_line) - 1])
+
+            #Fallback method (adapted from Thomas Jordan's code):
+            if sequence not in line: #This can happen if there are two consecutive spaces in the middle of the sequence.
+                rsp = line.rsplit(Tbox_end, maxsplit = 1)
+                lsp = rsp[0].split(Tbox_start + ' ')
+                sequence = lsp[len(lsp) - 1].strip()
+                print("Fallback on line %d" % lineCount)
+
+            #Do a sanity check
+            if len(sequence) != len(structure): #This is an error!
+                print("\nParsing ERROR occured on line %d" % lineCount)
+                print(line) #For debug purposes
+                print(sequence)
+                print(structure)
+                print(seq_line)
+
+            yield InfernalHit(Name = name,
+                              Rank = int(metadata[0][1:len(metadata[0])-1]), #All except first and last characters
+                              E_value = float(metadata[2]), #third entry
+                              Score = float(metadata[3]), #fourth
+                              Bias = float(metadata[4]), #fifth
+                              Tbox_start = int(Tbox_start),
+                              Tbox_end = int(Tbox_end),
+                              CM_accuracy = float(metadata[13]),
+                              GC = float(metadata[15][0:4]), #ignore the \n at the end
+                              Sequence = sequence,
+                              Structure = structure)
+
+#Streams the hits of an INFERNAL output file, one InfernalHit at a time
+#With jobs > 1, the file is parsed in parallel shards (see iter_INFERNAL_parallel)
+#If alignment_file is given, file is a cmsearch --tblout table instead (see iter_tblout)
+def iter_INFERNAL(file, jobs = 1, alignment_file = None):
+    if alignment_file is not None:
+        for hit in iter_tblout(file, alignment_file):
+            yield hit
+        return
+    if jobs > 1:
+        if compression(file) == 'gzip':
+            print("%s is gzip compressed and cannot be split; parsing with 1 process (use bgzip instead)" % file)
+        else:
+            for hit in iter_INFERNAL_parallel(file, jobs):
+                yield hit
+            return
+    with open_input(file) as f:
+        for hit in parse_INFERNAL(f):
+            yield hit
+
+#Splits an INFERNAL output file into shards of about shard_bytes, as (start, end) byte offsets
+#Every shard starts at a '>>' line, so no hit is split between two shards
+def INFERNAL_shards(file, shard_bytes = SHARD_BYTES):
+    shards = []
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return shards
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            if mm[:2] == b'>>':
+                start = 0
+            else:
+                start = mm.find(b'\n>>') + 1
+                if start == 0: #No hits
+                    return shards
+            while start < size:
+                end = mm.find(b'\n>>', start + max(shard_bytes, 1) - 1)
+                end = size if end == -1 else end + 1
+                shards.append((start, end))
+                start = end
+    return shards
+
+#Parses the hits in one shard of an INFERNAL output file (run in a worker process)
+def parse_INFERNAL_shard(file, start, end):
+    with open(file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            text = mm[start:end].decode()
+    return list(parse_INFERNAL(io.StringIO(text, newline = None)))
+
+#Reads the blocks of a BGZF file, yielding (block start offset, decompressed data)
+def bgzf_blocks(handle):
+    while True:
+        start = handle.tell()
+        header = handle.read(18)
+        if len(header) < 18:
+            return
+        block_size = struct.unpack('<H', header[16:18])[0] + 1 #BSIZE is the block size minus 1
+        payload = handle.read(block_size - 18)
+        yield start, zlib.decompress(payload[:-8], -15) #Strip the CRC32 and size, and inflate the raw data
+
+#Splits a bgzip compressed INFERNAL output file into shards of about shard_bytes (uncompressed)
+#Returns a list of (BGZF virtual offset of the first '>>' line, number of hits), so that each worker
+#can seek directly to its blocks instead of decompressing the file from the start
+def bgzf_INFERNAL_shards(file, shard_bytes = SHARD_BYTES):
+    shards = []
+    shard_start = 0 #uncompressed offset of the first hit in the current shard
+    read_bytes = 0 #uncompressed bytes before the current block
+    #The last 2 bytes of the previous blocks and their virtual offsets, to find '\n>>' across blocks
+    #A newline is assumed before the start of the file
+    tail, tail_offsets = b'\n', [None]
+    with open(file, 'rb') as f:
+        for block_start, data in bgzf_blocks(f):
+            text = tail + data
+            pos = text.find(b'\n>>')
+            while pos != -1:
+                hit = pos + 1 - len(tail) #offset of the '>>' in this block (negative if in a previous block)
+                if hit >= 0:
+                    offset = bgzf.make_virtual_offset(block_start, hit)
+                else:
+                    offset = tail_offsets[pos + 1]
+                if len(shards) == 0 or read_bytes + hit - shard_start >= shard_bytes:
+                    shards.append([offset, 0])
+                    shard_start = read_bytes + hit
+                shards[-1][1] += 1
+                pos = text.find(b'\n>>', pos + 1)
+            
+            tail_offsets = (tail_offsets + [bgzf.make_virtual_offset(block_start, k) for k in range(max(len(data) - 2, 0), len(data))])[-2:]
+            tail = text[-2:]
+            read_bytes += len(data)
+    return [tuple(shard) for shard in shards]
+
+#Parses the hits in one shard of a bgzip compressed INFERNAL output file (run in a worker process)
+def parse_INFERNAL_bgzf_shard(file, offset, n_hits):
+    with bgzf.BgzfReader(file, 'r') as handle:
+        handle.seek(offset)
+        return list(itertools.islice(parse_INFERNAL(handle), n_hits))
+
+#Parses an INFERNAL output file with a pool of jobs processes, yielding the hits in their original order
+#Plain text files are memory-mapped and split at '>>' lines; bgzip files are split at BGZF virtual offsets
+#At most 2 shards per process are in flight, so memory stays bounded for large files
+def iter_INFERNAL_parallel(file, jobs, shard_bytes = SHARD_BYTES):
+    if compression(file) == 'bgzf':
+        tasks = [(parse_INFERNAL_bgzf_shard, (file, offset, n_hits)) for offset, n_hits in bgzf_INFERNAL_shards(file, shard_bytes)]
+    else:
+        tasks = [(parse_INFERNAL_shard, (file, start, end)) for start, end in INFERNAL_shards(file, shard_bytes)]
+    with Pool(jobs) as pool:
+        pending = deque()
+        for function, args in tasks:
+            pending.append(pool.apply_async(function, args))
+            if len(pending) >= 2 * jobs:
+                for hit in pending.popleft().get():
+                    yield hit
+        while len(pending) > 0:
+            for hit in pending.popleft().get():
+                yield hit
+
+#Makes a dataframe of hits, with the columns used by the predictors
+def hits_to_frame(hits):
+    return pd.DataFrame.from_records(list(hits), columns = HIT_COLUMNS)
+
+#Function to read an INFERNAL output file and extract sequence names, metadata, structure, and sequence
+def read_INFERNAL(file, jobs = 1, alignment_file = None):
+    return hits_to_frame(iter_INFERNAL(file, jobs, alignment_file))
+
+#Reads an INFERNAL output file as a series of dataframes of at most chunksize hits each
+#Only one chunk is held in memory at a time
+def read_INFERNAL_chunks(file, chunksize, jobs = 1, alignment_file = None):
+    hits = iter_INFERNAL(file, jobs, alignment_file)
+    while True:
+        chunk = list(itertools.islice(hits, chunksize))
+        if len(chunk) == 0:
+            return
+        yield hits_to_frame(chunk)
+
+#Reads a Stockholm alignment written by cmsearch -A
+#Returns a dictionary of sequence name -> (aligned sequence, posterior probabilities, consensus structure, reference annotation)
+#Alignments split into several blocks are joined back together
+def read_stockholm(file):
+    alignments = {}
+    sequences = {}
+    posteriors = {}
+    SS_cons = []
+    RF = []
+    with open_input(file) as f:
+        for line in f:
+            line = line.strip()
+            if line == '//': #End of one alignment (the file may contain several)
+                SS = ''.join(SS_cons)
+                reference = ''.join(RF)
+                for name, seq in sequences.items():
+                    alignments[name] = (''.join(seq), ''.join(posteriors.get(name, [])), SS, reference)
+                sequences = {}
+                posteriors = {}
+                SS_cons = []
+                RF = []
+            elif line.startswith('#=GC SS_cons'):
+                SS_cons.append(line.split()[2])
+            elif line.startswith('#=GC RF'):
+                RF.append(line.split()[2])
+            elif line.startswith('#=GR'):
+                split_line = line.split()
+                if split_line[2] == 'PP':
+                    posteriors.setdefault(split_line[1], []).append(split_line[3])
+            elif line != '' and not line.startswith('#'):
+                name, seq = line.split()
+                sequences.setdefault(name, []).append(seq)
+    return alignments
+
+#Estimates the INFERNAL accuracy (mean posterior probability of the aligned residues) from the PP annotation
+#Each PP character is a bin of width 0.1, '*' being >= 0.95; the middle of each bin is used
+def PP_accuracy(posteriors):
+    values = [0.975 if c == '*' else max(int(c) / 10, 0.025) for c in posteriors if c == '*' or c.isdigit()]
+    if len(values) == 0:
+        return float('nan')
+    return round(sum(values) / len(values), 2)
+
+#Cuts the columns of one hit out of a Stockholm alignment, like the hit alignments in the text output
+#The alignment has every consensus column of the model, but the text output only shows the hit's model range,
+#so only the columns from consensus position mdl_from to mdl_to (1-indexed, from the tblout table) are kept
+#Consensus columns are the ones that are not insert columns ('.' in RF, or in SS_cons if there is no RF)
+#Insert columns where the hit has no residue ('.') are dropped; deletions ('-') are kept
+def project_alignment(aligned_seq, SS_cons, mdl_from, mdl_to, RF = ''):
+    reference = RF if len(RF) == len(SS_cons) else SS_cons
+    consensus = [i for i, c in enumerate(reference) if c != '.']
+    first, last = 0, len(SS_cons) - 1
+    if 1 <= mdl_from <= mdl_to <= len(consensus):
+        first, last = consensus[mdl_from - 1], consensus[mdl_to - 1]
+    sequence = []
+    structure = []
+    for c, s in zip(aligned_seq[first:(last + 1)], SS_cons[first:(last + 1)]):
+        if c != '.':
+            sequence.append(c)
+            structure.append(s)
+    return ''.join(sequence), ''.join(structure)
+
+#Streams the hits of a cmsearch --tblout table, taking sequence and structure from the cmsearch -A alignment
+#Ranks are numbered in table order for each query, like the text output
+#Hits missing from the alignment (for example, below the inclusion threshold) are skipped
+def iter_tblout(tblout_file, alignment_file):
+    alignments = read_stockholm(alignment_file)
+    ranks = {}
+    missing = 0
+    with open_input(tblout_file) as f:
+        for line in f:
+            if line.startswith('#') or line.strip() == '':
+                continue
+            fields = line.split()
+            name, query = fields[0], fields[2]
+            mdl_from, mdl_to = int(fields[5]), int(fields[6])
+            seq_from, seq_to = int(fields[7]), int(fields[8])
+            ranks[query] = ranks.get(query, 0) + 1
+            
+            aligned_name = '%s/%d-%d' % (name, seq_from, seq_to)
+            if aligned_name not in alignments:
+                missing += 1
+                continue
+            aligned_seq, posteriors, SS_cons, RF = alignments[aligned_name]
+            sequence, structure = project_alignment(aligned_seq, SS_cons, mdl_from, mdl_to, RF)
+            
+            yield InfernalHit(Name = name,
+                              Rank = ranks[query],
+                              E_value = float(fields[15]),
+                              Score = float(fields[14]),
+                              Bias = float(fields[13]),
+                              Tbox_start = seq_from,
+                              Tbox_end = seq_to,
+                              CM_accuracy = PP_accuracy(posteriors),
+                              GC = float(fields[12]),
+                              Sequence = sequence,
+                              Structure = structure)
+    if missing > 0:
+        print("Warning: %d hits in %s are not in the alignment %s" % (missing, tblout_file, alignment_file))
+
+#Whitespace removed from FASTA sequence lines, besides the newline
+LINE_WHITESPACE = re.compile(b'[ \t\r\x0b\x0c]')
+
+#Gets the record name (the first word of the title) from a FASTA header line, as SeqIO does
+def fasta_name(header):
+    title = header[1:].rstrip()
+    if len(title) == 0:
+        return ""
+    return title.split(None, 1)[0].decode('utf-8', 'replace')
+
+#Joins the sequence lines of a FASTA record, removing whitespace as SeqIO does
+def fasta_sequence(lines):
+    sequence = lines.replace(b'\n', b'')
+    if LINE_WHITESPACE.search(sequence) is not None:
+        sequence = b''.join(line.rstrip() for line in lines.split(b'\n')).replace(b' ', b'').replace(b'\r', b'')
+    return sequence.decode('utf-8', 'replace')
+
+#Indexes a plain text FASTA file by scanning the memory-mapped bytes for headers
+def index_fasta_plain(fasta_file):
+    index = {'Name':[], 'offset':[], 'length':[]}
+    if os.path.getsize(fasta_file) == 0:
+        return pd.DataFrame(index)
+    with open(fasta_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            pos = 0 if mm[:1] == b'>' else mm.find(b'\n>') + 1 #Text before the first header is ignored
+            if pos == 0 and mm[:1] != b'>': #No records
+                return pd.DataFrame(index)
+            while True:
+                header_end = mm.find(b'\n', pos)
+                if header_end == -1:
+                    header_end = size
+                next_header = mm.find(b'\n>', header_end)
+                seq_end = next_header + 1 if next_header != -1 else size
+                index['Name'].append(fasta_name(mm[pos:header_end]))
+                index['offset'].append(min(header_end + 1, size))
+                index['length'].append(max(seq_end - header_end - 1, 0))
+                if next_header == -1:
+                    break
+                pos = next_header + 1
+    return pd.DataFrame(index)
+
+#Indexes a bgzip FASTA file. Offsets are BGZF virtual offsets, so records can be read without decompressing the file
+def index_fasta_bgzf(fasta_file):
+    index = {'Name':[], 'offset':[], 'length':[]}
+    with bgzf.BgzfReader(fasta_file, 'rb') as handle:
+        while True:
+            line = handle.readline()
+            if len(line) == 0:
+                break
+            if line.startswith(b'>'):
+                index['Name'].append(fasta_name(line))
+                index['offset'].append(handle.tell())
+                index['length'].append(0)
+            elif len(index['length']) > 0:
+                index['length'][-1] += len(line)
+    return pd.DataFrame(index)
+
+#Index of a FASTA file, like samtools faidx: one row per record, in file order,
+#with the offset and length of its sequence lines
+#Plain gzip files cannot be read at an offset, so their sequences are kept in the index instead
+def index_fasta(fasta_file):
+    file_compression = compression(fasta_file)
+    if file_compression is None:
+        return index_fasta_plain(fasta_file)
+    if file_compression == 'bgzf':
+        return index_fasta_bgzf(fasta_file)
+    print("%s is gzip compressed and cannot be indexed; reading all sequences (use bgzip instead)" % fasta_file)
+    fastas = {'Name':[], 'FASTA_sequence':[]}
+    with open_input(fasta_file) as f:
+        for fasta in SeqIO.parse(f,'fasta'):
+            fastas['Name'].append(fasta.id)
+            fastas['FASTA_sequence'].append(str(fasta.seq))
+    return pd.DataFrame(fastas)
+
+#Reads the sequences of some rows of a FASTA index, in order
+def fetch_fasta(fasta_file, index):
+    if 'FASTA_sequence' in index.columns:
+        return list(index['FASTA_sequence'])
+    sequences = []
+    if len(index) == 0:
+        return sequences
+    if compression(fasta_file) == 'bgzf':
+        with bgzf.BgzfReader(fasta_file, 'rb') as handle:
+            for offset, length in zip(index['offset'], index['length']):
+                handle.seek(int(offset))
+                sequences.append(fasta_sequence(handle.read(int(length))))
+    else:
+        with open(fasta_file, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                for offset, length in zip(index['offset'], index['length']):
+                    sequences.append(fasta_sequence(mm[offset:offset + length]))
+    return sequences
+
+#Reads the FASTA records with the given names into a dataframe of names and sequences, in file order
+#Only these records are read from the file. Records with other names are:
+#'none': skipped, 'first': skipped except for the first one, 'all': all read
+#index is the index of the file, if it was already made
+def select_fasta(fasta_file, names, missing = 'none', index = None):
+    if index is None:
+        index = index_fasta(fasta_file)
+    selected = index['Name'].isin(set(names)).to_numpy(copy = True) #written below, so it can't be a read-only view
+    if missing == 'all':
+        selected[:] = True
+    elif missing == 'first' and not selected.all():
+        selected[selected.argmin()] = True
+    rows = index[selected]
+    #Both columns are strings, also when no records are selected (so that they can still be merged on Name)
+    return pd.DataFrame({'Name':list(rows['Name']), 'FASTA_sequence':fetch_fasta(fasta_file, rows)},
+                        columns = ['Name', 'FASTA_sequence'], dtype = object)
+
+#Reads a fasta file into a dataframe of names and sequences
+def read_fasta(fasta_file):
+    return select_fasta(fasta_file, [], missing = 'all')
@@ -0,0 +1,342 @@
+#tbox_motifs.py
+#Structure landmarks and feature extraction shared by the transcriptional and translational T-box predictors
+#Each covariance model has a motif profile describing where its landmarks are
+#Also maps feature positions from the INFERNAL alignment to the FASTA sequence
+#Patterns are compiled once per process instead of being looked up on every re.search call
+
+import re
+import itertools
+from collections import namedtuple
+import numpy as np
+
+#Nucleotides accepted in codons and discriminators
+ACGU = frozenset('AaCcGgUu')
+NON_ACGU = re.compile('[^AaCcGgUu]')
+
+#Landmarks in an INFERNAL structure are pairs of structure characters, possibly separated by gaps ('.')
+#These are shared by all models
+STEM1_END = re.compile('>\.*,') #'>,' Stem 1 end
+ANTITERM_START = re.compile(',\.*<') #',<' antiterminator start
+ANTITERM_END = re.compile('>\.*:') #'>:' antiterminator end
+
+#How to find the Stem 1 specifier loop and codon for one covariance model
+#loop_start, loop_end: landmark patterns for the specifier loop start and end
+#loop_start_index, loop_end_index: which occurrence of each landmark to use (0 = first)
+#loop_end_at: 'start' or 'end', the position of the loop end match to use
+#loop_end_before_stem1: the loop end must come before the Stem 1 end
+#fallback: if the loop start is missing, use the last loop end strictly before the Stem 1 end
+#truncations: recalculate the loop from the end of Stem 1 if Stem 1 is truncated ('~')
+#codon: the codon is seq[loop_end - codon[0]:loop_end - codon[1]]
+#loop_end_offset: added to the reported loop end, on top of the position offset
+#codon_offsets: the codon start and end relative to the reported loop end, used when mapping to the FASTA sequence
+MotifProfile = namedtuple('MotifProfile', ['name', 'loop_start', 'loop_start_index', 'loop_end', 'loop_end_index',
+                                           'loop_end_at', 'loop_end_before_stem1', 'fallback', 'truncations', 'codon',
+                                           'loop_end_offset', 'codon_offsets'])
+
+#Makes a profile, compiling the landmark patterns
+def make_profile(name, loop_start, loop_end, **settings):
+    return MotifProfile(name = name, loop_start = re.compile(loop_start), loop_end = re.compile(loop_end), **settings)
+
+#Profiles for the supported covariance models
+PROFILES = {
+    #Transcriptional T-boxes: the specifier loop is the second '>-' ... '->' in Stem 1
+    'RF00230': make_profile('RF00230', '>\.*-', '-\.*>',
+                            loop_start_index = 1, loop_end_index = 1, loop_end_at = 'end',
+                            loop_end_before_stem1 = False, fallback = True, truncations = True,
+                            codon = (5, 2), loop_end_offset = -1, codon_offsets = (4, 2)),
+    #Translational T-boxes: the specifier loop is the first hairpin '<_' ... '_>'
+    'translational_ILE': make_profile('translational_ILE', '<\.*_', '_\.*>',
+                                      loop_start_index = 0, loop_end_index = 0, loop_end_at = 'start',
+                                      loop_end_before_stem1 = True, fallback = False, truncations = False,
+                                      codon = (3, 0), loop_end_offset = 0, codon_offsets = (3, 1)),
+}
+
+#Returns the start of the first match of a landmark, or -1
+def first_start(pattern, struct):
+    m = pattern.search(struct)
+    if m is not None:
+        return m.start()
+    return -1
+
+#Returns the starts of all matches of a landmark in struct[:endpos]
+def all_starts(pattern, struct, endpos = None):
+    if endpos is None:
+        endpos = len(struct)
+    return [m.start() for m in pattern.finditer(struct, 0, endpos)]
+
+#Returns the ends of all matches of a landmark in struct[:endpos]
+def all_ends(pattern, struct, endpos = None):
+    if endpos is None:
+        endpos = len(struct)
+    return [m.end() for m in pattern.finditer(struct, 0, endpos)]
+
+#Returns the n-th (0-indexed) match of a landmark, or None. Stops scanning once it is found
+def nth_match(pattern, struct, n):
+    for i, m in enumerate(pattern.finditer(struct)):
+        if i == n:
+            return m
+    return None
+
+#Returns the last ACGU position at or before pos, stopping at 0
+def last_ACGU(seq, pos):
+    while pos > 0 and seq[pos] not in ACGU:
+        pos -= 1
+    return pos
+
+#Returns the first ACGU position at or after pos, stopping at the last character
+def next_ACGU(seq, pos):
+    while pos < len(seq) - 1 and seq[pos] not in ACGU:
+        pos += 1
+    return pos
+
+#Function to find features of a T-box given the secondary structure
+#Parameters:
+#profile is the MotifProfile of the covariance model
+#seq is the sequence containing the T-box
+#struct is the secondary structure
+#offset is added to all positions
+
+#Output:
+#Stem 1 start, stem 1 specifier loop, codon, stem 1 end, antiterminator start, discriminator, antiterminator end
+def motif_features(profile, seq, struct, offset = 0):
+    warnings = ""
+    codon_region = ""
+
+    if len(seq)!=len(struct):
+        raise RuntimeError("Sequence length (%d) is not equal to structure length (%d)" % (len(seq), len(struct)))
+
+    if not (struct.startswith(':') or struct.startswith('<')):
+        warnings += "BAD_SEC_STRUCT;"
+
+    #Find the Stem 1 start
+    s1_start = struct.find('<') #Gets the first '<'
+    if s1_start == -1:
+        warnings += "NO_STEM1_START;"
+
+    #Find the Stem 1 end
+    s1_end = first_start(STEM1_END, struct) #Gets the first '>,' or possibly '>.,'
+    if s1_end == -1:
+        warnings += "NO_STEM1_END;"
+
+    #Find the Stem 1 specifier loop start
+    m = nth_match(profile.loop_start, struct, profile.loop_start_index)
+    if m is not None:
+        s1_loop_start = m.start()
+    else:
+        s1_loop_start = -1
+        warnings += "NO_SPEC_START;"
+
+    #Find the Stem 1 specifier loop end
+    s1_loop_end = -1
+    if s1_loop_start != -1 or not profile.fallback:
+        m = nth_match(profile.loop_end, struct, profile.loop_end_index)
+        if m is not None:
+            end = m.end() if profile.loop_end_at == 'end' else m.start()
+            if not profile.loop_end_before_stem1 or end < s1_end:
+                s1_loop_end = end
+    else: #Use fallback method to find Stem 1 specifier end
+        for m in profile.loop_end.finditer(struct):
+            end = m.end() if profile.loop_end_at == 'end' else m.start()
+            if end > s1_loop_start and end < s1_end - 1: #The last loop STRICTLY before the stem 1 end
+                s1_loop_end = end
+    if s1_loop_end == -1:
+        warnings += "NO_SPEC_END;"
+
+    #Check to see if the Stem 1 has truncations
+    if profile.truncations and '~' in struct[s1_start:s1_end+1]: #there is a truncation
+        warnings += "TRUNCATED_STEM_1;"
+        #Recalculate Stem 1 loop end
+        if profile.loop_end_at == 'end':
+            matches = all_ends(profile.loop_end, struct, s1_end + 1)
+        else:
+            matches = all_starts(profile.loop_end, struct, s1_end + 1)
+        if len(matches) > 1: #there should be at least 2
+            s1_loop_end = matches[-2] #get the second to last
+        if s1_loop_end == -1:
+            warnings += "NO_SPEC_END;"
+        else: #Recalculate Stem 1 loop start
+            matches = all_starts(profile.loop_start, struct, s1_loop_end + 1)
+            if len(matches) >= 1:
+                s1_loop_start = matches[-1] #get the last one before the Stem 1 loop end
+
+    if s1_loop_end > s1_loop_start: #Sanity check
+        #Read the codon
+        codon = seq[s1_loop_end - profile.codon[0]: s1_loop_end - profile.codon[1]]
+        #Check the codon
+        if NON_ACGU.search(codon) is not None:
+            warnings += "BAD_CODON;"
+        else: #Assign the codon region
+            minus_one_pos = last_ACGU(seq, s1_loop_end - 6) #Look for the first ACGU character before the codon
+            plus_one_pos = next_ACGU(seq, s1_loop_end - 2) #Look for the first ACGU character after the codon
+            codon_region = seq[minus_one_pos] + codon + seq[plus_one_pos] #Get the surrounding region too, for +1/-1 predictions
+    else:
+        codon = ""
+        warnings += "NO_CODON;"
+
+    #Find the antiterminator start
+    antiterm_list = all_starts(ANTITERM_START, struct) #Makes a list of all occurences of ',<'
+    if len(antiterm_list) > 0:
+        antiterm_start = antiterm_list[-1] #Gets the last one
+        discrim_start = struct.find('---', antiterm_start + 3) #Find the loop containing the discriminator
+        discrim_end = discrim_start + 4
+        discrim = seq[discrim_start:discrim_end]
+    else:
+        antiterm_start = -1
+        discrim_start = -1
+        discrim_end = -1
+        discrim = ""
+        warnings += "NO_ANTITERM_START;"
+
+    #Check the discriminator
+    if not discrim.startswith('UGG') or NON_ACGU.search(discrim) is not None:
+        warnings += "BAD_DISCRIM;"
+
+    #Find the antiterminator
+    antiterm_end = first_start(ANTITERM_END, struct) #Gets the first '>:' or possibly '>.:'
+    if antiterm_end == -1: #Sometimes the antiterminator end is missing from the sequence
+        antiterm_end = struct.rfind('>') #Simply get the last '>'
+        if antiterm_end == -1:
+            warnings += "NO_ANTITERM_END;"
+
+    #Adjust values based on offset
+    s1_start += offset
+    s1_loop_start += offset + 1
+    s1_loop_end += offset + profile.loop_end_offset
+    s1_end += offset
+    antiterm_start += offset + 1
+    antiterm_end += offset
+    discrim_start += offset
+    discrim_end += offset - 1
+
+    #Return a tuple with the features identified
+    return (s1_start, s1_loop_start, s1_loop_end, codon, s1_end, antiterm_start, discrim, antiterm_end, codon_region, warnings, discrim_start, discrim_end)
+
+#Names of the values returned by motif_features, in order
+FEATURE_COLUMNS = ['s1_start', 's1_loop_start', 's1_loop_end', 'codon', 's1_end', 'antiterm_start', 'discriminator',
+                   'antiterm_end', 'codon_region', 'warnings', 'discrim_start', 'discrim_end']
+
+#Finds the features of arrays of sequences and structures in one pass
+#profiles is one MotifProfile for all hits, or one per hit, so hits from several models can be mixed
+#Returns a dictionary from feature name to a list of values, in the same order as the input
+def features_batch(profiles, sequences, structures, offset = 0):
+    if isinstance(profiles, MotifProfile):
+        profiles = itertools.repeat(profiles)
+    print('Deriving features for %d hits' % len(sequences)) #Write to log
+    features = [motif_features(profile, seq, struct, offset) for profile, seq, struct in zip(profiles, sequences, structures)]
+    if len(features) == 0:
+        return {column:[] for column in FEATURE_COLUMNS}
+    return {column:list(values) for column, values in zip(FEATURE_COLUMNS, zip(*features))}
+
+#Gaps in the INFERNAL sequence are written as '[ N]', meaning N FASTA bases are skipped
+GAP_TOKEN = re.compile('\[([^\]]*)\]')
+
+#Lookup table of the characters counted as FASTA bases
+def base_table(allowed):
+    table = np.zeros(256, dtype = np.int64)
+    table[np.frombuffer(allowed.encode('ascii'), dtype = np.uint8)] = 1
+    return table
+
+BASES = base_table('AaGgCcUu')
+
+#Makes the array of FASTA bases used by each character of the INFERNAL sequences, concatenated
+#Characters inside '[ N]' gaps count 0, the closing ']' counts N
+#Returns the increments and the start of each sequence in the concatenation
+def base_increments(sequences, table = BASES):
+    starts = np.zeros(len(sequences) + 1, dtype = np.int64)
+    starts[1:] = np.cumsum([len(seq) for seq in sequences])
+    joined = ''.join(sequences).encode('ascii', 'replace')
+    increments = table[np.frombuffer(joined, dtype = np.uint8)]
+    for start, seq in zip(starts, sequences):
+        if '[' not in seq:
+            continue
+        gap_end = 0
+        for m in GAP_TOKEN.finditer(seq):
+            increments[start + m.start():start + m.end() - 1] = 0
+            increments[start + m.end() - 1] = int(m.group(1).strip()) #Parse the value
+            gap_end = m.end()
+        unclosed = seq.find('[', gap_end)
+        if unclosed != -1: #A gap that never ends: nothing after it is counted
+            increments[start + unclosed:start + len(seq)] = 0
+    return increments, starts
+
+#Convert between position in INFERNAL output and fasta sequence
+#Count the gaps and adjust for them
+#Returns a mapping between INFERNAL position and fasta position, as an array
+def map_fasta(seq, fasta = None, offset = 0, allowed = 'AaGgCcUu'):
+    increments, starts = base_increments([seq], BASES if allowed == 'AaGgCcUu' else base_table(allowed))
+    mapping = np.zeros(len(seq), dtype = np.int64)
+    mapping[1:] = np.cumsum(increments[:-1])
+    return mapping + offset
+
+#Maps the INFERNAL-relative features of a batch of T-boxes to FASTA positions, in place
+#Rows without an INFERNAL sequence (NaN) are skipped
+#codon_offsets: the codon start and end relative to the loop end (from the motif profile)
+#find_term_end: if given, term_end is set to find_term_end(FASTA_sequence, antiterm_end) after mapping
+def remap_features(tboxes, codon_offsets, find_term_end = None):
+    rows = np.array([isinstance(seq, str) for seq in tboxes['Sequence']], dtype = bool)
+    if not rows.any():
+        return tboxes
+    sequences = list(tboxes['Sequence'][rows])
+    lengths = np.array([len(seq) for seq in sequences], dtype = np.int64)
+    increments, starts = base_increments(sequences)
+    #cumulative[starts[r] + k] - cumulative[starts[r]] is the number of bases before position k of sequence r
+    cumulative = np.zeros(len(increments) + 1, dtype = np.int64)
+    cumulative[1:] = np.cumsum(increments)
+    offsets = tboxes['Tbox_start'].to_numpy()[rows] - 1
+    
+    #Look up positions in the mapping. Negative positions count from the end, like list indexing
+    #Returns the FASTA positions and which rows could be mapped
+    def gather(positions, selected):
+        positions = np.where(positions < 0, positions + lengths, positions)
+        selected = selected & (positions >= 0) & (positions < lengths)
+        index = starts[:-1] + np.where(selected, positions, 0)
+        return offsets + cumulative[index] - cumulative[starts[:-1]], selected
+    
+    def feature(column):
+        return tboxes[column].to_numpy()[rows].astype(np.int64)
+    
+    #Each feature is mapped from its own INFERNAL position
+    s1_start = feature('s1_start')
+    s1_loop_start = feature('s1_loop_start')
+    s1_loop_end = feature('s1_loop_end')
+    s1_end = feature('s1_end')
+    aterm_start = feature('antiterm_start')
+    discrim_start = feature('discrim_start')
+    aterm_end = np.minimum(feature('antiterm_end'), lengths - 1)
+    
+    loop_end_mapped = (s1_loop_end > 0) & (s1_loop_end < lengths)
+    for i in np.flatnonzero((s1_loop_end > 0) & ~loop_end_mapped):
+        print("Warning: mapping error for s1_loop_end:")
+        print(s1_loop_end[i])
+        print(lengths[i])
+        print(list(offsets[i] + cumulative[starts[i]:starts[i] + lengths[i]] - cumulative[starts[i]]))
+    
+    mapped = {'s1_start':gather(s1_start, s1_start > 0),
+              's1_loop_start':gather(s1_loop_start, s1_loop_start > 0),
+              's1_loop_end':gather(s1_loop_end, loop_end_mapped),
+              'codon_start':gather(s1_loop_end - codon_offsets[0], loop_end_mapped),
+              'codon_end':gather(s1_loop_end - codon_offsets[1], loop_end_mapped),
+              's1_end':gather(s1_end, s1_end > 0),
+              'antiterm_start':gather(aterm_start, aterm_start > 0),
+              'discrim_start':gather(discrim_start, discrim_start > 0),
+              'discrim_end':gather(discrim_start + 3, discrim_start > 0), #+3 because inclusive
+              'antiterm_end':gather(aterm_end, feature('antiterm_end') > 0)}
+    
+    #Write each column once, keeping its dtype
+    for column, (values, selected) in mapped.items():
+        column_values = tboxes[column].to_numpy(copy = True)
+        row_values = column_values[rows]
+        row_values[selected] = values[selected]
+        column_values[rows] = row_values
+        tboxes[column] = column_values
+    
+    #Calculate terminator end
+    if find_term_end is not None:
+        values, selected = mapped['antiterm_end']
+        column_values = tboxes['term_end'].to_numpy(copy = True)
+        row_values = column_values[rows]
+        fastas = tboxes['FASTA_sequence'].to_numpy()[rows]
+        row_values[selected] = [find_term_end(fasta, int(end)) for fasta, end in zip(fastas[selected], values[selected])]
+        column_values[rows] = row_values
+        tboxes['term_end'] = column_values
+    return tboxes
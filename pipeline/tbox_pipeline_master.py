@@ -3,82 +3,21 @@
 #Reads INFERNAL output data and calculates T-box features
 #Also calculates thermodynamic parameters (code by Thomas Jordan)
 
-import sys
 import re
+import argparse
+import numpy as np
 import pandas as pd
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.Alphabet import generic_dna
-import subprocess
-
-#Function to read an INFERNAL output file and extract sequence names, metadata, structure, and sequence
-#Metadata is as described in the INFERNAL manual
-def read_INFERNAL(file):
-    metadata = []
-    Tbox_start = -1
-    Tbox_end = -1
-    sp = ""
-    sp_start = ""
-
-    metadataLine = -1
-    structLine = -1
-    seqLine = -1
-
-    Tboxes = {'Name':[], 'Rank':[], 'E_value':[], 'Score':[], 'Bias':[], 'Tbox_start':[],'Tbox_end':[],
-               'CM_accuracy':[], 'GC':[], 'Sequence':[], 'Structure':[]}
-
-    with open(file) as f:
-        for lineCount, line in enumerate(f):
-            if re.match(">>", line) is not None: #We found a match!
-                Tboxes['Name'].append(line.split(" ")[1])
-
-                metadataLine = lineCount + 3
-                structLine = lineCount + 6
-                seqLine = lineCount + 9
-
-            if lineCount == metadataLine:
-                metadata = list(filter(None, line.split(' '))) #Splits by spaces, and strips empty strings
-
-                Tboxes['Rank'].append(int(metadata[0][1:len(metadata[0])-1])) #All except first and last characters
-                Tboxes['E_value'].append(float(metadata[2])) #third entry
-                Tboxes['Score'].append(float(metadata[3])) #fourth
-                Tboxes['Bias'].append(float(metadata[4])) #fifth
-                Tbox_start = metadata[9]
-                Tboxes['Tbox_start'].append(int(Tbox_start))
-                Tbox_end = metadata[10]
-                Tboxes['Tbox_end'].append(int(Tbox_end))
-                #Tboxes['Strand'].append(metadata[11])
-                Tboxes['CM_accuracy'].append(float(metadata[13]))
-                Tboxes['GC'].append(float(metadata[15][0:4])) #ignore the \n at the end
-
-            if lineCount == structLine:
-                sp = list(filter(None,line.split(' ')))
-                structure = sp[0]
-                Tboxes['Structure'].append(structure) #Take the second-to-last one
-
-            if lineCount == seqLine:
-                seq_line = list(filter(None, line.strip().split(' ')))
-                sequence = ' '.join(seq_line[2:len(seq_line) - 1])
-
-                #Fallback method (adapted from Thomas Jordan's code):
-                if sequence not in line: #This can happen if there are two consecutive spaces in the middle of the sequence.
-                    rsp = line.rsplit(Tbox_end, maxsplit = 1)
-                    lsp = rsp[0].split(Tbox_start + ' ')
-                    sequence = lsp[len(lsp) - 1].strip()
-                    print("Fallback on line %d" % lineCount)
-
-                #Do a sanity check
-                if len(sequence) != len(structure): #This is an error!
-                    print("\nParsing ERROR occured on line %d" % lineCount)
-                    print(line) #For debug purposes
-                    print(sequence)
-                    print(structure)
-                    print(seq_line)
-                    #sequence = "ERROR"
-                    
-                Tboxes['Sequence'].append(sequence)
-                
-    return pd.DataFrame(Tboxes)
+from Bio.Data.IUPACData import ambiguous_dna_complement
+from tbox_io import read_INFERNAL, index_fasta, select_fasta
+import vienna
+from tbox_motifs import PROFILES, FEATURE_COLUMNS, motif_features, features_batch, remap_features
+from rna_structure import pair_table, outer_pairs
+from tbox_predictor import predict_unique, predict_hit_features, run_thermo_parallel, temperature_sweep, add_ensemble, predict_chunks
+from tbox_predictor import add_common_arguments, apply_common_arguments
+from poly_u import poly_u_index, first_poly_u
+
+#Motif profile of the covariance model
+PROFILE = PROFILES['RF00230']
 
 #Function to find features of a T-box given the secondary structure
 #Parameters: 
@@ -88,159 +27,9 @@ def read_INFERNAL(file):
 
 #Output:
 #Stem 1 start, stem 1 specifier loop, codon, stem 1 end, antiterminator start, discriminator, antiterminator end
-
+#See motif_features in tbox_motifs.py; the model-specific landmarks are in PROFILE
 def tbox_features(seq, struct, offset = 0):
-    warnings = ""
-    codon_region = ""
-    
-    if len(seq)!=len(struct):
-        raise RuntimeError("Sequence length (%d) is not equal to structure length (%d)" % (len(seq), len(struct)))
-        
-    if not (struct.startswith(':') or struct.startswith('<')):
-        warnings += "BAD_SEC_STRUCT;"
-    
-    #Find the Stem 1 start
-    m = re.search('<',struct)
-    if m is not None:
-        s1_start = m.start() #Gets the first '<'
-    else:
-        s1_start = -1
-        warnings += "NO_STEM1_START;"
-        
-    #Find the Stem 1 end
-    m = re.search('>\.*,',struct)
-    if m is not None:
-        s1_end = m.start() #Gets the first '>,' or possibly '>.,'
-    else:
-        s1_end = -1
-        warnings += "NO_STEM1_END;"
-    
-    #Find the Stem 1 specifier loop start
-    matches = [m.start() for m in re.finditer('>\.*-', struct)]
-    if len(matches) > 1:
-        s1_loop_start = matches[1] #Gets the second occurrence of '>-' or possibly '>.-'
-        #Find the Stem 1 specifier end
-        matches = [m.end() for m in re.finditer('-\.*>', struct)]
-        if len(matches) > 1:
-            s1_loop_end = matches[1] #Gets the second occurrence of '->' or possibly '-.>'
-        else:
-            s1_loop_end = -1
-            warnings += "NO_SPEC_END;"
-    else:
-        s1_loop_start = -1
-        warnings += "NO_SPEC_START;"
-        #Use fallback method to find Stem 1 specifier end
-        s1_loop_end = -1
-        for m in re.finditer('-\.*>', struct):
-            end = m.end()
-            if end > s1_loop_start and end < s1_end - 1: #The last loop STRICTLY before the stem 1 end
-                s1_loop_end = end
-        if s1_loop_end == -1: warnings += "NO_SPEC_END;"
-
-    #Check to see if the Stem 1 has truncations
-    if '~' in struct[s1_start:s1_end+1]: #there is a truncation
-        warnings += "TRUNCATED_STEM_1;"
-        #Recalculate Stem 1 loop end
-        matches = [m.end() for m in re.finditer('-\.*>', struct[:s1_end+1])]
-        if len(matches) > 1: #there should be at least 2
-            s1_loop_end = matches[-2] #get the second to last
-        if s1_loop_end == -1:
-            warnings += "NO_SPEC_END;"
-        else: #Recalculate Stem 1 loop start
-            matches = [m.start() for m in re.finditer('>\.*-', struct[:s1_loop_end+1])]
-            if len(matches) >= 1:
-                s1_loop_start = matches[-1] #get the last one before the Stem 1 loop end
-
-    if s1_loop_end > s1_loop_start: #Sanity check
-        #Read the codon
-        codon = seq[s1_loop_end - 5: s1_loop_end - 2] 
-        #Check the codon
-        if re.search('[^AaCcGgUu]', codon) is not None:
-            warnings += "BAD_CODON;"
-        else: #Assign the codon region
-            minus_one_pos = s1_loop_end - 6
-            while minus_one_pos > 0 and re.match('[^AaCcGgUu]', seq[minus_one_pos]) is not None:
-                minus_one_pos -= 1 #Look for the first ACGU character before the codon
-            plus_one_pos = s1_loop_end - 2
-            while plus_one_pos < len(seq) - 1 and re.match('[^AaCcGgUu]', seq[plus_one_pos]) is not None:
-                plus_one_pos += 1 #Look for the first ACGU character after the codon
-            codon_region = seq[minus_one_pos] + codon + seq[plus_one_pos] #Get the surrounding region too, for +1/-1 predictions
-    else:
-        codon = ""
-        warnings += "NO_CODON;"
-        
-    #Find the antiterminator start
-    antiterm_list = [m.start() for m in re.finditer(',\.*<', struct)] #Makes a list of all occurences of ',<'
-    if len(antiterm_list) > 0:
-        antiterm_start = antiterm_list[len(antiterm_list)-1] #Gets the last one
-        discrim_start = struct.find('---', antiterm_start + 3) #Find the loop containing the discriminator
-        discrim_end = discrim_start + 4
-        discrim = seq[discrim_start:discrim_end]
-    else:
-        antiterm_start = -1
-        discrim_start = -1
-        discrim_end = -1
-        discrim = ""
-        warnings += "NO_ANTITERM_START;"
-    
-    #Check the discriminator
-    if not discrim.startswith('UGG') or re.search('[^AaCcGgUu]', discrim) is not None:
-        warnings += "BAD_DISCRIM;"
-    
-    #Find the antiterminator
-    match = re.search('>\.*:',struct)
-    if match is not None: #Sometimes the antiterminator end is missing from the sequence
-        antiterm_end = match.start()
-    else: #Simply get the last '>'
-        end_list = [m.start() for m in re.finditer('>', struct)]
-        if len(end_list) > 0:
-            antiterm_end = end_list[len(end_list)-1]
-        else:
-            antiterm_end = -1
-            warnings += "NO_ANTITERM_END;"
-    
-    #Adjust values based on offset
-    s1_start += offset
-    s1_loop_start += offset + 1
-    s1_loop_end += offset - 1
-    s1_end += offset
-    antiterm_start += offset + 1
-    antiterm_end += offset
-    discrim_start += offset
-    discrim_end += offset - 1
-    
-    #Return a tuple with the features identified
-    return (s1_start, s1_loop_start, s1_loop_end, codon, s1_end, antiterm_start, discrim, antiterm_end, codon_region, warnings, discrim_start, discrim_end)
-
-#Convert between position in INFERNAL output and fasta sequence
-#Count the gaps and adjust for them
-#Returns a mapping between INFERNAL position and fasta position
-def map_fasta(seq, fasta, offset = 0, allowed = 'AaGgCcUu'):
-    #Initialize counters
-    count_fasta = offset
-    parse_buffer = ""
-    parsing = False
-    mapping = []
-
-    for c in seq:
-        mapping.append(count_fasta)
-        
-        if parsing:
-            if c == ']': #The end of the numerical gap
-                parsing = False
-                count_fasta += int(parse_buffer.strip()) #Parse the value
-                #print(parse_buffer) #debug
-                parse_buffer = "" #reset buffer for the next gap
-            else:
-                parse_buffer += c #Add the character to the parse buffer
-            
-        elif c in allowed:
-            count_fasta += 1
-            
-        elif c == '[': # The start of a numerical gap
-            parsing = True
-        
-    return mapping
+    return motif_features(PROFILE, seq, struct, offset)
 
 #Function to find the end of the terminator (last occurence of TTTTT in the fasta sequence)
 def term_end(sequence, start, pattern = 'TTTTT'):
@@ -249,133 +38,94 @@ def term_end(sequence, start, pattern = 'TTTTT'):
         return match + len(pattern) #- 1
     return len(sequence) #fallback: return the end
 
+#Byte translation table for the complement of DNA, including IUPAC ambiguity codes, in upper and lower case
+#Other characters are left unchanged
+BASES = ''.join(ambiguous_dna_complement.keys())
+COMPLEMENTS = ''.join(ambiguous_dna_complement.values())
+COMPLEMENT = bytes.maketrans((BASES + BASES.lower()).encode('ascii'), (COMPLEMENTS + COMPLEMENTS.lower()).encode('ascii'))
+
+#Reverse complement of a DNA sequence string
+def reverse_complement(sequence):
+    return sequence.encode('latin-1').translate(COMPLEMENT)[::-1].decode('latin-1')
+
+#Converts negative-strand T-boxes to the positive strand, in place
+#The name coordinates are swapped, the FASTA sequence is reverse-complemented, and the T-box start and end become
+#relative to the reverse complement. Other features, which are INFERNAL-relative, should not be converted yet
+def normalize_strands(tboxes):
+    minus = (tboxes['Sequence'].map(lambda seq: isinstance(seq, str)) & (tboxes['Tbox_start'] > tboxes['Tbox_end'])).to_numpy()
+    if not minus.any():
+        return tboxes
+    print("Converting %d – strand T-boxes to +" % minus.sum())
+    
+    #Convert names: name:start-end becomes name:end-start
+    names = tboxes['Name'][minus]
+    split_name = names.str.split(':')
+    coordinates = split_name.str[1].str.split('-')
+    new_names = split_name.str[0] + ':' + coordinates.str[1] + '-' + coordinates.str[0]
+    if new_names.isna().any():
+        print("Warning: could not convert the names of these – strand T-boxes:")
+        print(list(names[new_names.isna()]))
+        new_names = new_names.fillna(names)
+    
+    #Convert FASTA sequences and T-box start and end (since these are FASTA-relative)
+    fastas = tboxes['FASTA_sequence'][minus]
+    lengths = fastas.str.len().to_numpy()
+    columns = {'Name':new_names.to_numpy(),
+               'FASTA_sequence':[reverse_complement(fasta) for fasta in fastas],
+               'Tbox_start':lengths - tboxes['Tbox_start'].to_numpy()[minus] + 1,
+               'Tbox_end':lengths - tboxes['Tbox_end'].to_numpy()[minus] + 1}
+    for column, values in columns.items():
+        column_values = tboxes[column].to_numpy(copy = True)
+        column_values[minus] = values
+        tboxes[column] = column_values
+    return tboxes
+
 #Function to compute derived T-box features from the prediction
 #Note: tboxes must contain fasta sequences!
 def tbox_derive(tboxes):
     #Derive more features for visualization
-    #ALSO: Handle negative-strand T-boxes
-
-    for i in range(len(tboxes['FASTA_sequence'])):
-        fasta = tboxes['FASTA_sequence'][i]
-        print('Mapping ' + tboxes['Name'][i]) #debug
-        seq = tboxes['Sequence'][i]
-        if isinstance(seq, str): #sanity check. Skip NaN
-            #Check if the T-box is on the NEGATIVE strand
-            if tboxes['Tbox_start'][i] > tboxes['Tbox_end'][i]:
-                print("Converting – strand to +: " + tboxes['Name'][i])
-                #Convert name
-                split_name = tboxes['Name'][i].split(':')
-                seq_start = split_name[1].split('-')[0]
-                seq_end = split_name[1].split('-')[1]
-                tboxes.at[tboxes.index[i], 'Name'] = split_name[0] + ':' + seq_end + '-' + seq_start
-                #Convert FASTA sequence
-                sequence = Seq(fasta, generic_dna)
-                tboxes.at[tboxes.index[i], 'FASTA_sequence'] = str(sequence.reverse_complement())
-                #Convert T-box start and end (since these are FASTA-relative)
-                #Other features, which are INFERNAL-relative, should not be converted yet
-                tboxes.at[tboxes.index[i], 'Tbox_start'] = len(fasta) - tboxes['Tbox_start'][i] + 1
-                tboxes.at[tboxes.index[i], 'Tbox_end'] = len(fasta) - tboxes['Tbox_end'][i] + 1
-                print("Conversion complete. New name is: " + tboxes['Name'][i])
-                
-            #Create mapping between INFERNAL sequence and FASTA sequence
-            mapping = map_fasta(seq, tboxes['FASTA_sequence'][i], offset = tboxes['Tbox_start'][i] - 1)
-            #Update the positions of existing features.
-            s1_start = int(tboxes['s1_start'][i])
-            if s1_start > 0:
-                tboxes.at[tboxes.index[i], 's1_start'] = mapping[s1_start]
-
-            s1_loop_start = int(tboxes['s1_loop_start'][i])
-            if s1_loop_start > 0:
-                tboxes.at[tboxes.index[i], 's1_loop_start'] = mapping[s1_loop_start]
-
-            s1_loop_end = int(tboxes['s1_loop_end'][i])
-            if s1_loop_end > 0:
-                if s1_loop_end < len(mapping):
-                    tboxes.at[tboxes.index[i], 's1_loop_end'] = mapping[s1_loop_end]
-                    #Calculate codon range
-                    tboxes.at[tboxes.index[i], 'codon_start'] = mapping[s1_loop_end - 4]
-                    tboxes.at[tboxes.index[i], 'codon_end'] = mapping[s1_loop_end - 2]
-                else:
-                    print("Warning: mapping error for s1_loop_end:")
-                    print(s1_loop_end)
-                    print(len(mapping))
-                    print(mapping)
-
-            s1_end = int(tboxes['s1_end'][i])
-            if s1_end > 0:
-                tboxes.at[tboxes.index[i], 's1_end'] = mapping[s1_end]
-
-            aterm_start = int(tboxes['antiterm_start'][i])
-            if aterm_start > 0:
-                tboxes.at[tboxes.index[i], 'antiterm_start'] = mapping[aterm_start]
-            
-            #Calculate discriminator range
-            discrim_start = int(tboxes['discrim_start'][i])
-            if discrim_start > 0:
-                tboxes.at[tboxes.index[i], 'discrim_start'] = mapping[discrim_start]
-                tboxes.at[tboxes.index[i], 'discrim_end'] = mapping[discrim_start + 3] #+3 because inclusive
-
-            aterm_end = int(tboxes['antiterm_end'][i])
-            if aterm_end > 0:
-                aterm_end = min(aterm_end, len(mapping)-1)
-                tboxes.at[tboxes.index[i], 'antiterm_end'] = mapping[aterm_end]
-                #Calculate terminator end
-                tboxes.at[tboxes.index[i], 'term_end'] = term_end(tboxes['FASTA_sequence'][i], int(tboxes['antiterm_end'][i]))
-    return tboxes
+    for name in tboxes['Name']:
+        print('Mapping ' + name) #debug
+    
+    #Handle negative-strand T-boxes
+    tboxes = normalize_strands(tboxes)
+    
+    #Create mappings between INFERNAL sequences and FASTA sequences, and update the positions of existing features
+    return remap_features(tboxes, PROFILE.codon_offsets, term_end)
 
-def term_end_regex(sequence, start, pattern = '[T]{3,}[ACGT]{,1}[T]{1,}[ACGT]{,1}[T]{1,}'):
-    print(start)
+#End of the first terminator poly U (poly_u.TERM_POLY_U) after the start, or the end of the sequence if there is none
+def term_end_regex(sequence, start):
     if pd.isna(start):
         return len(sequence)
-    matches = [m.end() for m in re.finditer(pattern, sequence[start:])]
-    if len(matches)>0:
-        return start + matches[0]
-    return len(sequence) #fallback: return the end
+    return poly_u_ends(poly_u_index([sequence]), [0], [start])[0]
+
+#Ends of the first terminator poly U after each start, in rows of a poly U index (see poly_u.py)
+#Rows without a poly U get the end of their sequence
+def poly_u_ends(index, rows, starts):
+    match_starts, match_ends = first_poly_u(index, rows, starts)
+    return np.where(match_ends >= 0, match_ends, index.lengths[rows])
 
 #RNAfold on target sequence
 def get_fold(sequence):
-    #Initialize outputs
-    structure = ""
-    energy = ""
-    errors = ""
-
-    vienna_args = ['RNAfold', '--noPS', '-T', '37'] # arguments used to call RNAfold at 37 degrees
-    vienna_input = str(sequence) # the input format
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    
-    output = vienna_call.stdout.split('\n')
-    if len(output) > 1: # if there is a result
-        output = output[-2]
-        output = output.split()
-        structure = output[0] # gets last line's structure (always will be first element when sliced)
-        energy = output[-1].replace(')', '').replace('(', '') # get energy (always will be last element in slice)
-    errors = vienna_call.stderr.replace('\n',' ')
-    return structure, energy, errors
+    return vienna.fold(sequence)
+
+#RNAfold on a column of target sequences (long sequences are folded in a window, see vienna.fold_column)
+def get_fold_column(sequences):
+    return vienna.fold_column(sequences)
 
 #RNAfold on target sequence, with constraints
 def get_fold_constraints(sequence, structure):
-    #Initialize outputs
-    energy = ""
-    errors = ""
-    structure_out = ""
-
-    vienna_args = ['RNAfold', '--noPS', '-T', '37', '-C'] # arguments used to call RNAfold at 37 degrees with constraints
-    vienna_input = str(sequence) + '\n' + str(structure) # the input format
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    
-    output = vienna_call.stdout.split('\n')
-    if len(output) > 1: # if there is a result
-        output = output[-2]
-        output = output.split()
-        structure_out = output[0] # gets last line's structure (always will be first element when sliced)
-        energy = output[-1].replace(')', '').replace('(', '') # get energy (always will be last element in slice)
-    errors = vienna_call.stderr.replace('\n','') #changed from ' '
-    return structure_out, energy, errors
+    return vienna.fold_constraints(sequence, structure)
+
+#RNAfold on a column of target sequences, with constraints
+def get_fold_constraints_column(sequences, structures, temperature = None):
+    return vienna.fold_constraints_column(sequences, structures, temperature)
 
 #Make antiterminator constraints for folding
+#Returns the constraints and the position before the discriminator UGGN, or None if there is nothing to refold
 def make_antiterm_constraints(sequence, structure):
     if pd.isna(sequence) or pd.isna(structure):
-        return None, None, None
+        return None, None
     
     # search for antiterm end
     antiterm_end = term_end(structure, 0, pattern = ')') + 1 #search for last ')', which is the antiterm end
@@ -390,28 +140,44 @@ def make_antiterm_constraints(sequence, structure):
         # make hard constraint for discriminator 
         if(discriminator):
             constraints = constraints[:(discriminator.start() + match.start() + 1)] + 'xxxx' + constraints[(discriminator.end() + match.start() + 1):]
-            structure_out, energy, errors = get_fold_constraints(sequence, constraints)
             pre_UGG = discriminator.start() + match.start()
-            if (pre_UGG < 1) or (structure_out[pre_UGG] != '('): #check if base immediately before UGGN is paired
-                if structure_out[0:4] != '((((': 
-                    errors += "BAD_ANTITERM_STEM"
-            return structure_out, energy, errors
-    return None, None, None
+            return constraints, pre_UGG
+    return None, None
+
+#Check the stem of a refolded antiterminator
+def check_antiterm_stem(structure_out, energy, errors, pre_UGG):
+    if (pre_UGG < 1) or (structure_out[pre_UGG] != '('): #check if base immediately before UGGN is paired
+        if structure_out[0:4] != '((((': 
+            errors += "BAD_ANTITERM_STEM"
+    return structure_out, energy, errors
+
+#Refold the antiterminators with constraints (from make_antiterm_constraints), with one RNAfold call for all of them
+#Returns a list of (structure, energy, errors), one per antiterminator
+def refold_antiterms(sequences, constraints):
+    sequences = list(sequences)
+    refold = [i for i, (constraint, pre_UGG) in enumerate(constraints) if constraint is not None]
+    folds = get_fold_constraints_column([sequences[i] for i in refold], [constraints[i][0] for i in refold])
+    results = [(None, None, None)] * len(sequences)
+    for i, (structure_out, energy, errors) in zip(refold, folds):
+        results[i] = check_antiterm_stem(structure_out, energy, errors, constraints[i][1])
+    return results
 
 #RNAeval to get energy
 def get_energy(sequence, structure):
     if pd.isna(sequence) or pd.isna(structure):
         return None, ""
-
-    vienna_args = ['RNAeval', '-T', '37'] # arguments that are used to call vienna RNAeval at T 37 degrees  
-    vienna_input = str(sequence + "\n" + structure) # the input format
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    # calls the subprocess with the vienna_input as input for the program
-    energy = vienna_call.stdout.split()
-    if energy: # if there actually is a result
-        energy = energy[-1].replace('(', '').replace(')', '')
-    errors = vienna_call.stderr.replace('\n',' ')
-    return energy, errors
+    return vienna.eval_energy(sequence, structure)
+
+#RNAeval on a column of sequences and structures, with one RNAeval call for the rows that have both
+def get_energy_column(sequences, structures, temperature = None):
+    sequences = list(sequences)
+    structures = list(structures)
+    rows = [i for i in range(len(sequences)) if not (pd.isna(sequences[i]) or pd.isna(structures[i]))]
+    energies = vienna.energy_column([sequences[i] for i in rows], [structures[i] for i in rows], temperature)
+    results = [(None, "")] * len(sequences)
+    for i, result in zip(rows, energies):
+        results[i] = result
+    return results
 
 def get_sequence(fasta, start, end):
     if pd.isna(fasta) or pd.isna(start) or pd.isna(end):
@@ -451,114 +217,86 @@ def replace_characters(structure):
             structure = structure.replace(c, ")") # creates a normal closed bracket
     return structure
 
+TRUNCATION = re.compile('\*\[.+?\][\*>]')
+GAP = re.compile('-')
+
 # removes truncations and adds the missing nucleotides from the FASTA
+# the new sequence and structure are built from pieces in one pass, and joined at the end
 def resolve_truncations(fasta_sequence, processed_sequence, processed_structure):
-
-    processed_length = len(processed_sequence) 
+    sequence_pieces = []
+    structure_pieces = []
+    length = 0 # length of the new sequence so far
+    sequence_gaps = 0 # number of gaps in the new sequence so far, important for alignment
+    end = 0 # end of the previous truncation in the input
     
-    for truncations in re.finditer('\*\[.+?\][\*>]', processed_sequence):
+    for truncations in TRUNCATION.finditer(processed_sequence):
         # finds the characters representing the truncation in the sequence
         # truncations have the form *[ N]* where N is a number of nucleotides
         # regexp : finds *[ followed by optional space, then number, then ]* or ]> if end of sequence
-        #print(truncations.group(),truncations.start())
-        
-        difference = len(processed_sequence) - processed_length 
-        # as we are modifying the length of the processed_sequence inside the for loop, we need to adjust
-        # our indices obtained from the regexp by how much the sequence length has changed 
         
         missing = int(truncations.group().replace('*', '').replace('[', '').replace(']','').replace(' ', ''))
         # obtain the number of missing nucleotides by stripping away the useless characters
         
-        match_start, match_end = truncations.start() + difference, truncations.end() + difference
+        # copies the input up to the truncation
+        piece = processed_sequence[end:truncations.start()]
+        sequence_pieces.append(piece)
+        structure_pieces.append(processed_structure[end:truncations.start()])
+        length += len(piece)
+        sequence_gaps += piece.count('-')
         
-        sequence_gaps = processed_sequence[:match_start].count('-')
-        # number of gaps from start of the sequence to the truncation itself, important for alignment
-        
-        # obtain the positions of the truncations (adjusted by the difference in length
         # adds the missing n nucleotides to the sequence by getting them from the fasta sequence
-        
+        # (the truncation starts at position length - sequence_gaps of the fasta)
         if(missing > 0):
-            processed_sequence = processed_sequence[:match_start] + transcribe(fasta_sequence[(match_start - sequence_gaps):(match_start - sequence_gaps + missing)]) + processed_sequence[match_end:]
-            processed_structure = processed_structure[:match_start] + "~" * (missing) + processed_structure[match_end:]
-        else:
-            processed_sequence = processed_sequence[:match_start] + processed_sequence[match_end:]
-            processed_structure = processed_structure[:match_start] + processed_structure[match_end:]
-    # appends the start of the T-box fasta if it is not in the infernal sequence
-    return processed_sequence, processed_structure
-
-
-#Makes a list of (lists of length 4) containing pair information
-# in pairs, the first element of each entry is the character type and the second its index
-# the third is the index of the bracket it is matched with and the fourth the matching bracket
-def make_pairs(processed_structure, dot_structure):
-    struct_list = list(dot_structure)
-    length_list = len(struct_list) # length of the list struct_list
-    pairs = [None] * length_list # creates a list of length dot structure filled with None
-    
-    for index, element in enumerate(struct_list):
-        if(element == '('):
-            pairs[index] = ['(', index, None, ''] # creates entries for the left brackets in pairs
-        elif(element == ')'):
-            pairs[index] = [')', index, None, ''] # creates entries for the right brackets in pairs
-
-    for index, element in enumerate(pairs):
-        l_count = 0
-        r_count = 0
-        i = index + 1
-        if(element != None):
-            if(element[0] == '('):
-                l_count += 1
-                while(i < length_list):
-                    if(pairs[i] != None):
-                        if('(' == pairs[i][0]):
-                            l_count += 1
-                        elif(')' == pairs[i][0]):
-                            r_count += 1
-                            l_count -= 1
-                        if((r_count > 0) and (l_count == 0)):
-                            element[2] = pairs[i][1]
-                            element[3] = processed_structure[pairs[i][1]]
-                            pairs[i][2] = element[1]
-                            pairs[i][3] = processed_structure[element[1]]
-                            break
-                    i += 1
-    return pairs
-
+            piece = transcribe(fasta_sequence[(length - sequence_gaps):(length - sequence_gaps + missing)])
+            sequence_pieces.append(piece)
+            structure_pieces.append("~" * (missing))
+            length += len(piece)
+            sequence_gaps += piece.count('-')
+        end = truncations.end()
+    
+    if end == 0: # no truncations
+        return processed_sequence, processed_structure
+    sequence_pieces.append(processed_sequence[end:])
+    structure_pieces.append(processed_structure[end:])
+    return ''.join(sequence_pieces), ''.join(structure_pieces)
+
+# tags the gaps '-' in the sequence, and the structure at the gaps, with 'x' for deletion
+# the bases paired with a gap are changed to '.' in the structures
+# the sequence and structures are changed in lists (the checks use the input strings), and joined at the end
 def replace_gaps(processed_sequence, processed_structure, dot_structure, pairs):
     structure_changed = False # check whether structure was modified by program
     corrected_brackets = False # check whether brackets were adjusted
     
-    my_dot_structure = dot_structure # creates a copy of dot_structure that does not get changed
-    my_processed_sequence = processed_sequence # creates a copy of processed_sequence that does not get changed
+    if '-' not in processed_sequence: # nothing to do
+        return processed_sequence, processed_structure, dot_structure, structure_changed, corrected_brackets
+    
+    new_sequence = list(processed_sequence)
+    new_structure = list(processed_structure)
+    new_dot_structure = list(dot_structure)
     
-    for match in re.finditer('-', my_processed_sequence):
+    for match in GAP.finditer(processed_sequence):
         index = match.start() # gets the index of each gap '-' in the sequence
         
-        if(my_dot_structure[index] == '.'):
-            processed_structure = processed_structure[:index] + 'x' + processed_structure[(index + 1):]
-            dot_structure = dot_structure[:index] + 'x' + dot_structure[(index + 1):]
+        if(dot_structure[index] == '.'):
             # replaces the secondary structure with an x to tag it for deletion
-            processed_sequence = processed_sequence[:index] + 'x' + processed_sequence[(index + 1):]
-            # replaces the nucleotide in the sequence with an x, tagging it for deletion
+            # and the nucleotide in the sequence with an x, tagging it for deletion
+            new_structure[index] = new_dot_structure[index] = new_sequence[index] = 'x'
         
-        elif((my_dot_structure[index] == '(') or (my_dot_structure[index] == ')')):
-            processed_structure = processed_structure[:index] + 'x' + processed_structure[(index + 1):]
-            dot_structure = dot_structure[:index] + 'x' + dot_structure[(index + 1):]
+        elif((dot_structure[index] == '(') or (dot_structure[index] == ')')):
             # replaces the open/closed bracket in the secondary structures by x to tag it for deletion
-            processed_sequence = processed_sequence[:index] + 'x' + processed_sequence[(index + 1):]
-            # replaces the corresponding nucleotide in the sequence by x to tag it for deletion
+            # and the corresponding nucleotide in the sequence by x to tag it for deletion
+            new_structure[index] = new_dot_structure[index] = new_sequence[index] = 'x'
             
             structure_changed = True # we have changed the sequence
             
-            if(isinstance(pairs[index][2], int) == True): # if there is a matching bracket
-                paired = pairs[index][2] # the position of the paired closed/open bracket
-                if(my_processed_sequence[paired] != '-'):
+            if(pairs[index] >= 0): # if there is a matching bracket
+                paired = pairs[index] # the position of the paired closed/open bracket
+                if(processed_sequence[paired] != '-'):
                 # if the matching closed/open bracket is a real nucleotide in the sequence and not '-'
-                    processed_structure = processed_structure[:paired] + '.' + processed_structure[(paired + 1):]
-                    dot_structure = dot_structure[:paired] + '.' + dot_structure[(paired + 1):]
+                    new_structure[paired] = new_dot_structure[paired] = '.'
                     # replace the matching closed/open bracket by a '.'
                     corrected_brackets = True
-    return processed_sequence, processed_structure, dot_structure, structure_changed, corrected_brackets
+    return ''.join(new_sequence), ''.join(new_structure), ''.join(new_dot_structure), structure_changed, corrected_brackets
 
 def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure): 
     # Fills truncations, strips gaps, and aligns secondary structure
@@ -600,7 +338,7 @@ def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure):
     processed_sequence = processed_sequence.upper()
     dot_structure = replace_characters(processed_structure) # make a normal dot bracket structure
     
-    pairs = make_pairs(processed_structure, dot_structure) # creates a list with all paired 
+    pairs = pair_table(dot_structure) # the position paired with each bracket
     
     processed_sequence, processed_structure, dot_structure, structure_changed, corrected_brackets = replace_gaps(processed_sequence, processed_structure, dot_structure, pairs)
     if(structure_changed == True):
@@ -628,18 +366,8 @@ def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure):
         warnings += ' unequal_number_of_brackets'
 
     # make pairs again to process the secondary structure features of the Tbox
-    # Find stems
-    my_pairs = make_pairs(processed_structure, dot_structure)
-    index = 0
-    structures = []
-    while(index < len(dot_structure) - 1):
-        if(my_pairs[index] != None):
-            if(my_pairs[index][0] == '('):
-                # this is a secondary structure element (a stem)
-                #use 1-index
-                structures.append([ my_pairs[index][1] + 1, my_pairs[index][2] + 1])
-                index = my_pairs[index][2] # go to the paired bracket
-        index += 1
+    # Find stems (1-indexed)
+    structures = outer_pairs(pair_table(dot_structure))
     
     #Stem 3 is the second-to-last. Only calculate if there also a stem 1 (total stems >2)
     stem_three = None    
@@ -649,93 +377,126 @@ def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure):
     #Return: dot structure, list of secondary structural elements, messages and warnings
     return dot_structure, structures, (messages + warnings)
 
+#RNALfold, for finding local terminator structures
 def local_fold(sequence, length):
-    vienna_args = ['RNALfold', '-T', '37', '-L', str(length), '−−noClosingGU'] # https://academic.oup.com/nar/article/40/12/5215/2414626
-    # 100bp length will be good for our purpose
-    vienna_input = str(sequence)
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    
-    output = vienna_call.stdout.strip().split('\n')
-    errors = vienna_call.stderr
+    return vienna.local_fold(sequence, length)
 
-    return output, errors
+#RNALfold on a column of sequences
+def local_fold_column(sequences, length):
+    return vienna.local_fold_column(sequences, length)
 
-def term_local_fold(sequence, term_struct, term_energy, antiterm_struct):
-    polyU_regex = '[T]{3,}[ACGT]{,1}[T]{1,}[ACGT]{,1}[T]{1,}'
-    #print(sequence) #debug
-    
-    #search for last ')'
+LFOLD_WINDOWS = [100, 50, 40, 30, 20] # window sizes for the lfold algorithm, tried in order
+
+POLY_U_OFFSET = 10 # how many chars after antiterm end is start of poly U search
+
+#Finds the end of the antiterminator (the last ')' of its structure), or None if there is no antiterminator
+def antiterm_struct_end(antiterm_struct):
     if pd.isna(antiterm_struct):
-        return term_struct, term_energy, 'no_good_structure_found;no_aterm'
+        return None
     antiterm_end = antiterm_struct.rfind(')')
     if antiterm_end < 0: #if ')' not found
         antiterm_end = 0
         #Possibly return here
-    
-    found_poly_u = " NO_POLY_U"
-    offset = 10 # how many chars after antiterm end is start of poly U search
-    poly_u = re.search(polyU_regex, sequence[(antiterm_end + offset):])
-    # search for a poly U starting at the 10th nucleotide after the antiterminators end
-    
-    if(poly_u):
-        search_start = poly_u.start() + offset + antiterm_end
-        search_sequence = sequence[:search_start] # truncate sequence to poly U
-        #print(sequence[:search_start], 'poly U search')
-        found_poly_u = "" # flag that a poly U sequence was found
-    else:
-        search_sequence = sequence[:-5] # use entire sequence except last 5 bp
-    
-    #print(search_sequence)
-    
-    lfold_window = [100, 50, 40, 30, 20] # window sizes for the lfold algorithm
-    for window in lfold_window:  
-        output, errors = local_fold(search_sequence, window)    
-        correct = False 
-        loops = [] # all structures from RNALfold get dumped here
-    
-        if(output):
-            output_lines = output[::-1] # reverse order
-            index = 2 # skip first line (last line in original output)
-            maximum = len(output_lines)
-            while(index < maximum): 
-                # parse all of the lines containing structures 
-                split_line = output_lines[index].split()
-                lfold_structure, lfold_energy, lfold_start = split_line[0], split_line[-2], int(split_line[-1])
-                
-                if((lfold_start < (antiterm_end)) ):
-                # We take any structures that start before the end of the antiterminator
-                    brackets = lfold_structure.count('(') + lfold_structure.count(')')
-                    loops.append([lfold_structure, lfold_start, lfold_energy, brackets])        
-                index += 1
-        # reject any structures with multiple loops or that start before 5nt
-        good_loops = []
-        for element in loops:
-            #print(element)
-            if((re.search('[\)][\.]+[\(]', element[0]) == None) and (re.search('[\)][\(]', element[0]) == None)):
-                if(element[1] >= 5): # must start at least after the fifth nucleotide
-                    if(element[3] > 11): # at least 12 brackets in the structure
-                        #print(sequence[(len(element[0]) + element[1] - 1):(len(element[0]) + element[1]) + 7])
-                        if(re.search(polyU_regex, sequence[(len(element[0]) + element[1] - 1):(len(element[0]) + element[1]) + 7])):
-                        # search for a poly T near the end of the loop
-                            good_loops.append(element)
-                            correct = True
-                            #print('Good!')
-        if(correct):
+    return antiterm_end
+
+#Finds the region to search for local terminator structures, given the start of the first poly U
+#POLY_U_OFFSET nucleotides or more after the antiterminator end (-1 if there is none)
+#Returns the search sequence and the poly U flag
+def term_search_region(sequence, poly_u_start):
+    if poly_u_start >= 0:
+        return sequence[:poly_u_start], "" # truncate sequence to poly U, flag that a poly U sequence was found
+    return sequence[:-5], " NO_POLY_U" # use entire sequence except last 5 bp
+
+#Parses RNALfold output, yielding the local structures that start before the end of the antiterminator
+#in the order they were always checked (last line first), as [structure, start, energy, number of brackets]
+def lfold_loops(output, antiterm_end):
+    for line in output[-3::-1]: # skip the sequence and energy lines at the end of the output
+        # parse all of the lines containing structures 
+        split_line = line.split()
+        lfold_structure, lfold_energy, lfold_start = split_line[0], split_line[-2], int(split_line[-1])
+        if((lfold_start < (antiterm_end)) ):
+        # We take any structures that start before the end of the antiterminator
+            brackets = lfold_structure.count('(') + lfold_structure.count(')')
+            yield [lfold_structure, lfold_start, lfold_energy, brackets]
+
+#Checks the shape of a local structure: a single hairpin, starting after the fifth nucleotide, with at least 12 brackets
+#A good loop also needs a poly T near its end (in its poly_u_window)
+def good_hairpin(loop):
+    if(loop[1] < 5 or loop[3] <= 11): # must start at least after the fifth nucleotide, with at least 12 brackets
+        return False
+    # reject any structures with multiple loops
+    if ')(' in loop[0] or re.search('[\)][\.]+[\(]', loop[0]):
+        return False
+    return True
+
+#Part of the sequence to search for a poly T near the end of a local structure, as [start, end)
+def poly_u_window(loop):
+    loop_end = len(loop[0]) + loop[1]
+    return loop_end - 1, loop_end + 7
+
+#Re-calculate the terminator structures of a column of T-boxes with RNALfold
+#All unresolved rows are folded together for each window size, and a row is done at the first window size
+#that gives a good loop. The energies of the new structures are then calculated together with RNAeval
+#The poly U searches of all rows and loops use one poly U index of the sequences
+#Returns a list of (new terminator structure, energy, errors), one per T-box
+def term_local_fold_column(sequences, term_structs, term_energies, antiterm_structs):
+    sequences, term_structs, term_energies = list(sequences), list(term_structs), list(term_energies)
+    results = [None] * len(sequences)
+    index = poly_u_index(sequences)
+    antiterm_ends = {}
+    for i, antiterm_struct in enumerate(antiterm_structs):
+        antiterm_end = antiterm_struct_end(antiterm_struct)
+        if antiterm_end is None:
+            results[i] = term_structs[i], term_energies[i], 'no_good_structure_found;no_aterm'
+        else:
+            antiterm_ends[i] = antiterm_end
+    rows = list(antiterm_ends)
+    poly_u_starts = first_poly_u(index, rows, [antiterm_ends[i] + POLY_U_OFFSET for i in rows])[0]
+    regions = {}
+    for i, poly_u_start in zip(rows, poly_u_starts):
+        search_sequence, found_poly_u = term_search_region(sequences[i], poly_u_start)
+        regions[i] = search_sequence, antiterm_ends[i], found_poly_u
+    
+    best_loops = {}
+    pending = list(regions)
+    for window in LFOLD_WINDOWS:
+        if len(pending) == 0:
             break
+        outputs = local_fold_column([regions[i][0] for i in pending], window)
+        hairpins = [(i, loop) for i, (output, errors) in zip(pending, outputs) for loop in lfold_loops(output, regions[i][1]) if good_hairpin(loop)]
+        windows = np.array([poly_u_window(loop) for i, loop in hairpins], dtype = np.int64).reshape(-1, 2)
+        found = first_poly_u(index, [i for i, loop in hairpins], windows[:, 0], windows[:, 1])[0] >= 0
+        good_loops = {}
+        for (i, loop), has_poly_u in zip(hairpins, found):
+            if has_poly_u:
+                good_loops.setdefault(i, []).append(loop)
+        unresolved = []
+        for i in pending:
+            if i in good_loops:
+                best_loops[i] = max(good_loops[i], key=lambda x: x[3]) # get loop with largest number of brackets
+            else:
+                unresolved.append(i)
+        pending = unresolved
     
-    if(correct):
-        best_loop = max(good_loops, key=lambda x: x[3]) # get loop with largest number of brackets
-        lfold_start, lfold_structure = best_loop[1], best_loop[0]
-        term_foldseq = sequence[lfold_start - 1:(lfold_start + len(lfold_structure) - 1)]
-        new_term_structure = '.' * (lfold_start - 1) + lfold_structure + '.' * (len(sequence) - len(lfold_structure) - lfold_start + 1)
-        
-        energy, errors = get_energy(sequence, new_term_structure)
-        return new_term_structure, energy, errors+found_poly_u
-
     # fallback option takes original term structure etc in case nothing works
-    return term_struct, term_energy, 'no_good_structure_found'+found_poly_u
+    for i in pending:
+        results[i] = term_structs[i], term_energies[i], 'no_good_structure_found' + regions[i][2]
+    
+    new_structures = {}
+    for i, (lfold_structure, lfold_start, lfold_energy, brackets) in best_loops.items():
+        length = len(sequences[i])
+        new_structures[i] = '.' * (lfold_start - 1) + lfold_structure + '.' * (length - len(lfold_structure) - lfold_start + 1)
+    rows = list(new_structures)
+    energies = get_energy_column([sequences[i] for i in rows], [new_structures[i] for i in rows])
+    for i, (energy, errors) in zip(rows, energies):
+        results[i] = new_structures[i], energy, errors + regions[i][2]
+    return results
+
+#Re-calculate the terminator structure of one T-box
+def term_local_fold(sequence, term_struct, term_energy, antiterm_struct):
+    return term_local_fold_column([sequence], [term_struct], [term_energy], [antiterm_struct])[0]
 
-def run_thermo(tboxes):
+def run_thermo(tboxes, temperatures = (), ensemble = False):
     #Don't need: fasta_antiterm_start, fasta_antiterm_end
     #From RUN:
     tboxes[['whole_antiterm_structure', 'other_stems', 'whole_antiterm_warnings']] = tboxes.apply(lambda x: parse_structures(x['FASTA_sequence'], x['Tbox_start'], x['Tbox_end'], x['Sequence'], x['Structure']), axis = 'columns', result_type = 'expand')
@@ -744,7 +505,8 @@ def run_thermo(tboxes):
     tboxes['term_sequence'] = tboxes.apply(lambda x: get_sequence(x['FASTA_sequence'], x['discrim_end'], x['term_end']), axis = 'columns', result_type = 'expand')
     print('Terminators found.')
     # fold the terminator sequence obtained above to get the secondary structure
-    tboxes[['term_structure', 'terminator_energy', 'term_errors']] = tboxes.apply(lambda x: get_fold(x['term_sequence']), axis = 'columns', result_type = 'expand')
+    columns = ['term_structure', 'terminator_energy', 'term_errors']
+    tboxes[columns] = pd.DataFrame(get_fold_column(tboxes['term_sequence']), index = tboxes.index, columns = columns)
     print('Terminators folded.')
     # get the sequence from antiterm start to term end, will be used for comparing conformations with equal length
     tboxes['antiterm_term_sequence'] = tboxes.apply(lambda x: get_sequence(x['FASTA_sequence'],x['antiterm_start'] - 1, x['term_end']), axis = 'columns', result_type = 'expand')
@@ -757,90 +519,85 @@ def run_thermo(tboxes):
     #tboxes[['infernal_antiterminator_energy', 'infernal_antiterminator_errors']] = tboxes.apply(lambda x: get_energy(x['antiterm_term_sequence'], x['infernal_antiterminator_structure']), axis = 'columns', result_type = 'expand')
     print('Antiterminator energy done.')
     # refold the antiterminator using RNAfold with hard constraints
-    tboxes[['vienna_antiterminator_structure', 'vienna_antiterminator_energy', 'vienna_antiterminator_errors']] = tboxes.apply(lambda x: make_antiterm_constraints(x['antiterm_term_sequence'], x['infernal_antiterminator_structure']), axis = 'columns', result_type = 'expand')
+    constraints = [make_antiterm_constraints(sequence, structure) for sequence, structure in zip(tboxes['antiterm_term_sequence'], tboxes['infernal_antiterminator_structure'])]
+    columns = ['vienna_antiterminator_structure', 'vienna_antiterminator_energy', 'vienna_antiterminator_errors']
+    tboxes[columns] = pd.DataFrame(refold_antiterms(tboxes['antiterm_term_sequence'], constraints), index = tboxes.index, columns = columns)
     print('Antiterminator re-folding done.')
     # get the terminator structure and energy, structure is term structure with dots in front so that structure 
     # spans from antiterm_start to term_end
     tboxes['terminator_structure'] = tboxes.apply(lambda x: ('.' * 8 + x['term_structure']), axis = 'columns', result_type = 'expand')
     print('Terminator structure generated.')
-    tboxes[['terminator_energy', 'terminator_errors']] = tboxes.apply(lambda x: get_energy(x['antiterm_term_sequence'], x['terminator_structure']), axis = 'columns', result_type = 'expand')
+    columns = ['terminator_energy', 'terminator_errors']
+    tboxes[columns] = pd.DataFrame(get_energy_column(tboxes['antiterm_term_sequence'], tboxes['terminator_structure']), index = tboxes.index, columns = columns)
     print('Terminator energy calculated.')
     
     #Re-calculate the terminator structure
-    tboxes[['new_term_structure', 'new_term_energy', 'new_term_errors']] = tboxes.apply(lambda x: term_local_fold(x.antiterm_term_sequence, x.terminator_structure, x.terminator_energy, x.vienna_antiterminator_structure), axis = 'columns', result_type = 'expand')
+    columns = ['new_term_structure', 'new_term_energy', 'new_term_errors']
+    tboxes[columns] = pd.DataFrame(term_local_fold_column(tboxes['antiterm_term_sequence'], tboxes['terminator_structure'], tboxes['terminator_energy'], tboxes['vienna_antiterminator_structure']), index = tboxes.index, columns = columns)
     print('Terminator refined')
     
     # make the tbox terminator structure. Use the refined structure.
     tboxes[['whole_term_structure', 'term_start']] = tboxes.apply(lambda x: get_whole_structs(x['antiterm_start'], x['whole_antiterm_structure'], x['new_term_structure']), axis = 'columns', result_type = 'expand')
     #make the Vienna antiterm structure for the whole T-box
     tboxes['folded_antiterm_structure'] = tboxes.apply(lambda x: get_whole_structs(x['antiterm_start'], x['whole_antiterm_structure'], x['vienna_antiterminator_structure'])[0], axis = 'columns', result_type = 'expand')
+    if len(temperatures) > 0:
+        tboxes = temperature_sweep(tboxes, [constraint for constraint, pre_UGG in constraints], temperatures, 'new_term_structure')
+        print('Temperature sweep done.')
+    if ensemble:
+        tboxes = add_ensemble(tboxes, 'new_term_structure', 'new_term_energy')
+        print('Ensemble probabilities done.')
     print('Thermodynamic calculations complete.')
     return tboxes
 
-#Generate trimmed structures and sequences
+#Slices a FASTA sequence and its T-box structures from tbox_start to term_end (1-indexed)
+#Structures shorter than the trimmed sequence are first padded with '.' to its length
+def trim_tbox(seq, a_struct, t_struct, tbox_start, term_end):
+    seq = seq[tbox_start-1:term_end]
+    a_struct = a_struct.ljust(len(seq), '.')
+    t_struct = t_struct.ljust(len(seq), '.')
+    return seq, a_struct[tbox_start-1:term_end], t_struct[tbox_start-1:term_end]
+
+#Generate trimmed structures and sequences: from the T-box start to the first poly U after the antiterminator
+#(or to term_end, if it comes first). The bounds of all rows are calculated together
+#Rows without structures (fallback) only get the sequence trimmed, from the T-box start
 def trim(seq_df):
     seq_df['Trimmed_sequence']=""
     seq_df['Trimmed_antiterm_struct']=""
     seq_df['Trimmed_term_struct']=""
-
-    counter = 0
-
-    for i in range(0,len(seq_df)):
-        print('Trimming ' + seq_df['Name'][i])
-        seq = seq_df['FASTA_sequence'][i]
-        t_struct = seq_df['whole_term_structure'][i]
-        a_struct = seq_df['folded_antiterm_structure'][i]
-    
-        if pd.isna(seq):
-            continue
-        if pd.isna(t_struct) or pd.isna(a_struct) or pd.isna(seq_df['antiterm_end'][i]):
-            #Fallback: only trim sequence
-            try:
-                tbox_start = int(seq_df['Tbox_start'][i])
-                #Slice fasta sequence to get the tbox sequence
-                seq = seq[tbox_start-1:]
-                seq_df.at[seq_df.index[i], 'Trimmed_sequence'] = seq
-                counter += 1
-            except:
-                pass
-            continue
-        
-        tbox_start = int(seq_df['Tbox_start'][i])
-        term_end = min(term_end_regex(seq,int(seq_df['antiterm_end'][i]) + 10),int(seq_df['term_end'][i]))
-        seq_df.at[seq_df.index[i], 'term_end'] = term_end #update term_end
-    
-        if (tbox_start < -1) or term_end > len(seq): #note these are 1-indexed
-            print('Error')
-            continue
-    
-        #Slice fasta sequence to get the tbox sequence
-        seq = seq[tbox_start-1:term_end]
-    
-        if len(seq) != len(a_struct):
-            a_struct += '.'*(len(seq)-len(a_struct))
-        
-        if len(seq) != len(t_struct):
-            t_struct += '.'*(len(seq)-len(t_struct))
-    
-        #Also slice the structures
-        t_struct = t_struct[tbox_start-1:term_end]
-        a_struct = a_struct[tbox_start-1:term_end]
     
-        seq_df.at[seq_df.index[i], 'Trimmed_sequence'] = seq
-        seq_df.at[seq_df.index[i], 'Trimmed_antiterm_struct'] = a_struct
-        seq_df.at[seq_df.index[i], 'Trimmed_term_struct'] = t_struct
-        counter += 1
-
-    print("Trimmed sequences: " + str(counter))
+    has_sequence = seq_df['FASTA_sequence'].notna()
+    has_structures = seq_df['whole_term_structure'].notna() & seq_df['folded_antiterm_structure'].notna() & seq_df['antiterm_end'].notna()
+    
+    #Fallback: only trim sequence
+    fallback = has_sequence & ~has_structures & seq_df['Tbox_start'].notna()
+    tbox_starts = seq_df.loc[fallback, 'Tbox_start'].astype(int)
+    seq_df.loc[fallback, 'Trimmed_sequence'] = [seq[tbox_start-1:] for seq, tbox_start in zip(seq_df.loc[fallback, 'FASTA_sequence'], tbox_starts)]
+    
+    trimmed = has_sequence & has_structures
+    sequences = seq_df.loc[trimmed, 'FASTA_sequence'].tolist()
+    tbox_starts = seq_df.loc[trimmed, 'Tbox_start'].astype(int).to_numpy()
+    ends = poly_u_ends(poly_u_index(sequences), np.arange(len(sequences)), seq_df.loc[trimmed, 'antiterm_end'].astype(int).to_numpy() + 10)
+    term_ends = np.minimum(ends, seq_df.loc[trimmed, 'term_end'].astype(int).to_numpy())
+    seq_df.loc[trimmed, 'term_end'] = term_ends.astype(seq_df['term_end'].dtype) #update term_end (keeping the column type)
+    
+    lengths = np.array([len(seq) for seq in sequences], dtype = int)
+    errors = (tbox_starts < -1) | (term_ends > lengths) #note these are 1-indexed
+    if errors.any():
+        print('Error: %d T-boxes are outside of their sequence' % errors.sum())
+    done = trimmed.copy()
+    done[trimmed] = ~errors
+    rows = (~errors).nonzero()[0]
+    a_structs = seq_df.loc[done, 'folded_antiterm_structure'].tolist()
+    t_structs = seq_df.loc[done, 'whole_term_structure'].tolist()
+    columns = ['Trimmed_sequence', 'Trimmed_antiterm_struct', 'Trimmed_term_struct']
+    seq_df.loc[done, columns] = pd.DataFrame([trim_tbox(sequences[row], a_struct, t_struct, tbox_starts[row], term_ends[row]) for row, a_struct, t_struct in zip(rows, a_structs, t_structs)],
+                                             index = seq_df.index[done], columns = columns)
+    
+    print("Trimmed sequences: " + str(fallback.sum() + done.sum()))
     return seq_df
 
-#The main function to predict T-boxes
-#For TRANSCRIPTIONAL T-boxes only (RF00230)
-def tbox_predict(INFERNAL_file, predictions_file, fasta_file = None, score_cutoff = 15):
-    score_cutoff = int(score_cutoff) #makes it an int, if it was passed as a string
-
-    #Read the input file into a dataframe
-    tbox_all_DF = read_INFERNAL(INFERNAL_file)
+#Predict the features of each T-box in a dataframe of INFERNAL hits
+def predict_features(tbox_all_DF, fasta_file, score_cutoff):
     #Initialize the dataframe columns for prediction output
     tbox_all_DF['s1_start'] = -1
     tbox_all_DF['s1_loop_start'] = -1
@@ -861,68 +618,115 @@ def tbox_predict(INFERNAL_file, predictions_file, fasta_file = None, score_cutof
     tbox_all_DF['type'] = "Transcriptional"
     tbox_all_DF['source'] = fasta_file.split('/')[-1]
         
-    #Predict the t-boxes
-    for i, name in enumerate(tbox_all_DF['Name']):
-        print(name) #Write to log
-        
-        #Predict the features. Use offset of 1 to convert 0-indexed Python format to standard sequence format
-        tbox = tbox_features(tbox_all_DF['Sequence'][i], tbox_all_DF['Structure'][i], offset = 1)
-        
-        #Assign output to dataframe
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_start'] = tbox[0]
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_loop_start'] = tbox[1]
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_loop_end'] = tbox[2]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'codon'] = tbox[3]
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_end'] = tbox[4]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'antiterm_start'] = tbox[5]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'discriminator'] = tbox[6]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'antiterm_end'] = tbox[7]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'codon_region'] = tbox[8]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'warnings'] += tbox[9]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'discrim_start'] = tbox[10]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'discrim_end'] += tbox[11]
-        
-        #Check the score
-        if tbox_all_DF.at[tbox_all_DF.index[i], 'Score'] < score_cutoff:
-            tbox_all_DF.at[tbox_all_DF.index[i], 'warnings'] += "LOW_SCORE;"
+    #Predict the features for all T-boxes. Use offset of 1 to convert 0-indexed Python format to standard sequence format
+    features = features_batch(PROFILE, tbox_all_DF['Sequence'], tbox_all_DF['Structure'], offset = 1)
+    
+    #Assign output to dataframe, one column at a time
+    for column in FEATURE_COLUMNS:
+        values = pd.Series(features[column], index = tbox_all_DF.index, dtype = tbox_all_DF[column].dtype)
+        if column in ('warnings', 'discrim_end'): #These are added to the initial values
+            tbox_all_DF[column] = tbox_all_DF[column] + values
+        else:
+            tbox_all_DF[column] = values
+    
+    #Check the score
+    low_score = tbox_all_DF['Score'] < score_cutoff
+    tbox_all_DF.loc[low_score, 'warnings'] = tbox_all_DF.loc[low_score, 'warnings'] + "LOW_SCORE;"
+    return tbox_all_DF
+
+#Predict the features and thermodynamics of T-boxes merged with their FASTA records (run once per T-box, see predict_unique)
+def predict_tboxes(tboxes, fasta_file, score_cutoff, jobs = 1, temperatures = (), ensemble = False):
+    #Predict the features of the rows with hits
+    tboxes = predict_hit_features(lambda hits: predict_features(hits, fasta_file, score_cutoff), tboxes)
+    
+    #Convert positions from INFERNAL-relative to FASTA-relative
+    tboxes = tbox_derive(tboxes)
+    
+    print('Feature derivation complete. Running thermodynamics.')
+    return run_thermo_parallel(run_thermo, tboxes, jobs, temperatures, ensemble)
+
+#The main function to predict T-boxes
+#For TRANSCRIPTIONAL T-boxes only (RF00230)
+#If chunksize is given, the INFERNAL hits are streamed and processed chunksize hits at a time
+#jobs is the number of processes used to parse the INFERNAL file and to run the thermodynamic calculations
+#If alignment_file (cmsearch -A output) is given, INFERNAL_file is the cmsearch --tblout table
+def tbox_predict(INFERNAL_file, predictions_file, fasta_file = None, score_cutoff = 15, chunksize = None, jobs = 1,
+                 alignment_file = None, temperatures = (), ensemble = False):
+    score_cutoff = int(score_cutoff) #makes it an int, if it was passed as a string
+    if chunksize is not None:
+        return tbox_predict_chunks(INFERNAL_file, predictions_file, fasta_file, score_cutoff, int(chunksize), jobs,
+                                   alignment_file, temperatures, ensemble)
+
+    #Read the input file into a dataframe
+    tbox_all_DF = read_INFERNAL(INFERNAL_file, jobs, alignment_file)
         
     #Perform the fasta processing (if enabled)
     if fasta_file is not None:
-        fastas = {'Name':[], 'FASTA_sequence':[]}
-        #Read the fasta file
-        with open(fasta_file) as f:
-            for fasta in SeqIO.parse(f,'fasta'):
-                name, sequence = fasta.id, str(fasta.seq)
-                fastas['Name'].append(name)
-                fastas['FASTA_sequence'].append(sequence)
+        #Read the fasta records with hits. Of the records without hits, only the first one is kept in the output
+        #(as a single row with no T-box, after removing duplicates), so the others are not read at all
+        fasta_DF = select_fasta(fasta_file, tbox_all_DF['Name'], missing = 'first')
         #Merge with T-box dataframe
-        fasta_DF = pd.DataFrame(fastas)
         #fasta_DF.to_csv('test_fasta.csv', index = True, header = True)
         merged = pd.merge(fasta_DF, tbox_all_DF, on = 'Name', how = 'left') #Left merge to preserve all FASTA sequences
         
-        #Convert positions from INFERNAL-relative to FASTA-relative
-        merged = tbox_derive(merged)
-        #merged.to_csv('test_merge.csv', index = True, header = True)
-        print('Feature derivation complete. Running thermodynamics.')
-        thermo = run_thermo(merged)
+        #Only the first of each T-box sequence is kept in the output, so the duplicates are dropped before predicting
+        #the features and thermodynamics
+        print('Removing duplicate T-boxes')
+        thermo = predict_unique(lambda tboxes: predict_tboxes(tboxes, fasta_file, score_cutoff, jobs, temperatures, ensemble),
+                                merged, key = ['Sequence'], fan_out = False)
         print('Trimming structures and sequences')
         thermo.to_csv(predictions_file, index = False, header = True)
         thermo = trim(thermo)
         
-        print('Removing duplicate T-boxes')
-        thermo.drop_duplicates(subset = 'Sequence', keep = 'first', inplace = True) #Drop duplicate T-boxes
-        
         #Write output
         thermo.to_csv(predictions_file, index = False, header = True)
         return 0
+    
+    #Predict the features
+    tbox_all_DF = predict_features(tbox_all_DF, fasta_file, score_cutoff)
         
     #Write output
     tbox_all_DF.to_csv(predictions_file, index = False, header = True)
     return 0
 
+#Streaming version of tbox_predict, for INFERNAL outputs too large to hold in memory
+#Each chunk of hits goes through the whole prediction and is appended to the output (see predict_chunks)
+#Only FASTA sequences with hits are written, and duplicates are removed across chunks
+def tbox_predict_chunks(INFERNAL_file, predictions_file, fasta_file, score_cutoff, chunksize, jobs = 1,
+                        alignment_file = None, temperatures = (), ensemble = False):
+    fasta_index = None
+    if fasta_file is not None:
+        fasta_index = index_fasta(fasta_file)
+    seen_sequences = set() #T-box sequences already written
+    
+    #Prediction of one chunk of hits
+    def predict_chunk(tbox_all_DF):
+        if fasta_index is None:
+            return predict_features(tbox_all_DF, fasta_file, score_cutoff)
+        
+        #Only the fasta records with hits in this chunk are read
+        fasta_DF = select_fasta(fasta_file, tbox_all_DF['Name'], index = fasta_index)
+        merged = pd.merge(fasta_DF, tbox_all_DF, on = 'Name', how = 'inner')
+        
+        #Drop duplicate T-boxes, including those from earlier chunks, before the predictions
+        merged = merged[~merged['Sequence'].isin(seen_sequences)]
+        seen_sequences.update(merged['Sequence'])
+        if len(merged) == 0:
+            return None
+        
+        thermo = predict_unique(lambda tboxes: predict_tboxes(tboxes, fasta_file, score_cutoff, jobs, temperatures, ensemble),
+                                merged, key = ['Sequence'], fan_out = False)
+        return trim(thermo)
+    
+    return predict_chunks(predict_chunk, INFERNAL_file, predictions_file, chunksize, jobs, alignment_file)
+
 #Get arguments from command line and run the prediction
-if len(sys.argv) > 5 or len(sys.argv) < 3:
-    print("Error: incorrect number of arguments: %d" % len(sys.argv))
-    print(sys.argv)
-else:
-    tbox_predict(*sys.argv[1:len(sys.argv)])
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Predict transcriptional T-box features from INFERNAL output')
+    parser.add_argument('INFERNAL_file', help = 'cmsearch output file (or --tblout table, with --alignment)')
+    parser.add_argument('predictions_file', help = 'output .csv file')
+    parser.add_argument('fasta_file', nargs = '?', default = None, help = 'fasta file searched by cmsearch')
+    parser.add_argument('score_cutoff', nargs = '?', default = 15, help = 'INFERNAL score cutoff (default 15)')
+    add_common_arguments(parser)
+    args = parser.parse_args()
+    tbox_predict(args.INFERNAL_file, args.predictions_file, args.fasta_file, args.score_cutoff, **apply_common_arguments(parser, args))
@@ -3,17 +3,21 @@
 #Gets feature data from various databases to annotate T-box predictions
 
 import pandas as pd
+import numpy as np
 import sys
+import functools
 import hashlib
 import base64
 
 from Bio import Entrez
 from Bio import SeqIO
 from Bio.Seq import Seq
-from Bio.Alphabet import generic_rna
+from Bio.Data.IUPACData import ambiguous_rna_complement
 
 import urllib.request
 
+from rna_structure import pair_table
+
 #IMPORTANT: you need to put your email and NCBI API key here in order for this to work
 #For more information see: https://www.ncbi.nlm.nih.gov/account/
 #You can also run without a key but this will be slower.
@@ -136,10 +140,11 @@ def add_thermocalc(predseq):
     
     return predseq
 
+#Reverse complement of an RNA codon. It is taken as DNA (U as T), as Seq has no RNA alphabet in newer Biopython versions
 def rc(codon):
-    scodon=Seq(codon,generic_rna)
+    scodon=Seq(codon.upper().replace('U','T'))
     rc_codon=str(scodon.reverse_complement())
-    rc_codon=rc_codon.upper()
+    rc_codon=rc_codon.replace('T','U')
     return rc_codon
 
 def wobblepair(base1, base2):
@@ -155,27 +160,59 @@ def wobblepair(base1, base2):
         return True
     return False
 
-def clean(dot_structure, seq):
-    if pd.isna(dot_structure) or pd.isna(seq):
-        return None
-    str_clean = ['.']*len(dot_structure)
-    
-    str_len = len(dot_structure)
+#Code of the characters that are not in the table of allowed pairs (not ASCII), which never pair
+NO_PAIR = 255
+
+#Lookup table of the allowed base pairs of the ASCII characters: allowed_pairs()[ord(base1), ord(base2)] is
+#wobblepair(base1, base2). Other codes are never allowed. It is filled from the RNA complements directly,
+#which are the same as rc, instead of making a Seq for each pair
+@functools.lru_cache(maxsize = None)
+def allowed_pairs():
+    allowed = np.zeros((256, 256), dtype = bool)
+    bases = [chr(i).upper().replace('T','U') for i in range(128)]
+    for i, base1 in enumerate(bases):
+        for j, base2 in enumerate(bases):
+            allowed[i, j] = (base1 == 'N' or base2 == 'N' or base1 == ambiguous_rna_complement.get(base2, base2)
+                             or (base1, base2) in (('G', 'U'), ('U', 'G')))
+    return allowed
+
+#Codes of the characters of a sequence in the table of allowed pairs, with NO_PAIR for the characters outside of it
+def sequence_codes(seq):
+    codes = np.frombuffer(seq.encode('utf-32-le', 'surrogatepass'), dtype = np.uint32)
+    return np.where(codes < 128, codes, NO_PAIR).astype(np.uint8)
+
+#Keeps only the base pairs of the structures that are allowed (see wobblepair)
+#The pairs of all of the structures are checked together with the lookup table
+def clean_column(dot_structures, seqs):
+    dot_structures, seqs = list(dot_structures), list(seqs)
+    rows = [i for i in range(len(dot_structures)) if not (pd.isna(dot_structures[i]) or pd.isna(seqs[i]))]
+    lefts, rights, bases1, bases2 = [], [], [], []
+    for i in rows:
+        table = np.frombuffer(pair_table(dot_structures[i]), dtype = np.intc)
+        left = np.flatnonzero(table > np.arange(len(table))) #We found the pairs!
+        right = table[left]
+        codes = sequence_codes(seqs[i])
+        lefts.append(left)
+        rights.append(right)
+        bases1.append(codes[left])
+        bases2.append(codes[right])
     
-    for i in range(str_len - 1):
-        if dot_structure[i] == '(':
-            l_count = 1 #counting the original '(' that we're looking for
-            for j in range(i+1, str_len):
-                if dot_structure[j] == '(':
-                    l_count += 1
-                if dot_structure[j] == ')':
-                    l_count -= 1
-                if l_count == 0: #We found the pair!
-                    if wobblepair(seq[i],seq[j]): #But is it good?
-                        str_clean[i] = '('
-                        str_clean[j] = ')'
-                    break
-    return "".join(str_clean) #Convert to string from list
+    results = [None] * len(dot_structures)
+    if len(rows) == 0:
+        return results
+    good = allowed_pairs()[np.concatenate(bases1), np.concatenate(bases2)] #But are they good?
+    start = 0
+    for i, left, right in zip(rows, lefts, rights):
+        good_row = good[start:(start + len(left))]
+        start += len(left)
+        str_clean = np.full(len(dot_structures[i]), ord('.'), dtype = np.uint8)
+        str_clean[left[good_row]] = ord('(')
+        str_clean[right[good_row]] = ord(')')
+        results[i] = str_clean.tobytes().decode('ascii')
+    return results
+
+def clean(dot_structure, seq):
+    return clean_column([dot_structure], [seq])[0]
 
 
 def clean_sequences(predseq):
@@ -184,8 +221,8 @@ def clean_sequences(predseq):
     predseq["FASTA_sequence"]=predseq["FASTA_sequence"].str.upper()
     predseq["Name"]=predseq["Name"].str.replace('c','',regex=False)
     
-    predseq[["Trimmed_antiterm_struct"]] = predseq.apply(lambda x: clean(x['Trimmed_antiterm_struct'], x['Trimmed_sequence']), axis = 'columns', result_type = 'expand')
-    predseq[["Trimmed_term_struct"]] = predseq.apply(lambda x: clean(x['Trimmed_term_struct'], x['Trimmed_sequence']), axis = 'columns', result_type = 'expand')
+    predseq["Trimmed_antiterm_struct"] = clean_column(predseq['Trimmed_antiterm_struct'], predseq['Trimmed_sequence'])
+    predseq["Trimmed_term_struct"] = clean_column(predseq['Trimmed_term_struct'], predseq['Trimmed_sequence'])
     
     return predseq
 
@@ -0,0 +1,164 @@
+#tbox_predictor.py
+#Prediction steps shared by the transcriptional and translational T-box predictors
+#Each predictor passes its own run_thermo (and column names) where the two differ
+
+import os
+import functools
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from tbox_io import read_INFERNAL_chunks, HIT_COLUMNS
+import vienna
+
+#Key of a T-box for predict_unique: rows with the same INFERNAL hit (sequence, structure, position and score) in the same
+#FASTA sequence, such as identical T-boxes in several strains, have the same features and thermodynamics
+#Rows without a hit are keyed by their FASTA sequence
+TBOX_KEY = ['FASTA_sequence', 'Sequence', 'Structure', 'Tbox_start', 'Tbox_end', 'Score']
+
+#Runs predict (the predictor's features and thermodynamics, which returns one row for each row, in order) once for each
+#distinct key of the T-boxes, on the first row with the key
+#With fan_out, the predictions are copied back to every row with the same key, and the columns of each row that are not
+#in the key (such as Name) are kept. Otherwise only the first row of each key is returned, as with drop_duplicates
+def predict_unique(predict, tboxes, key = TBOX_KEY, fan_out = True):
+    groups = tboxes.groupby(key, sort = False, dropna = False).ngroup().to_numpy()
+    first_rows = np.sort(np.unique(groups, return_index = True)[1]) #first row of each key, in row order
+    unique = tboxes.iloc[first_rows].reset_index(drop = True)
+    if not fan_out:
+        return predict(unique)
+    if len(first_rows) < len(tboxes):
+        print('Predicting %d distinct T-boxes (%d rows)' % (len(first_rows), len(tboxes)))
+    predictions = predict(unique)
+    positions = np.zeros(len(first_rows), dtype = np.int64)
+    positions[groups[first_rows]] = np.arange(len(first_rows)) #row of each key in the predictions
+    fanned = predictions.iloc[positions[groups]].reset_index(drop = True)
+    for column in tboxes.columns:
+        if column not in key and column in fanned.columns:
+            fanned[column] = tboxes[column].to_numpy()
+    return fanned
+
+#Runs predict_features (the predictor's feature predictions) on the rows of the T-boxes that have an INFERNAL hit
+#The other rows (FASTA records without hits) have no features, as when the hits are merged with the FASTA records
+#after predicting their features
+def predict_hit_features(predict_features, tboxes):
+    hits = tboxes['Sequence'].notna()
+    if hits.all():
+        return predict_features(tboxes)
+    return pd.concat([predict_features(tboxes[hits].copy()), tboxes[~hits]]).sort_index()
+
+#Runs run_thermo (the predictor's thermodynamic calculations) with a pool of jobs processes, on row chunks of the T-boxes
+#temperatures are the extra temperatures of the sweep mode (see temperature_sweep), and ensemble adds the ensemble mode
+#probabilities (see add_ensemble)
+#With the ViennaRNA bindings, the chunks are at most vienna.FOLD_CONTEXTS rows, so that the fold compound of each
+#sequence is reused by all of its steps (see vienna.sequence_compound)
+#The chunks are put back together in their original order
+def run_thermo_parallel(run_thermo, tboxes, jobs, temperatures = (), ensemble = False, chunks_per_job = 4):
+    thermo_function = functools.partial(run_thermo, temperatures = temperatures, ensemble = ensemble)
+    n_chunks = 1 if jobs <= 1 else jobs * chunks_per_job #Several chunks per process, so slow chunks are balanced out
+    if vienna.BACKEND == 'bindings':
+        n_chunks = max(n_chunks, -(-len(tboxes) // vienna.FOLD_CONTEXTS))
+    n_chunks = min(len(tboxes), n_chunks)
+    if n_chunks <= 1:
+        return thermo_function(tboxes)
+    bounds = [len(tboxes) * i // n_chunks for i in range(n_chunks + 1)]
+    chunks = [tboxes.iloc[start:end].copy() for start, end in zip(bounds[:-1], bounds[1:])]
+    if jobs <= 1:
+        thermo = [thermo_function(chunk) for chunk in chunks]
+    else:
+        with Pool(jobs) as pool:
+            thermo = pool.map(thermo_function, chunks)
+    return pd.concat(thermo)
+
+#Sweep mode: energies of the antiterminator and terminator at other temperatures, without rerunning the pipeline
+#The structures found at 37 degrees are reused: the antiterminator is refolded with the same constraints (one per row,
+#None if it was not refolded), and the energy of the terminator structure in term_structure_column is evaluated
+#Adds the columns antiterm_energy_T{t}, term_energy_T{t} and deltadelta_g_T{t} (terminator - antiterminator) for each temperature
+def temperature_sweep(tboxes, constraints, temperatures, term_structure_column):
+    sequences = list(tboxes['antiterm_term_sequence'])
+    structures = list(tboxes[term_structure_column])
+    refold = [i for i, constraint in enumerate(constraints) if constraint is not None]
+    evaluate = [i for i in range(len(sequences)) if not (pd.isna(sequences[i]) or pd.isna(structures[i]))]
+    for temperature in temperatures:
+        print('Temperature sweep: %s degrees' % temperature)
+        antiterm_energies = [None] * len(sequences)
+        folds = vienna.fold_constraints_column([sequences[i] for i in refold], [constraints[i] for i in refold], temperature)
+        for i, (structure_out, energy, errors) in zip(refold, folds):
+            antiterm_energies[i] = energy
+        term_energies = [None] * len(sequences)
+        energies = vienna.energy_column([sequences[i] for i in evaluate], [structures[i] for i in evaluate], temperature)
+        for i, (energy, errors) in zip(evaluate, energies):
+            term_energies[i] = energy
+        
+        antiterm_energy = pd.Series([vienna.energy_value(energy) for energy in antiterm_energies], index = tboxes.index, dtype = float)
+        term_energy = pd.Series([vienna.energy_value(energy) for energy in term_energies], index = tboxes.index, dtype = float)
+        tboxes['antiterm_energy_T%s' % temperature] = antiterm_energy
+        tboxes['term_energy_T%s' % temperature] = term_energy
+        tboxes['deltadelta_g_T%s' % temperature] = term_energy - antiterm_energy
+    return tboxes
+
+#Ensemble mode: mean base pair probabilities of the antiterminator and terminator structures in the Boltzmann ensemble
+#of the antiterminator to terminator sequence (see vienna.ensemble_column)
+#The terminator structure and its energy are in term_structure_column and term_energy_column
+#switch_probability is the antiterminator probability relative to both: antiterm / (antiterm + term). As these are mean
+#pair probabilities and not structure probabilities, it is not a ratio of Boltzmann weights
+def add_ensemble(tboxes, term_structure_column, term_energy_column):
+    probabilities = vienna.ensemble_column(tboxes['antiterm_term_sequence'], tboxes['vienna_antiterminator_structure'], tboxes[term_structure_column],
+                                           tboxes['vienna_antiterminator_energy'], tboxes[term_energy_column])
+    tboxes[['antiterm_probability', 'term_probability']] = pd.DataFrame(probabilities, index = tboxes.index, columns = ['antiterm_probability', 'term_probability'], dtype = float)
+    tboxes['switch_probability'] = tboxes['antiterm_probability'] / (tboxes['antiterm_probability'] + tboxes['term_probability'])
+    return tboxes
+
+#Streaming driver of the predictors' tbox_predict_chunks, for INFERNAL outputs too large to hold in memory
+#The hits are read chunksize at a time, and each chunk goes through predict_chunk (the whole prediction, which returns the
+#rows to write, or None if there are none) and is appended to the output
+def predict_chunks(predict_chunk, INFERNAL_file, predictions_file, chunksize, jobs = 1, alignment_file = None):
+    header = True
+    for chunk_number, tbox_all_DF in enumerate(read_INFERNAL_chunks(INFERNAL_file, chunksize, jobs, alignment_file)):
+        print('Processing chunk %d (%d hits)' % (chunk_number, len(tbox_all_DF)))
+        tbox_all_DF = predict_chunk(tbox_all_DF)
+        if tbox_all_DF is None:
+            continue
+        
+        #Write output
+        tbox_all_DF.to_csv(predictions_file, mode = 'w' if header else 'a', index = False, header = header)
+        header = False
+    
+    if header: #No hits were written
+        pd.DataFrame(columns = HIT_COLUMNS).to_csv(predictions_file, index = False, header = True)
+    return 0
+
+#Command line options shared by the predictors (after their INFERNAL_file, predictions_file, fasta_file and score_cutoff)
+def add_common_arguments(parser):
+    parser.add_argument('--chunksize', type = int, default = None,
+                        help = 'stream the INFERNAL hits and process this many at a time')
+    parser.add_argument('--jobs', type = int, default = 1,
+                        help = 'number of processes used to parse the INFERNAL file and run the thermodynamic calculations (default 1)')
+    parser.add_argument('--alignment', default = None,
+                        help = 'Stockholm alignment from cmsearch -A; INFERNAL_file is then the cmsearch --tblout table')
+    parser.add_argument('--temperatures', type = vienna.parse_temperatures, default = [],
+                        help = 'comma separated temperatures (for example 25,37,55) at which to also calculate the antiterminator '
+                               'and terminator energies, adding antiterm_energy_T{t}, term_energy_T{t} and deltadelta_g_T{t}')
+    parser.add_argument('--ensemble', action = 'store_true',
+                        help = 'also calculate the probabilities of the antiterminator and terminator in the Boltzmann ensemble, '
+                               'adding antiterm_probability, term_probability and switch_probability (needs the ViennaRNA Python bindings)')
+    parser.add_argument('--max-bp-span', type = int, default = None,
+                        help = 'maximum base pair span of the terminator and antiterminator folds (RNAfold --maxBPspan)')
+    parser.add_argument('--max-fold-length', type = int, default = None,
+                        help = "longest terminator sequence folded whole; longer ones are folded in a window at their 3' end, "
+                               'with a warning in term_errors. Longer antiterminator folds get a warning in vienna_antiterminator_errors')
+    parser.add_argument('--cache', default = None,
+                        help = 'SQLite file caching the ViennaRNA results across runs (or set TBOX_FOLD_CACHE)')
+
+#Checks the options of add_common_arguments, and passes the ViennaRNA ones on through the environment, where the
+#worker processes also see them
+#Returns the keyword arguments of the predictors' tbox_predict
+def apply_common_arguments(parser, args):
+    if args.ensemble and vienna.BACKEND != 'bindings':
+        parser.error('--ensemble needs the ViennaRNA Python bindings')
+    if args.cache is not None:
+        os.environ['TBOX_FOLD_CACHE'] = args.cache
+    if args.max_bp_span is not None:
+        os.environ['TBOX_MAX_BP_SPAN'] = str(args.max_bp_span)
+    if args.max_fold_length is not None:
+        os.environ['TBOX_MAX_FOLD_LENGTH'] = str(args.max_fold_length)
+    return dict(chunksize = args.chunksize, jobs = args.jobs, alignment_file = args.alignment, temperatures = args.temperatures,
+                ensemble = args.ensemble)
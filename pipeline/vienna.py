@@ -0,0 +1,507 @@
+#vienna.py
+#ViennaRNA folding shared by the transcriptional and translational T-box predictors
+#Uses the ViennaRNA Python bindings (import RNA) in the same process when they are installed,
+#otherwise runs the RNAfold, RNAeval and RNALfold programs
+#Set the environment variable TBOX_VIENNA to 'subprocess' or 'bindings' to choose the backend
+#Results are kept in the fold cache (see fold_cache.py) when it is enabled
+
+import os
+import re
+import subprocess
+import functools
+import fold_cache
+
+try:
+    import RNA
+except ImportError:
+    RNA = None
+
+#Folding temperature (degrees C), used unless a function is given another temperature
+TEMPERATURE = 37
+
+def vienna_temperature(temperature = None):
+    return TEMPERATURE if temperature is None else temperature
+
+#Chooses the folding backend
+def get_backend():
+    backend = os.environ.get('TBOX_VIENNA', '')
+    if backend == 'subprocess' or (backend == '' and RNA is None):
+        return 'subprocess'
+    if RNA is None:
+        raise ImportError("TBOX_VIENNA is set to '%s', but the ViennaRNA Python bindings (RNA) are not installed" % backend)
+    return 'bindings'
+
+BACKEND = get_backend()
+
+#Parses a comma separated list of temperatures, for example '25,37,55'
+def parse_temperatures(text):
+    temperatures = []
+    for value in text.split(','):
+        temperature = float(value)
+        temperatures.append(int(temperature) if temperature.is_integer() else temperature)
+    return temperatures
+
+#Limits for long inputs, set with the predictors' --max-bp-span and --max-fold-length options, or the environment
+#TBOX_MAX_BP_SPAN is the maximum base pair span of RNAfold (--maxBPspan), and TBOX_MAX_FOLD_LENGTH is the longest
+#sequence that is folded whole (see fold_column and fold_constraints_column). Neither is limited by default
+def env_limit(name):
+    limit = os.environ.get(name, '')
+    return int(limit) if limit != '' else None
+
+def max_bp_span():
+    return env_limit('TBOX_MAX_BP_SPAN')
+
+def max_fold_length():
+    return env_limit('TBOX_MAX_FOLD_LENGTH')
+
+#Energy as a number, or None if there is no energy
+def energy_value(energy):
+    try:
+        return float(energy)
+    except (TypeError, ValueError):
+        return None
+
+#Formats an energy the way the Vienna programs print it, after removing the brackets
+def format_energy(energy):
+    return '%.2f' % (energy + 0.0)
+
+#Model details, as set by the Vienna programs' command line options
+def model_details(window = None, temperature = None, span = None):
+    md = RNA.md()
+    md.temperature = vienna_temperature(temperature)
+    if window is not None: #RNALfold -L sets both the window size and the maximum base pair span
+        md.window_size = window
+        md.max_bp_span = window
+    if span is not None: #RNAfold --maxBPspan
+        md.max_bp_span = span
+    return md
+
+#Number of fold compounds kept (most recently used first), so that the constrained fold and the energy evaluations
+#of a sequence share one, and the energy parameters and the sequence are only set up once.
+#run_thermo works on chunks of at most this many rows with the bindings, so each sequence stays in between its steps
+#The folds have their own compound if the base pair span is limited, as RNAeval has no such limit
+#Every caller passes all three arguments, so that the cache keys of the same compound are the same
+FOLD_CONTEXTS = 256
+
+@functools.lru_cache(maxsize = FOLD_CONTEXTS)
+def sequence_compound(sequence, temperature, span):
+    return RNA.fold_compound(sequence, model_details(temperature = temperature, span = span))
+
+#The Vienna programs read RNA in upper case, converting T to U
+def vienna_sequence(sequence):
+    return str(sequence).upper().replace('T', 'U')
+
+#RNAfold on target sequence, without the cache
+#Returns the MFE structure, energy, and errors
+def fold_record(sequence):
+    if BACKEND == 'subprocess':
+        return fold_subprocess(sequence)
+    sequence = vienna_sequence(sequence)
+    if len(sequence) == 0: #No input, no output
+        return "", "", ""
+    structure, energy = RNA.fold_compound(sequence, model_details(span = max_bp_span())).mfe()
+    return structure, format_energy(energy), ""
+
+def fold_subprocess(sequence):
+    #Initialize outputs
+    structure = ""
+    energy = ""
+    errors = ""
+
+    vienna_args = fold_args() # arguments used to call RNAfold at 37 degrees
+    vienna_input = str(sequence) # the input format
+    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
+
+    output = vienna_call.stdout.split('\n')
+    if len(output) > 1: # if there is a result
+        output = output[-2]
+        output = output.split()
+        structure = output[0] # gets last line's structure (always will be first element when sliced)
+        energy = output[-1].replace(')', '').replace('(', '') # get energy (always will be last element in slice)
+    errors = vienna_call.stderr.replace('\n',' ')
+    return structure, energy, errors
+
+#RNAfold on target sequence, with hard constraints (RNAfold -C), without the cache
+#Returns the MFE structure, energy, and errors
+def fold_constraints_record(sequence, constraints, temperature = None):
+    if BACKEND == 'subprocess':
+        return fold_constraints_subprocess(sequence, constraints, temperature)
+    sequence = vienna_sequence(sequence)
+    constraints = str(constraints)
+    if len(sequence) == 0:
+        return "", "", ""
+    errors = ""
+    if len(constraints) > len(sequence): #RNAfold stops with an error
+        return "", "", "ERROR: structure constraint is too long"
+    if len(constraints) < len(sequence): #RNAfold pads the constraint with '.' (an empty constraint line is no constraint)
+        if len(constraints) > 0:
+            errors = "WARNING: structure constraint is shorter than sequence"
+        constraints += '.' * (len(sequence) - len(constraints))
+    fc = sequence_compound(sequence, vienna_temperature(temperature), max_bp_span())
+    fc.hc_add_from_db(constraints, RNA.CONSTRAINT_DB_DEFAULT)
+    structure, energy = fc.mfe()
+    fc.hc_init() #Remove the constraints, as the fold compound is shared
+    return structure, format_energy(energy), errors
+
+def fold_constraints_subprocess(sequence, structure, temperature = None):
+    #Initialize outputs
+    energy = ""
+    errors = ""
+    structure_out = ""
+
+    vienna_args = fold_constraints_args(temperature) # arguments used to call RNAfold at 37 degrees with constraints
+    vienna_input = str(sequence) + '\n' + str(structure) # the input format
+    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
+
+    output = vienna_call.stdout.split('\n')
+    if len(output) > 1: # if there is a result
+        output = output[-2]
+        output = output.split()
+        structure_out = output[0] # gets last line's structure (always will be first element when sliced)
+        energy = output[-1].replace(')', '').replace('(', '') # get energy (always will be last element in slice)
+    errors = vienna_call.stderr.replace('\n','') #changed from ' '
+    return structure_out, energy, errors
+
+#RNAeval to get the energy of a structure, without the cache
+#Returns the energy and errors. As with RNAeval, there is no energy ([]) if the lengths differ
+def eval_energy_record(sequence, structure, temperature = None):
+    if BACKEND == 'subprocess':
+        return eval_energy_subprocess(sequence, structure, temperature)
+    sequence = vienna_sequence(sequence)
+    structure = str(structure)
+    if len(sequence) == 0:
+        return [], ""
+    if len(sequence) != len(structure):
+        return [], "ERROR: unequal length "
+    energy = sequence_compound(sequence, vienna_temperature(temperature), None).eval_structure(structure)
+    return format_energy(energy), ""
+
+def eval_energy_subprocess(sequence, structure, temperature = None):
+    vienna_args = eval_energy_args(temperature) # arguments that are used to call vienna RNAeval at T 37 degrees
+    vienna_input = str(sequence + "\n" + structure) # the input format
+    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
+    # calls the subprocess with the vienna_input as input for the program
+    energy = vienna_call.stdout.split()
+    if energy: # if there actually is a result
+        energy = energy[-1].replace('(', '').replace(')', '')
+    errors = vienna_call.stderr.replace('\n',' ')
+    return energy, errors
+
+#RNALfold with a maximum base pair span of length, without the cache
+#Returns the output lines, as printed by RNALfold: one 'structure (energy) start' line per local structure,
+#then the sequence and the minimum free energy
+def local_fold_record(sequence, length):
+    if BACKEND == 'subprocess':
+        return local_fold_subprocess(sequence, length)
+    sequence = vienna_sequence(sequence)
+    if len(sequence) == 0:
+        return [''], ""
+    #The program was called with '−−noClosingGU', which uses unicode dashes and is not a real option,
+    #so the default model (closing GU pairs allowed) is the one that has always been used
+    fc = RNA.fold_compound(sequence, model_details(window = length), RNA.OPTION_MFE | RNA.OPTION_WINDOW)
+    output = []
+    def add_structure(start, end, structure, energy, output):
+        if structure is not None:
+            output.append("%s (%6.2f) %4d" % (structure, energy + 0.0, start))
+    mfe = fc.mfe_window_cb(add_structure, output)
+    output.append(sequence)
+    output.append(" (%6.2f)" % (mfe + 0.0))
+    return output, ""
+
+#The RNAfold options also set the base pair span limit, if there is one
+def span_args():
+    span = max_bp_span()
+    return [] if span is None else ['--maxBPspan', str(span)]
+
+def fold_args():
+    return ['RNAfold', '--noPS', '-T', str(TEMPERATURE)] + span_args()
+
+def fold_constraints_args(temperature = None):
+    return ['RNAfold', '--noPS', '-T', str(vienna_temperature(temperature)), '-C'] + span_args()
+
+def eval_energy_args(temperature = None):
+    return ['RNAeval', '-T', str(vienna_temperature(temperature))]
+
+def local_fold_args(length):
+    return ['RNALfold', '-T', str(TEMPERATURE), '-L', str(length), '−−noClosingGU']
+
+def local_fold_subprocess(sequence, length):
+    vienna_args = local_fold_args(length) # https://academic.oup.com/nar/article/40/12/5215/2414626
+    # 100bp length will be good for our purpose
+    vienna_input = str(sequence)
+    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
+
+    output = vienna_call.stdout.strip().split('\n')
+    errors = vienna_call.stderr
+
+    return output, errors
+
+#Records that can be batched: single line sequences, and dot-bracket structures or constraints of the same length.
+#Anything else (missing values, empty or mismatched inputs) is run on its own, so the program reports it as before
+SEQUENCE = re.compile('[A-Za-z]+')
+STRUCTURE = re.compile('[.()]+')
+CONSTRAINTS = re.compile('[.()|x<>]+')
+
+def batch_record(sequence, structure = None, pattern = STRUCTURE):
+    if not isinstance(sequence, str) or not SEQUENCE.fullmatch(sequence):
+        return False
+    if structure is None:
+        return True
+    return isinstance(structure, str) and len(structure) == len(sequence) and pattern.fullmatch(structure) is not None
+
+#Runs a Vienna program once on many records, each preceded by a '>id' header
+#Returns the output lines of each record, matched to the input by id, or None if the output cannot be matched
+def run_batch_once(vienna_args, records):
+    vienna_input = ''.join('>%d\n%s\n' % (i, '\n'.join(record)) for i, record in enumerate(records))
+    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
+    if vienna_call.returncode != 0 or vienna_call.stderr: #Messages can't be matched to a record
+        return None
+
+    outputs = {}
+    lines = None
+    for line in vienna_call.stdout.split('\n'):
+        if line.startswith('>'):
+            lines = outputs.setdefault(line[1:].strip(), [])
+        elif line and lines is not None:
+            lines.append(line)
+    outputs = [outputs.get(str(i)) for i in range(len(records))]
+    if any(not output for output in outputs):
+        return None
+    return outputs
+
+#Runs a Vienna program on many records with as few calls as possible
+#A batch whose output cannot be matched (for example, because a record made the program print a message) is split in half
+#and each half is run again, so that only the records with messages are left out, with about 2 log2(n) calls for each
+#Returns the output lines of each record, or None for the records that have to be run on their own (see fill_results)
+def run_batch(vienna_args, records):
+    if len(records) == 0:
+        return []
+    outputs = run_batch_once(vienna_args, records)
+    if outputs is not None:
+        return outputs
+    if len(records) == 1:
+        return [None]
+    middle = len(records) // 2
+    return run_batch(vienna_args, records[:middle]) + run_batch(vienna_args, records[middle:])
+
+#Structure and energy from the last line of a record, as for a single RNAfold call
+def parse_fold(lines):
+    output = lines[-1].split()
+    return output[0], output[-1].replace(')', '').replace('(', ''), ""
+
+#Runs single-record calls for the rows that were not batched (results that are still None)
+def fill_results(results, single, *columns):
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = single(*[column[i] for column in columns])
+    return results
+
+#RNAfold on a whole column of sequences, with one RNAfold call for the column
+#Returns a list of (structure, energy, errors), one per sequence
+def fold_batch(sequences):
+    sequences = list(sequences)
+    results = [None] * len(sequences)
+    if BACKEND == 'subprocess':
+        batch = [i for i, sequence in enumerate(sequences) if batch_record(sequence)]
+        outputs = run_batch(fold_args(), [[sequences[i]] for i in batch])
+        for i, output in zip(batch, outputs):
+            if output is not None:
+                results[i] = parse_fold(output)
+    return fill_results(results, fold_record, sequences)
+
+#RNAfold -C on whole columns of sequences and constraints
+#Returns a list of (structure, energy, errors), one per sequence
+def fold_constraints_batch(sequences, constraints, temperature = None):
+    sequences = list(sequences)
+    constraints = list(constraints)
+    results = [None] * len(sequences)
+    if BACKEND == 'subprocess':
+        batch = [i for i in range(len(sequences)) if batch_record(sequences[i], constraints[i], CONSTRAINTS)]
+        outputs = run_batch(fold_constraints_args(temperature), [[sequences[i], constraints[i]] for i in batch])
+        for i, output in zip(batch, outputs):
+            if output is not None:
+                results[i] = parse_fold(output)
+    return fill_results(results, fold_constraints_record, sequences, constraints, [temperature] * len(sequences))
+
+#RNAeval on whole columns of sequences and structures
+#Returns a list of (energy, errors), one per sequence
+def energy_batch(sequences, structures, temperature = None):
+    sequences = list(sequences)
+    structures = list(structures)
+    results = [None] * len(sequences)
+    if BACKEND == 'subprocess':
+        batch = [i for i in range(len(sequences)) if batch_record(sequences[i], structures[i])]
+        outputs = run_batch(eval_energy_args(temperature), [[sequences[i], structures[i]] for i in batch])
+        for i, output in zip(batch, outputs):
+            if output is not None:
+                results[i] = output[-1].split()[-1].replace('(', '').replace(')', ''), ""
+    return fill_results(results, eval_energy_record, sequences, structures, [temperature] * len(sequences))
+
+#RNALfold on a whole column of sequences, with one RNALfold call for the column
+#Returns a list of (output lines, errors), one per sequence
+def local_fold_batch(sequences, length):
+    sequences = list(sequences)
+    results = [None] * len(sequences)
+    if BACKEND == 'subprocess':
+        batch = [i for i, sequence in enumerate(sequences) if batch_record(sequence)]
+        outputs = run_batch(local_fold_args(length), [[sequences[i]] for i in batch])
+        for i, output in zip(batch, outputs):
+            if output is not None:
+                results[i] = output, ""
+    return fill_results(results, local_fold_record, sequences, [length] * len(sequences))
+
+#Version of ViennaRNA, part of the cache key as the energy parameters can change between versions
+@functools.lru_cache(maxsize = None)
+def vienna_version():
+    if BACKEND == 'bindings':
+        return RNA.__version__
+    vienna_call = subprocess.run(['RNAfold', '--version'], stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = '', encoding = 'ascii')
+    version = vienna_call.stdout.split()
+    return version[-1] if version else 'unknown'
+
+#Runs function on the records (rows of the columns) that are not in the fold cache, and caches the new results
+#The program with its options (vienna_args) and the record are the cache key
+def cached(vienna_args, function, *columns):
+    columns = [list(column) for column in columns]
+    if not fold_cache.enabled():
+        return function(*columns)
+    vienna_args = vienna_args + [vienna_version()]
+    records = list(zip(*columns))
+    results = fold_cache.lookup(vienna_args, records)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if len(missing) > 0:
+        new_results = function(*[[column[i] for i in missing] for column in columns])
+        fold_cache.store(vienna_args, [records[i] for i in missing], new_results)
+        for i, result in zip(missing, new_results):
+            results[i] = result
+    return results
+
+#Start of the window folded by fold_column: sequences longer than max_fold_length() are only folded in their
+#last max_fold_length() bases, the 3' end where the terminators are
+def fold_window_start(sequence):
+    length = max_fold_length()
+    if length is None or not isinstance(sequence, str) or len(sequence) <= length:
+        return 0
+    return len(sequence) - length
+
+#End of the window folded by fold_constraints_column: for sequences longer than max_fold_length(), the bases at the 3' end
+#that are constrained to be unpaired ('x', as after the antiterminators) are not folded, except the first of them
+#(which can dangle on the last pair). The structure and energy are the same as folding the whole sequence
+#Returns None if the whole sequence is folded (including when the brackets don't match, as RNAfold ignores the constraints)
+#The window can be longer than max_fold_length() if the constrained region is, and fold_constraints_column warns of it
+def constraints_window_end(sequence, constraints):
+    length = max_fold_length()
+    if length is None or not batch_record(sequence, constraints, CONSTRAINTS) or len(sequence) <= length:
+        return None
+    if constraints.count('(') != constraints.count(')'):
+        return None
+    end = max(length, len(constraints.rstrip('x')) + 1)
+    return end if end < len(sequence) else None
+
+#Appends a warning to the errors of a row, after a separator
+def add_warning(errors, warning):
+    return errors + '; ' + warning if errors else warning
+
+#RNAfold on a column of sequences (see fold_window_start for long sequences)
+#The rest of the structure of a sequence folded in a window is left unpaired, and its errors get a warning
+#Returns a list of (structure, energy, errors), one per sequence
+def fold_column(sequences):
+    sequences = list(sequences)
+    starts = [fold_window_start(sequence) for sequence in sequences]
+    folds = cached(fold_args(), fold_batch, [sequence[start:] if start > 0 else sequence for sequence, start in zip(sequences, starts)])
+    results = []
+    for sequence, start, (structure, energy, errors) in zip(sequences, starts, folds):
+        if start > 0 and structure:
+            structure = '.' * start + structure
+            errors = add_warning(errors, 'WARNING: folded the last %d of %d bases' % (len(sequence) - start, len(sequence)))
+        results.append((structure, energy, errors))
+    return results
+
+#RNAfold -C on columns of sequences and constraints, at temperature (default TEMPERATURE)
+#See constraints_window_end for long sequences. The errors get a warning if more than max_fold_length() bases are folded
+#Returns a list of (structure, energy, errors), one per sequence
+def fold_constraints_column(sequences, constraints, temperature = None):
+    sequences = list(sequences)
+    constraints = list(constraints)
+    ends = [constraints_window_end(sequence, constraint) for sequence, constraint in zip(sequences, constraints)]
+    folds = cached(fold_constraints_args(temperature), lambda sequences, constraints: fold_constraints_batch(sequences, constraints, temperature),
+                   [sequence if end is None else sequence[:end] for sequence, end in zip(sequences, ends)],
+                   [constraint if end is None else constraint[:end] for constraint, end in zip(constraints, ends)])
+    length = max_fold_length()
+    results = []
+    for sequence, end, (structure, energy, errors) in zip(sequences, ends, folds):
+        if end is not None and structure:
+            structure = structure + '.' * (len(sequence) - end)
+        folded = len(structure) if end is None else end
+        if length is not None and structure and folded > length:
+            errors = add_warning(errors, 'WARNING: folded %d bases, more than the maximum fold length of %d' % (folded, length))
+        results.append((structure, energy, errors))
+    return results
+
+#RNAeval on columns of sequences and structures, at temperature (default TEMPERATURE)
+#Returns a list of (energy, errors), one per sequence
+def energy_column(sequences, structures, temperature = None):
+    return cached(eval_energy_args(temperature), lambda sequences, structures: energy_batch(sequences, structures, temperature),
+                  sequences, structures)
+
+#RNALfold on a column of sequences, with a maximum base pair span of length
+#Returns a list of (output lines, errors), one per sequence
+def local_fold_column(sequences, length):
+    return cached(local_fold_args(length), lambda sequences: local_fold_batch(sequences, length), sequences)
+
+#Single sequence versions of the above
+def fold(sequence):
+    return fold_column([sequence])[0]
+
+def fold_constraints(sequence, constraints, temperature = None):
+    return fold_constraints_column([sequence], [constraints], temperature)[0]
+
+def eval_energy(sequence, structure, temperature = None):
+    return energy_column([sequence], [structure], temperature)[0]
+
+def local_fold(sequence, length):
+    return local_fold_column([sequence], length)[0]
+
+#Ensemble mode (bindings only): base pair probabilities of a sequence, from the partition function
+#The fold compound is the one shared with the constrained fold and the energy evaluations of the sequence
+#The Boltzmann factors are scaled with energy, a known energy close to the MFE (the probabilities don't depend on it),
+#so the sequence isn't folded again for its MFE. Without one, ViennaRNA's default scale is used
+def pair_probabilities(sequence, energy = None, temperature = None):
+    fc = sequence_compound(vienna_sequence(sequence), vienna_temperature(temperature), None)
+    if energy is not None:
+        fc.exp_params_rescale(energy)
+    fc.pf()
+    return fc.bpp()
+
+#Mean probability of the base pairs of a structure in the ensemble, or None if it has no base pairs
+def structure_probability(probabilities, structure):
+    pair_table = RNA.ptable(str(structure))
+    pairs = [(i, j) for i, j in enumerate(pair_table[1:], 1) if j > i]
+    if len(pairs) == 0:
+        return None
+    return sum(probabilities[i][j] for i, j in pairs) / len(pairs)
+
+def ensemble_batch(sequences, antiterm_structures, term_structures, antiterm_energies, term_energies):
+    results = []
+    for sequence, antiterm_structure, term_structure, antiterm_energy, term_energy in zip(sequences, antiterm_structures, term_structures, antiterm_energies, term_energies):
+        if not (batch_record(sequence, antiterm_structure) and batch_record(sequence, term_structure)):
+            results.append((None, None))
+            continue
+        energies = [energy for energy in (energy_value(antiterm_energy), energy_value(term_energy)) if energy is not None]
+        probabilities = pair_probabilities(sequence, min(energies) if len(energies) > 0 else None)
+        results.append((structure_probability(probabilities, antiterm_structure), structure_probability(probabilities, term_structure)))
+    return results
+
+#Energies as strings, with '' for missing energies, so that the records can be cached
+def energy_strings(energies):
+    return [energy if isinstance(energy, str) else '' for energy in energies]
+
+#Probabilities of the antiterminator and terminator structures of each sequence (see structure_probability)
+#antiterm_energies and term_energies are the energies of the structures, already calculated by the predictors; the lowest
+#is used to scale the partition function (see pair_probabilities)
+#Returns a list of (antiterminator probability, terminator probability), None where a structure is missing or doesn't fit
+def ensemble_column(sequences, antiterm_structures, term_structures, antiterm_energies, term_energies):
+    if BACKEND != 'bindings':
+        raise RuntimeError('The ensemble mode needs the ViennaRNA Python bindings (import RNA)')
+    return cached(['RNAfold', '-p', '-T', str(TEMPERATURE)], ensemble_batch, sequences, antiterm_structures, term_structures,
+                  energy_strings(antiterm_energies), energy_strings(term_energies))
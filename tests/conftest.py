@@ -0,0 +1,5 @@
+#The pipeline modules are imported by name, as the scripts do
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipeline'))
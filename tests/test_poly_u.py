@@ -0,0 +1,43 @@
+#Checks of the poly U index in poly_u.py against the regular expression it replaces
+
+import random
+import re
+import pytest
+from poly_u import TERM_POLY_U, poly_u_index, first_poly_u
+
+POLY_U = re.compile(TERM_POLY_U)
+
+#Expected (start, end) of re.compile(TERM_POLY_U).search(sequence, start, limit), or (-1, -1)
+def regex_poly_u(sequence, start, limit):
+    match = POLY_U.search(sequence, max(start, 0), max(limit, 0))
+    return (match.start(), match.end()) if match else (-1, -1)
+
+#Random columns of sequences, mostly T with the bridge characters and others, with starts and limits around each sequence
+@pytest.mark.parametrize('seed', range(5))
+def test_first_poly_u_matches_regex(seed):
+    rng = random.Random(seed)
+    for _ in range(100):
+        alphabet = rng.choice(['TTTTA', 'TTTAC', 'TTTTN', 'TTAGt', 'TTTTTTTGA-', 'T'])
+        sequences = [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 60))) for _ in range(rng.randint(1, 8))]
+        index = poly_u_index(sequences)
+        rows, starts, limits = [], [], []
+        for row, sequence in enumerate(sequences):
+            for _ in range(10):
+                start = rng.randint(-3, len(sequence) + 3)
+                rows.append(row)
+                starts.append(start)
+                limits.append(rng.choice([len(sequence), rng.randint(-2, len(sequence) + 3), start + 8]))
+
+        match_starts, match_ends = first_poly_u(index, rows, starts)
+        for row, start, match_start, match_end in zip(rows, starts, match_starts, match_ends):
+            assert (match_start, match_end) == regex_poly_u(sequences[row], start, len(sequences[row]))
+        match_starts, match_ends = first_poly_u(index, rows, starts, limits)
+        for row, start, limit, match_start, match_end in zip(rows, starts, limits, match_starts, match_ends):
+            assert (match_start, match_end) == regex_poly_u(sequences[row], start, limit)
+
+#Missing sequences have no matches
+def test_first_poly_u_missing_sequence():
+    index = poly_u_index(['ATTTTTA', float('nan')])
+    match_starts, match_ends = first_poly_u(index, [0, 1], [0, 0])
+    assert list(match_starts) == [1, -1]
+    assert list(match_ends) == [6, -1]
@@ -0,0 +1,70 @@
+#Checks of the pair tables in rna_structure.py against the forward bracket count they replace
+
+import random
+import pytest
+from rna_structure import pair_table, outer_pairs
+
+#Partner of each '(' found by counting brackets forward from it, as make_pairs did (-1 if none)
+def bracket_count_pairs(structure):
+    pairs = {}
+    for i in range(len(structure)):
+        if structure[i] == '(':
+            level = 1
+            for j in range(i + 1, len(structure)):
+                level += structure[j] == '('
+                level -= structure[j] == ')'
+                if level == 0:
+                    pairs[i] = j
+                    break
+            else:
+                pairs[i] = -1
+    return pairs
+
+#Outermost pairs, walking the structure from the partner of each stem, as the stems were found with make_pairs
+def bracket_count_stems(structure):
+    pairs = bracket_count_pairs(structure)
+    stems = []
+    index = 0
+    while index < len(structure) - 1:
+        if pairs.get(index, -1) >= 0:
+            stems.append([index + 1, pairs[index] + 1])
+            index = pairs[index]
+        index += 1
+    return stems
+
+#Random structure: balanced (with other characters between the brackets), or random brackets
+def random_structure(rng):
+    length = rng.randint(0, 80)
+    if rng.random() < 0.3:
+        return ''.join(rng.choice('(()).') for _ in range(length))
+    structure, depth = [], 0
+    for _ in range(length):
+        value = rng.random()
+        if value < 0.3:
+            structure.append('(')
+            depth += 1
+        elif value < 0.6 and depth > 0:
+            structure.append(')')
+            depth -= 1
+        else:
+            structure.append(rng.choice('.~,'))
+    return ''.join(structure) + ')' * depth
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pair_table_matches_bracket_count(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        structure = random_structure(rng)
+        table = pair_table(structure)
+        assert len(table) == len(structure)
+        for i, partner in bracket_count_pairs(structure).items():
+            assert table[i] == partner
+            if partner >= 0:
+                assert table[partner] == i
+        if structure.count('(') == structure.count(')'):
+            assert outer_pairs(table) == bracket_count_stems(structure)
+
+#Other bracket characters, and the stems of a structure
+def test_pair_table_brackets():
+    assert list(pair_table('<<.>.>', '<', '>')) == [5, 3, -1, 1, -1, 0]
+    assert outer_pairs(pair_table('((..))..(.)')) == [[1, 6], [9, 11]]
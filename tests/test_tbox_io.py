@@ -0,0 +1,73 @@
+#Checks of the INFERNAL and FASTA readers in tbox_io.py
+
+import pandas as pd
+import pytest
+from Bio import bgzf
+from tbox_io import read_INFERNAL, read_fasta, select_fasta
+
+#One local hit (model positions 3 to 10 of 12, with an insert after position 5), as cmsearch writes it
+#in the text output, the --tblout table, and the -A alignment
+TEXT_OUTPUT = '''>> seq1  -
+ rank     E-value  score  bias mdl mdl from   mdl to       seq from      seq to       acc trunc   gc
+ ----   --------- ------ ----- --- -------- --------    -------- --------      ---- ----- ----
+  (1) !   1.0e-10   50.0   0.1  cm        3       10 []          5       13 + ..    0.90    no 0.50
+
+                              NC
+                    <<<.__>>> CS
+  RF00230         3 xxx.xxxxx 10
+
+  seq1            5 ACGuAAACG 13
+                    ********* PP
+
+'''
+
+TBLOUT = '''#target name accession query name accession mdl mdl from mdl to seq from seq to strand trunc pass gc bias score E-value inc description
+seq1 - T-box RF00230 cm 3 10 5 13 + no 1 0.50 0.1 50.0 1.0e-10 ! -
+'''
+
+ALIGNMENT = '''# STOCKHOLM 1.0
+
+seq1/5-13         --ACGuAAACG--
+#=GR seq1/5-13 PP ..*********..
+#=GC SS_cons      ::<<<.__>>>,,
+#=GC RF           xxxxx.xxxxxxx
+//
+'''
+
+#Both input paths give the same hits, except CM_accuracy (estimated from the posteriors for --tblout)
+def test_tblout_matches_text_output(tmp_path):
+    text_file, tblout_file, alignment_file = tmp_path / 'hits.txt', tmp_path / 'hits.tbl', tmp_path / 'hits.sto'
+    text_file.write_text(TEXT_OUTPUT)
+    tblout_file.write_text(TBLOUT)
+    alignment_file.write_text(ALIGNMENT)
+    text_hits = read_INFERNAL(str(text_file)).drop(columns = 'CM_accuracy')
+    tblout_hits = read_INFERNAL(str(tblout_file), alignment_file = str(alignment_file)).drop(columns = 'CM_accuracy')
+    assert text_hits.to_dict('records') == tblout_hits.to_dict('records')
+    assert text_hits.loc[0, 'Sequence'] == 'ACGuAAACG'
+    assert text_hits.loc[0, 'Structure'] == '<<<.__>>>'
+
+FASTA = '>seq1 first\nACGT\nACG\n>seq2\nTTTT\n>seq3 third\nGGGG\nCC\n'
+
+def write_fasta(path, compressed):
+    if compressed:
+        with bgzf.BgzfWriter(str(path), 'wb') as handle:
+            handle.write(FASTA.encode('ascii'))
+    else:
+        path.write_text(FASTA)
+    return str(path)
+
+#Reading an indexed FASTA file writes to the mask of selected records, which pandas can return as a read-only view
+#(with copy-on-write, the default from pandas 3)
+@pytest.mark.parametrize('compressed', [False, True])
+def test_read_fasta(tmp_path, compressed):
+    fasta_file = write_fasta(tmp_path / 'input.fa', compressed)
+    with pd.option_context('mode.copy_on_write', True):
+        fastas = read_fasta(fasta_file)
+        first = select_fasta(fasta_file, ['seq3'], missing = 'first')
+        none = select_fasta(fasta_file, ['seq3'])
+        empty = select_fasta(fasta_file, [])
+    assert fastas.to_dict('list') == {'Name':['seq1', 'seq2', 'seq3'], 'FASTA_sequence':['ACGTACG', 'TTTT', 'GGGGCC']}
+    assert first.to_dict('list') == {'Name':['seq1', 'seq3'], 'FASTA_sequence':['ACGTACG', 'GGGGCC']}
+    assert none.to_dict('list') == {'Name':['seq3'], 'FASTA_sequence':['GGGGCC']}
+    #No records: the names can still be merged with (empty) hits
+    assert len(pd.merge(empty, pd.DataFrame({'Name':pd.Series([], dtype = object)}), on = 'Name')) == 0
@@ -0,0 +1,42 @@
+#Checks of the deduplication of the predictors (predict_unique in tbox_predictor.py)
+
+import numpy as np
+import pandas as pd
+from tbox_predictor import predict_unique
+
+#Two strains with the same T-box, a second T-box, and FASTA records without hits (the same record twice)
+def tboxes():
+    return pd.DataFrame({'Name':['strain1', 'strain2', 'other', 'empty1', 'empty2'],
+                         'FASTA_sequence':['AACGT', 'AACGT', 'GGGCC', 'TTTT', 'TTTT'],
+                         'Rank':[1, 2, 3, np.nan, np.nan],
+                         'Score':[20.0, 20.0, 10.0, np.nan, np.nan],
+                         'Tbox_start':[1, 1, 2, np.nan, np.nan],
+                         'Tbox_end':[4, 4, 5, np.nan, np.nan],
+                         'Sequence':['ACG', 'ACG', 'GGC', np.nan, np.nan],
+                         'Structure':['(.)', '(.)', '(.)', np.nan, np.nan]})
+
+#Stands in for the predictions: records the rows it was run on, and changes a key column, as tbox_derive does
+def predict(rows, calls):
+    calls.append(list(rows['Name']))
+    rows = rows.copy()
+    rows['prediction'] = rows['FASTA_sequence'].str.lower()
+    rows['Tbox_start'] = rows['Tbox_start'] + 1
+    return rows
+
+def test_predict_unique_fans_out():
+    calls = []
+    predicted = predict_unique(lambda rows: predict(rows, calls), tboxes())
+    assert calls == [['strain1', 'other', 'empty1']]
+    assert list(predicted.columns) == list(tboxes().columns) + ['prediction']
+    assert list(predicted['Name']) == ['strain1', 'strain2', 'other', 'empty1', 'empty2'] #not in the key, kept for each row
+    assert list(predicted['Rank'].fillna(0)) == [1, 2, 3, 0, 0]
+    assert list(predicted['prediction']) == ['aacgt', 'aacgt', 'gggcc', 'tttt', 'tttt']
+    assert list(predicted['Tbox_start'].fillna(0)) == [2, 2, 3, 0, 0] #in the key, copied from the predictions
+
+#Without fan-out, only the first row of each key is predicted and returned, in order (also when the rows without hits
+#come first)
+def test_predict_unique_drops_duplicates():
+    calls = []
+    predicted = predict_unique(lambda rows: predict(rows, calls), tboxes().iloc[::-1], key = ['Sequence'], fan_out = False)
+    assert calls == [['empty2', 'other', 'strain2']]
+    assert list(predicted['Name']) == ['empty2', 'other', 'strain2']
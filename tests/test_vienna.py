@@ -0,0 +1,34 @@
+#Checks of the ViennaRNA folding in vienna.py
+
+import subprocess
+import pytest
+
+import vienna
+
+#The constrained fold and the energy evaluation of a sequence share one fold compound (see FOLD_CONTEXTS)
+def test_sequence_compound_is_shared(monkeypatch):
+    pytest.importorskip('RNA')
+    monkeypatch.setattr(vienna, 'BACKEND', 'bindings')
+    monkeypatch.delenv('TBOX_MAX_BP_SPAN', raising = False)
+    vienna.sequence_compound.cache_clear()
+    sequence = 'GGGGAAACCCCATTTTTT'
+    structure, energy, errors = vienna.fold_constraints_record(sequence, '((((...))))')
+    assert vienna.eval_energy_record(sequence, structure) == (energy, '')
+    info = vienna.sequence_compound.cache_info()
+    assert (info.misses, info.hits) == (1, 1)
+
+#A record that makes the program print a message is run on its own, and the rest of the column stays batched
+def test_run_batch_splits_messages(monkeypatch):
+    calls = []
+    def run(args, input, **kwargs):
+        records = input.split('>')[1:]
+        calls.append(len(records))
+        stdout = ''.join('>%s\n%s (-1.00)\n' % tuple(record.split('\n')[:2]) for record in records)
+        stderr = 'WARNING: message\n' if 'GGGG' in input else ''
+        return subprocess.CompletedProcess(args, 0, stdout = stdout, stderr = stderr)
+    monkeypatch.setattr(vienna.subprocess, 'run', run)
+    records = [['ACGU' * 3]] * 63 + [['GGGGAAAACCCC']]
+    outputs = vienna.run_batch(['RNAfold'], records)
+    assert outputs[-1] is None
+    assert all(output == ['ACGUACGUACGU (-1.00)'] for output in outputs[:-1])
+    assert len(calls) <= 2 * 6 + 1
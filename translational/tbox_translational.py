@@ -5,80 +5,23 @@
 import hashlib
 import base64
 import sys
+import os
 import re
+import argparse
+import numpy as np
 import pandas as pd
-from Bio import SeqIO
-import subprocess
-
-#Function to read an INFERNAL output file and extract sequence names, metadata, structure, and sequence
-#Metadata is as described in the INFERNAL manual
-def read_INFERNAL(file):
-    metadata = []
-    Tbox_start = -1
-    Tbox_end = -1
-    sp = ""
-    sp_start = ""
-
-    metadataLine = -1
-    structLine = -1
-    seqLine = -1
-    
-    #Don't parse strand (will all be +)
-    Tboxes = {'Name':[], 'Rank':[], 'E_value':[], 'Score':[], 'Bias':[], 'Tbox_start':[],'Tbox_end':[],
-               'CM_accuracy':[], 'GC':[], 'Sequence':[], 'Structure':[]}
-
-    with open(file) as f:
-        for lineCount, line in enumerate(f):
-            if re.match(">>", line) is not None: #We found a match!
-                Tboxes['Name'].append(line.split(" ")[1])
-
-                metadataLine = lineCount + 3
-                structLine = lineCount + 6
-                seqLine = lineCount + 9
-
-            if lineCount == metadataLine:
-                metadata = list(filter(None, line.split(' '))) #Splits by spaces, and strips empty strings
-
-                Tboxes['Rank'].append(int(metadata[0][1:len(metadata[0])-1])) #All except first and last characters
-                Tboxes['E_value'].append(float(metadata[2])) #third entry
-                Tboxes['Score'].append(float(metadata[3])) #fourth
-                Tboxes['Bias'].append(float(metadata[4])) #fifth
-                Tbox_start = metadata[9]
-                Tboxes['Tbox_start'].append(int(Tbox_start))
-                Tbox_end = metadata[10]
-                Tboxes['Tbox_end'].append(int(Tbox_end))
-                #Tboxes['Strand'].append(metadata[11])
-                Tboxes['CM_accuracy'].append(float(metadata[13]))
-                Tboxes['GC'].append(float(metadata[15][0:4])) #ignore the \n at the end
-
-            if lineCount == structLine:
-                sp = list(filter(None,line.split(' ')))
-                structure = sp[0]
-                Tboxes['Structure'].append(structure) #Take the second-to-last one
-
-            if lineCount == seqLine:
-                seq_line = list(filter(None, line.strip().split(' ')))
-                sequence = ' '.join(seq_line[2:len(seq_line) - 1])
-
-                #Fallback method (adapted from Thomas Jordan's code):
-                if sequence not in line: #This can happen if there are two consecutive spaces in the middle of the sequence.
-                    rsp = line.rsplit(Tbox_end, maxsplit = 1)
-                    lsp = rsp[0].split(Tbox_start + ' ')
-                    sequence = lsp[len(lsp) - 1].strip()
-                    print("Fallback on line %d" % lineCount)
-
-                #Do a sanity check
-                if len(sequence) != len(structure): #This is an error!
-                    print("\nParsing ERROR occured on line %d" % lineCount)
-                    print(line) #For debug purposes
-                    print(sequence)
-                    print(structure)
-                    print(seq_line)
-                    #sequence = "ERROR"
-                    
-                Tboxes['Sequence'].append(sequence)
-                
-    return pd.DataFrame(Tboxes)
+
+#The shared readers and motif profiles live in the pipeline directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline'))
+from tbox_io import read_INFERNAL, read_fasta, index_fasta, select_fasta
+import vienna
+from tbox_motifs import PROFILES, FEATURE_COLUMNS, motif_features, features_batch, remap_features
+from rna_structure import pair_table, outer_pairs
+from tbox_predictor import predict_unique, predict_hit_features, run_thermo_parallel, temperature_sweep, add_ensemble, predict_chunks
+from tbox_predictor import add_common_arguments, apply_common_arguments
+
+#Motif profile of the covariance model
+PROFILE = PROFILES['translational_ILE']
 
 #Function to find features of a T-box given the secondary structure
 #Parameters: 
@@ -88,240 +31,42 @@ def read_INFERNAL(file):
 
 #Output:
 #Stem 1 start, stem 1 specifier loop, codon, stem 1 end, antiterminator start, discriminator, antiterminator end
-
+#See motif_features in tbox_motifs.py; the model-specific landmarks are in PROFILE
 def tbox_features_translational(seq, struct, offset = 0):
-    s1_start = -1
-    s1_end = -1
-    s1_loop_start = -1
-    s1_loop_end = -1
-    antiterm_start = -1
-    antiterm_end = -1
-    warnings = ""
-    codon = ""
-    codon_region = ""
-    discrim = ""
-    discrim_start = -1
-    discrim_end = -1
-    
-    if len(seq)!=len(struct):
-        raise RuntimeError("Sequence length (%d) is not equal to structure length (%d)" % (len(seq), len(struct)))
-        
-    if not (struct.startswith(':') or struct.startswith('<')):
-        warnings += "BAD_SEC_STRUCT;"
-    
-    #Find the Stem 1 start
-    m = re.search('<',struct)
-    if m is not None:
-        s1_start = m.start() #Gets the first '<'
-    else:
-        warnings += "NO_STEM1_START;"
-        
-    #Find the Stem 1 end
-    m = re.search('>\.*,',struct)
-    if m is not None:
-        s1_end = m.start() #Gets the first '>,' or possibly '>.,'
-    else:
-        warnings += "NO_STEM1_END;"
-
-    #Find the Stem 1 specifier loop start
-    m = re.search('<\.*_',struct)
-    if m is not None:
-        s1_loop_start = m.start() #Gets the first '<_' or possibly '<._'
-    else:
-        warnings += "NO_SPEC_START;"
-    
-    #Find the Stem 1 specifier loop end
-    m = re.search('_\.*>',struct)
-    if m is not None and m.start() < s1_end:
-        s1_loop_end = m.start() #Gets the first '_>' or possibly '_>'
-    else:
-        warnings += "NO_SPEC_END;"
-
-    if s1_loop_end > s1_loop_start: #Sanity check
-        #Read the codon
-        codon = seq[s1_loop_end - 3: s1_loop_end] 
-        #Check the codon
-        if re.search('[^AaCcGgUu]', codon) is not None:
-            warnings += "BAD_CODON;"
-        else: #Assign the codon region
-            minus_one_pos = s1_loop_end - 6
-            while minus_one_pos > 0 and re.match('[^AaCcGgUu]', seq[minus_one_pos]) is not None:
-                minus_one_pos -= 1 #Look for the first ACGU character before the codon
-            plus_one_pos = s1_loop_end - 2
-            while plus_one_pos < len(seq) - 1 and re.match('[^AaCcGgUu]', seq[plus_one_pos]) is not None:
-                plus_one_pos += 1 #Look for the first ACGU character after the codon
-            codon_region = seq[minus_one_pos] + codon + seq[plus_one_pos] #Get the surrounding region too, for +1/-1 predictions
-    else:
-        warnings += "NO_CODON;"
-        
-    #Find the antiterminator start
-    antiterm_list = [m.start() for m in re.finditer(',\.*<', struct)] #Makes a list of all occurences of ',<'
-    if len(antiterm_list) > 0:
-        antiterm_start = antiterm_list[len(antiterm_list)-1] #Gets the last one
-        discrim_start = struct.find('---', antiterm_start + 3) #Find the loop containing the discriminator
-        discrim_end = discrim_start + 4
-        discrim = seq[discrim_start:discrim_end]
-    else:
-        warnings += "NO_ANTITERM_START;"
-    
-    #Check the discriminator
-    if not discrim.startswith('UGG') or re.search('[^AaCcGgUu]', discrim) is not None:
-        warnings += "BAD_DISCRIM;"
-    
-    #Find the antiterminator
-    match = re.search('>\.*:',struct)
-    if match is not None: #Sometimes the antiterminator end is missing from the sequence
-        antiterm_end = match.start()
-    else: #Simply get the last '>'
-        end_list = [m.start() for m in re.finditer('>', struct)]
-        if len(end_list) > 0:
-            antiterm_end = end_list[len(end_list)-1]
-        else:
-            warnings += "NO_ANTITERM_END;"
-    
-    #Adjust values based on offset
-    s1_start += offset
-    s1_loop_start += offset + 1
-    s1_loop_end += offset
-    s1_end += offset
-    antiterm_start += offset + 1
-    antiterm_end += offset
-    discrim_start += offset
-    discrim_end += offset - 1
-    
-    #Return a tuple with the features identified
-    return (s1_start, s1_loop_start, s1_loop_end, codon, s1_end, antiterm_start, discrim, antiterm_end, codon_region, warnings, discrim_start, discrim_end)
-    
-#Convert between position in INFERNAL output and fasta sequence
-#Count the gaps and adjust for them
-#Returns a mapping between INFERNAL position and fasta position
-def map_fasta(seq, fasta, offset = 0, allowed = 'AaGgCcUu'):
-    #Initialize counters
-    count_fasta = offset
-    parse_buffer = ""
-    parsing = False
-    mapping = []
-
-    for c in seq:
-        mapping.append(count_fasta)
-        
-        if parsing:
-            if c == ']': #The end of the numerical gap
-                parsing = False
-                count_fasta += int(parse_buffer.strip()) #Parse the value
-                #print(parse_buffer) #debug
-                parse_buffer = "" #reset buffer for the next gap
-            else:
-                parse_buffer += c #Add the character to the parse buffer
-            
-        elif c in allowed:
-            count_fasta += 1
-            
-        elif c == '[': # The start of a numerical gap
-            parsing = True
-        
-    return mapping
+    return motif_features(PROFILE, seq, struct, offset)
 
 #Function to compute derived T-box features from the prediction
 #Note: tboxes must contain fasta sequences!
 def tbox_derive(tboxes):
     #Derive more features for visualization
-
-    for i, fasta in enumerate(tboxes['FASTA_sequence']):
-        print('Mapping ' + tboxes['Name'][i]) #debug
-        seq = tboxes['Sequence'][i]
-        if isinstance(seq, str): #sanity check. Skip NaN
-            #Create mapping between INFERNAL sequence and FASTA sequence
-            mapping = map_fasta(seq, fasta, offset = tboxes['Tbox_start'][i] - 1)
-            #Update the positions of existing features.
-            s1_start = int(tboxes['s1_start'][i])
-            if s1_start > 0:
-                tboxes.at[tboxes.index[i], 's1_start'] = mapping[s1_start]
-
-            s1_loop_start = int(tboxes['s1_loop_start'][i])
-            if s1_loop_start > 0:
-                tboxes.at[tboxes.index[i], 's1_loop_start'] = mapping[s1_loop_start]
-
-            s1_loop_end = int(tboxes['s1_loop_end'][i])
-            if s1_loop_end > 0:
-                if s1_loop_end < len(mapping):
-                    tboxes.at[tboxes.index[i], 's1_loop_end'] = mapping[s1_loop_end]
-                    #Calculate codon range
-                    tboxes.at[tboxes.index[i], 'codon_start'] = mapping[s1_loop_end - 3]
-                    tboxes.at[tboxes.index[i], 'codon_end'] = mapping[s1_loop_end - 1]
-                else:
-                    print("Warning: mapping error for s1_loop_end:")
-                    print(s1_loop_end)
-                    print(len(mapping))
-                    print(mapping)
-
-            s1_end = int(tboxes['s1_end'][i])
-            if s1_end > 0:
-                tboxes.at[tboxes.index[i], 's1_end'] = mapping[s1_end]
-
-            aterm_start = int(tboxes['antiterm_start'][i])
-            if aterm_start > 0:
-                tboxes.at[tboxes.index[i], 'antiterm_start'] = mapping[aterm_start]
-                
-            #Calculate discriminator range
-            discrim_start = int(tboxes['discrim_start'][i])
-            if discrim_start > 0:
-                tboxes.at[tboxes.index[i], 'discrim_start'] = mapping[discrim_start]
-                tboxes.at[tboxes.index[i], 'discrim_end'] = mapping[discrim_start +  3] #+3 because inclusive
-
-            aterm_end = int(tboxes['antiterm_end'][i])
-            if aterm_end > 0:
-                aterm_end = min(aterm_end, len(mapping)-1)
-                tboxes.at[tboxes.index[i], 'antiterm_end'] = mapping[aterm_end]
-                #Calculate terminator end
-                #tboxes.at[tboxes.index[i], 'term_end'] = term_end(fasta, aterm_end)
-        
-    return tboxes
+    for name in tboxes['Name']:
+        print('Mapping ' + name) #debug
+    
+    #Create mappings between INFERNAL sequences and FASTA sequences, and update the positions of existing features
+    #The terminator end is not calculated for translational T-boxes
+    return remap_features(tboxes, PROFILE.codon_offsets)
 
 #RNAfold on target sequence
 def get_fold(sequence):
-    #Initialize outputs
-    structure = ""
-    energy = ""
-    errors = ""
-
-    vienna_args = ['RNAfold', '--noPS', '-T', '37'] # arguments used to call RNAfold at 37 degrees
-    vienna_input = str(sequence) # the input format
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    
-    output = vienna_call.stdout.split('\n')
-    if len(output) > 1: # if there is a result
-        output = output[-2]
-        output = output.split()
-        structure = output[0] # gets last line's structure (always will be first element when sliced)
-        energy = output[-1].replace(')', '').replace('(', '') # get energy (always will be last element in slice)
-    errors = vienna_call.stderr.replace('\n',' ')
-    return structure, energy, errors
+    return vienna.fold(sequence)
+
+#RNAfold on a column of target sequences (long sequences are folded in a window, see vienna.fold_column)
+def get_fold_column(sequences):
+    return vienna.fold_column(sequences)
 
 #RNAfold on target sequence, with constraints
 def get_fold_constraints(sequence, structure):
-    #Initialize outputs
-    energy = ""
-    errors = ""
-    structure_out = ""
-
-    vienna_args = ['RNAfold', '--noPS', '-T', '37', '-C'] # arguments used to call RNAfold at 37 degrees with constraints
-    vienna_input = str(sequence) + '\n' + str(structure) # the input format
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    
-    output = vienna_call.stdout.split('\n')
-    if len(output) > 1: # if there is a result
-        output = output[-2]
-        output = output.split()
-        structure_out = output[0] # gets last line's structure (always will be first element when sliced)
-        energy = output[-1].replace(')', '').replace('(', '') # get energy (always will be last element in slice)
-    errors = vienna_call.stderr.replace('\n','') #changed from ' '
-    return structure_out, energy, errors
+    return vienna.fold_constraints(sequence, structure)
+
+#RNAfold on a column of target sequences, with constraints
+def get_fold_constraints_column(sequences, structures, temperature = None):
+    return vienna.fold_constraints_column(sequences, structures, temperature)
 
 #Make antiterminator constraints for folding
+#Returns the constraints, or None if there is nothing to refold
 def make_antiterm_constraints(sequence, structure):
     if pd.isna(sequence) or pd.isna(structure):
-        return None, None, None
+        return None
     
     # search for antiterm end
     antiterm_end = term_end(structure, 0, pattern = ')') + 1 #search for last ')', which is the antiterm end
@@ -336,26 +81,42 @@ def make_antiterm_constraints(sequence, structure):
         # make hard constraint for discriminator 
         if(discriminator):
             constraints = constraints[:(discriminator.start() + match.start() + 1)] + 'xxxx' + constraints[(discriminator.end() + match.start() + 1):]
-            structure_out, energy, errors = get_fold_constraints(sequence, constraints)
-            if len(structure_out) < 4 or structure_out[3] != '(': #check if base immediately before UGGN is paired
-                errors += "BAD_ANTITERM_STEM"
-            return structure_out, energy, errors
-    return None, None, None
+            return constraints
+    return None
+
+#Check the stem of a refolded antiterminator
+def check_antiterm_stem(structure_out, energy, errors):
+    if len(structure_out) < 4 or structure_out[3] != '(': #check if base immediately before UGGN is paired
+        errors += "BAD_ANTITERM_STEM"
+    return structure_out, energy, errors
+
+#Refold the antiterminators with constraints (from make_antiterm_constraints), with one RNAfold call for all of them
+#Returns a list of (structure, energy, errors), one per antiterminator
+def refold_antiterms(sequences, constraints):
+    sequences = list(sequences)
+    refold = [i for i, constraint in enumerate(constraints) if constraint is not None]
+    folds = get_fold_constraints_column([sequences[i] for i in refold], [constraints[i] for i in refold])
+    results = [(None, None, None)] * len(sequences)
+    for i, fold in zip(refold, folds):
+        results[i] = check_antiterm_stem(*fold)
+    return results
 
 #RNAeval to get energy
 def get_energy(sequence, structure):
     if pd.isna(sequence) or pd.isna(structure):
         return None, ""
-
-    vienna_args = ['RNAeval', '-T', '37'] # arguments that are used to call vienna RNAeval at T 37 degrees  
-    vienna_input = str(sequence + "\n" + structure) # the input format
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    # calls the subprocess with the vienna_input as input for the program
-    energy = vienna_call.stdout.split()
-    if energy: # if there actually is a result
-        energy = energy[-1].replace('(', '').replace(')', '')
-    errors = vienna_call.stderr.replace('\n',' ')
-    return energy, errors
+    return vienna.eval_energy(sequence, structure)
+
+#RNAeval on a column of sequences and structures, with one RNAeval call for the rows that have both
+def get_energy_column(sequences, structures, temperature = None):
+    sequences = list(sequences)
+    structures = list(structures)
+    rows = [i for i in range(len(sequences)) if not (pd.isna(sequences[i]) or pd.isna(structures[i]))]
+    energies = vienna.energy_column([sequences[i] for i in rows], [structures[i] for i in rows], temperature)
+    results = [(None, "")] * len(sequences)
+    for i, result in zip(rows, energies):
+        results[i] = result
+    return results
 
 def get_sequence(fasta, start, end):
     if pd.isna(fasta) or pd.isna(start) or pd.isna(end):
@@ -395,114 +156,86 @@ def replace_characters(structure):
             structure = structure.replace(c, ")") # creates a normal closed bracket
     return structure
 
+TRUNCATION = re.compile('\*\[.+?\][\*>]')
+GAP = re.compile('-')
+
 # removes truncations and adds the missing nucleotides from the FASTA
+# the new sequence and structure are built from pieces in one pass, and joined at the end
 def resolve_truncations(fasta_sequence, processed_sequence, processed_structure):
-
-    processed_length = len(processed_sequence) 
+    sequence_pieces = []
+    structure_pieces = []
+    length = 0 # length of the new sequence so far
+    sequence_gaps = 0 # number of gaps in the new sequence so far, important for alignment
+    end = 0 # end of the previous truncation in the input
     
-    for truncations in re.finditer('\*\[.+?\][\*>]', processed_sequence):
+    for truncations in TRUNCATION.finditer(processed_sequence):
         # finds the characters representing the truncation in the sequence
         # truncations have the form *[ N]* where N is a number of nucleotides
         # regexp : finds *[ followed by optional space, then number, then ]* or ]> if end of sequence
-        #print(truncations.group(),truncations.start())
-        
-        difference = len(processed_sequence) - processed_length 
-        # as we are modifying the length of the processed_sequence inside the for loop, we need to adjust
-        # our indices obtained from the regexp by how much the sequence length has changed 
         
         missing = int(truncations.group().replace('*', '').replace('[', '').replace(']','').replace(' ', ''))
         # obtain the number of missing nucleotides by stripping away the useless characters
         
-        match_start, match_end = truncations.start() + difference, truncations.end() + difference
+        # copies the input up to the truncation
+        piece = processed_sequence[end:truncations.start()]
+        sequence_pieces.append(piece)
+        structure_pieces.append(processed_structure[end:truncations.start()])
+        length += len(piece)
+        sequence_gaps += piece.count('-')
         
-        sequence_gaps = processed_sequence[:match_start].count('-')
-        # number of gaps from start of the sequence to the truncation itself, important for alignment
-        
-        # obtain the positions of the truncations (adjusted by the difference in length
         # adds the missing n nucleotides to the sequence by getting them from the fasta sequence
-        
+        # (the truncation starts at position length - sequence_gaps of the fasta)
         if(missing > 0):
-            processed_sequence = processed_sequence[:match_start] + transcribe(fasta_sequence[(match_start - sequence_gaps):(match_start - sequence_gaps + missing)]) + processed_sequence[match_end:]
-            processed_structure = processed_structure[:match_start] + "~" * (missing) + processed_structure[match_end:]
-        else:
-            processed_sequence = processed_sequence[:match_start] + processed_sequence[match_end:]
-            processed_structure = processed_structure[:match_start] + processed_structure[match_end:]
-    # appends the start of the T-box fasta if it is not in the infernal sequence
-    return processed_sequence, processed_structure
-
-
-#Makes a list of (lists of length 4) containing pair information
-# in pairs, the first element of each entry is the character type and the second its index
-# the third is the index of the bracket it is matched with and the fourth the matching bracket
-def make_pairs(processed_structure, dot_structure):
-    struct_list = list(dot_structure)
-    length_list = len(struct_list) # length of the list struct_list
-    pairs = [None] * length_list # creates a list of length dot structure filled with None
-    
-    for index, element in enumerate(struct_list):
-        if(element == '('):
-            pairs[index] = ['(', index, None, ''] # creates entries for the left brackets in pairs
-        elif(element == ')'):
-            pairs[index] = [')', index, None, ''] # creates entries for the right brackets in pairs
-
-    for index, element in enumerate(pairs):
-        l_count = 0
-        r_count = 0
-        i = index + 1
-        if(element != None):
-            if(element[0] == '('):
-                l_count += 1
-                while(i < length_list):
-                    if(pairs[i] != None):
-                        if('(' == pairs[i][0]):
-                            l_count += 1
-                        elif(')' == pairs[i][0]):
-                            r_count += 1
-                            l_count -= 1
-                        if((r_count > 0) and (l_count == 0)):
-                            element[2] = pairs[i][1]
-                            element[3] = processed_structure[pairs[i][1]]
-                            pairs[i][2] = element[1]
-                            pairs[i][3] = processed_structure[element[1]]
-                            break
-                    i += 1
-    return pairs
-
+            piece = transcribe(fasta_sequence[(length - sequence_gaps):(length - sequence_gaps + missing)])
+            sequence_pieces.append(piece)
+            structure_pieces.append("~" * (missing))
+            length += len(piece)
+            sequence_gaps += piece.count('-')
+        end = truncations.end()
+    
+    if end == 0: # no truncations
+        return processed_sequence, processed_structure
+    sequence_pieces.append(processed_sequence[end:])
+    structure_pieces.append(processed_structure[end:])
+    return ''.join(sequence_pieces), ''.join(structure_pieces)
+
+# tags the gaps '-' in the sequence, and the structure at the gaps, with 'x' for deletion
+# the bases paired with a gap are changed to '.' in the structures
+# the sequence and structures are changed in lists (the checks use the input strings), and joined at the end
 def replace_gaps(processed_sequence, processed_structure, dot_structure, pairs):
     structure_changed = False # check whether structure was modified by program
     corrected_brackets = False # check whether brackets were adjusted
     
-    my_dot_structure = dot_structure # creates a copy of dot_structure that does not get changed
-    my_processed_sequence = processed_sequence # creates a copy of processed_sequence that does not get changed
+    if '-' not in processed_sequence: # nothing to do
+        return processed_sequence, processed_structure, dot_structure, structure_changed, corrected_brackets
+    
+    new_sequence = list(processed_sequence)
+    new_structure = list(processed_structure)
+    new_dot_structure = list(dot_structure)
     
-    for match in re.finditer('-', my_processed_sequence):
+    for match in GAP.finditer(processed_sequence):
         index = match.start() # gets the index of each gap '-' in the sequence
         
-        if(my_dot_structure[index] == '.'):
-            processed_structure = processed_structure[:index] + 'x' + processed_structure[(index + 1):]
-            dot_structure = dot_structure[:index] + 'x' + dot_structure[(index + 1):]
+        if(dot_structure[index] == '.'):
             # replaces the secondary structure with an x to tag it for deletion
-            processed_sequence = processed_sequence[:index] + 'x' + processed_sequence[(index + 1):]
-            # replaces the nucleotide in the sequence with an x, tagging it for deletion
+            # and the nucleotide in the sequence with an x, tagging it for deletion
+            new_structure[index] = new_dot_structure[index] = new_sequence[index] = 'x'
         
-        elif((my_dot_structure[index] == '(') or (my_dot_structure[index] == ')')):
-            processed_structure = processed_structure[:index] + 'x' + processed_structure[(index + 1):]
-            dot_structure = dot_structure[:index] + 'x' + dot_structure[(index + 1):]
+        elif((dot_structure[index] == '(') or (dot_structure[index] == ')')):
             # replaces the open/closed bracket in the secondary structures by x to tag it for deletion
-            processed_sequence = processed_sequence[:index] + 'x' + processed_sequence[(index + 1):]
-            # replaces the corresponding nucleotide in the sequence by x to tag it for deletion
+            # and the corresponding nucleotide in the sequence by x to tag it for deletion
+            new_structure[index] = new_dot_structure[index] = new_sequence[index] = 'x'
             
             structure_changed = True # we have changed the sequence
             
-            if(isinstance(pairs[index][2], int) == True): # if there is a matching bracket
-                paired = pairs[index][2] # the position of the paired closed/open bracket
-                if(my_processed_sequence[paired] != '-'):
+            if(pairs[index] >= 0): # if there is a matching bracket
+                paired = pairs[index] # the position of the paired closed/open bracket
+                if(processed_sequence[paired] != '-'):
                 # if the matching closed/open bracket is a real nucleotide in the sequence and not '-'
-                    processed_structure = processed_structure[:paired] + '.' + processed_structure[(paired + 1):]
-                    dot_structure = dot_structure[:paired] + '.' + dot_structure[(paired + 1):]
+                    new_structure[paired] = new_dot_structure[paired] = '.'
                     # replace the matching closed/open bracket by a '.'
                     corrected_brackets = True
-    return processed_sequence, processed_structure, dot_structure, structure_changed, corrected_brackets
+    return ''.join(new_sequence), ''.join(new_structure), ''.join(new_dot_structure), structure_changed, corrected_brackets
 
 def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure): 
     # Fills truncations, strips gaps, and aligns secondary structure
@@ -544,7 +277,7 @@ def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure):
     processed_sequence = processed_sequence.upper()
     dot_structure = replace_characters(processed_structure) # make a normal dot bracket structure
     
-    pairs = make_pairs(processed_structure, dot_structure) # creates a list with all paired 
+    pairs = pair_table(dot_structure) # the position paired with each bracket
     
     processed_sequence, processed_structure, dot_structure, structure_changed, corrected_brackets = replace_gaps(processed_sequence, processed_structure, dot_structure, pairs)
     if(structure_changed == True):
@@ -572,18 +305,8 @@ def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure):
         warnings += ' unequal_number_of_brackets'
 
     # make pairs again to process the secondary structure features of the Tbox
-    # Find stems
-    my_pairs = make_pairs(processed_structure, dot_structure)
-    index = 0
-    structures = []
-    while(index < len(dot_structure) - 1):
-        if(my_pairs[index] != None):
-            if(my_pairs[index][0] == '('):
-                # this is a secondary structure element (a stem)
-                #use 1-index
-                structures.append([ my_pairs[index][1] + 1, my_pairs[index][2] + 1])
-                index = my_pairs[index][2] # go to the paired bracket
-        index += 1
+    # Find stems (1-indexed)
+    structures = outer_pairs(pair_table(dot_structure))
     
     #Stem 3 is the second-to-last. Only calculate if there also a stem 1 (total stems >2)
     stem_three = None    
@@ -593,16 +316,9 @@ def parse_structures(fasta_sequence, tbox_start, tbox_end, sequence, structure):
     #Return: dot structure, list of secondary structural elements, messages and warnings
     return dot_structure, structures, (messages + warnings)
 
+#RNALfold, for finding local terminator structures
 def local_fold(sequence, length):
-    vienna_args = ['RNALfold', '-T', '37', '-L', str(length), '−−noClosingGU'] # https://academic.oup.com/nar/article/40/12/5215/2414626
-    # 100bp length will be good for our purpose
-    vienna_input = str(sequence)
-    vienna_call = subprocess.run(vienna_args, stdout = subprocess.PIPE, stderr = subprocess.PIPE, input = vienna_input, encoding = 'ascii')
-    
-    output = vienna_call.stdout.strip().split('\n')
-    errors = vienna_call.stderr
-
-    return output, errors
+    return vienna.local_fold(sequence, length)
 
 def term_end(sequence, start, pattern = 'TTTTT'):
     match = sequence.rfind(pattern, start) #get the last occurence of the pattern, after the start
@@ -610,7 +326,7 @@ def term_end(sequence, start, pattern = 'TTTTT'):
         return match + len(pattern) #- 1
     return len(sequence) #fallback: return the end
 
-def run_thermo(tboxes):
+def run_thermo(tboxes, temperatures = (), ensemble = False):
     #Don't need: fasta_antiterm_start, fasta_antiterm_end
     #From RUN:
     tboxes[['whole_antiterm_structure', 'other_stems', 'whole_antiterm_warnings']] = tboxes.apply(lambda x: parse_structures(x['FASTA_sequence'], x['Tbox_start'], x['Tbox_end'], x['Sequence'], x['Structure']), axis = 'columns', result_type = 'expand')
@@ -620,7 +336,8 @@ def run_thermo(tboxes):
     tboxes['term_sequence'] = tboxes.apply(lambda x: get_sequence(x['FASTA_sequence'], x['discrim_end'], x['term_end']), axis = 'columns', result_type = 'expand')
     print('Terminators found.')
     # fold the terminator sequence obtained above to get the secondary structure
-    tboxes[['term_structure', 'terminator_energy', 'term_errors']] = tboxes.apply(lambda x: get_fold(x['term_sequence']), axis = 'columns', result_type = 'expand')
+    columns = ['term_structure', 'terminator_energy', 'term_errors']
+    tboxes[columns] = pd.DataFrame(get_fold_column(tboxes['term_sequence']), index = tboxes.index, columns = columns)
     print('Terminators folded.')
 
     # get the sequence from antiterm start to term end, will be used for comparing conformations with equal length
@@ -634,13 +351,16 @@ def run_thermo(tboxes):
     #tboxes[['infernal_antiterminator_energy', 'infernal_antiterminator_errors']] = tboxes.apply(lambda x: get_energy(x['antiterm_term_sequence'], x['infernal_antiterminator_structure']), axis = 'columns', result_type = 'expand')
     print('Antiterminator energy done.')
     # refold the antiterminator using RNAfold with hard constraints
-    tboxes[['vienna_antiterminator_structure', 'vienna_antiterminator_energy', 'vienna_antiterminator_errors']] = tboxes.apply(lambda x: make_antiterm_constraints(x['antiterm_term_sequence'], x['infernal_antiterminator_structure']), axis = 'columns', result_type = 'expand')
+    constraints = [make_antiterm_constraints(sequence, structure) for sequence, structure in zip(tboxes['antiterm_term_sequence'], tboxes['infernal_antiterminator_structure'])]
+    columns = ['vienna_antiterminator_structure', 'vienna_antiterminator_energy', 'vienna_antiterminator_errors']
+    tboxes[columns] = pd.DataFrame(refold_antiterms(tboxes['antiterm_term_sequence'], constraints), index = tboxes.index, columns = columns)
     print('Antiterminator re-folding done.')
     # get the terminator structure and energy, structure is term structure with dots in front so that structure 
     # spans from antiterm_start to term_end. Use offset of 10 (instead of 8 for transcriptional T-boxes)
     tboxes['terminator_structure'] = tboxes.apply(lambda x: ('.' * 10 + x['term_structure']), axis = 'columns', result_type = 'expand')
     print('Terminator structure generated.')
-    tboxes[['terminator_energy', 'terminator_errors']] = tboxes.apply(lambda x: get_energy(x['antiterm_term_sequence'], x['terminator_structure']), axis = 'columns', result_type = 'expand')
+    columns = ['terminator_energy', 'terminator_errors']
+    tboxes[columns] = pd.DataFrame(get_energy_column(tboxes['antiterm_term_sequence'], tboxes['terminator_structure']), index = tboxes.index, columns = columns)
     print('Terminator energy calculated.')
     
     #PLACEHOLDER in place of terminator refinement
@@ -652,61 +372,54 @@ def run_thermo(tboxes):
     tboxes[['whole_term_structure', 'term_start']] = tboxes.apply(lambda x: get_whole_structs(x['antiterm_start'], x['whole_antiterm_structure'], x['terminator_structure']), axis = 'columns', result_type = 'expand')
     #make the Vienna antiterm structure for the whole T-box
     tboxes['folded_antiterm_structure'] = tboxes.apply(lambda x: get_whole_structs(x['antiterm_start'], x['whole_antiterm_structure'], x['vienna_antiterminator_structure'])[0], axis = 'columns', result_type = 'expand')
+    if len(temperatures) > 0:
+        tboxes = temperature_sweep(tboxes, constraints, temperatures, 'terminator_structure')
+        print('Temperature sweep done.')
+    if ensemble:
+        tboxes = add_ensemble(tboxes, 'terminator_structure', 'terminator_energy')
+        print('Ensemble probabilities done.')
     print('Thermodynamic calculations complete.')
     return tboxes
     
-#Generate trimmed structures and sequences
+#Slices a FASTA sequence and its T-box structures from tbox_start to term_end (1-indexed)
+#Structures shorter than the trimmed sequence are first padded with '.' to its length
+def trim_tbox(seq, a_struct, t_struct, tbox_start, term_end):
+    seq = seq[tbox_start-1:term_end]
+    a_struct = a_struct.ljust(len(seq), '.')
+    t_struct = t_struct.ljust(len(seq), '.')
+    return seq, a_struct[tbox_start-1:term_end], t_struct[tbox_start-1:term_end]
+
+#Generate trimmed structures and sequences, from the T-box start to term_end
+#The bounds of all rows are calculated together
 def trim(seq_df):
     seq_df['Trimmed_sequence']=""
     seq_df['Trimmed_antiterm_struct']=""
     seq_df['Trimmed_term_struct']=""
-
-    counter = 0
-
-    for i in range(0,len(seq_df)):
-        print('Trimming ' + seq_df['Name'][i])
-        seq = seq_df['FASTA_sequence'][i]
-        t_struct = seq_df['whole_term_structure'][i]
-        a_struct = seq_df['folded_antiterm_structure'][i]
-    
-        if pd.isna(seq) or pd.isna(t_struct) or pd.isna(a_struct) or pd.isna(seq_df['antiterm_end'][i]):
-            continue
-        
-        tbox_start = int(seq_df['Tbox_start'][i])
-        term_end = int(seq_df['term_end'][i]) #min(term_end_regex(seq,int(seq_df['antiterm_end'][i]) + 10),int(seq_df['term_end'][i]))
-        seq_df.at[seq_df.index[i], 'term_end'] = term_end #update term_end
-    
-        if (tbox_start < -1) or term_end > len(seq): #note these are 1-indexed
-            print('Error')
-            continue
-    
-        #Slice fasta sequence to get the tbox sequence
-        seq = seq[tbox_start-1:term_end]
-    
-        if len(seq) != len(a_struct):
-            a_struct += '.'*(len(seq)-len(a_struct))
-        
-        if len(seq) != len(t_struct):
-            t_struct += '.'*(len(seq)-len(t_struct))
     
-        #Also slice the structures
-        t_struct = t_struct[tbox_start-1:term_end]
-        a_struct = a_struct[tbox_start-1:term_end]
-    
-        seq_df.at[seq_df.index[i], 'Trimmed_sequence'] = seq
-        seq_df.at[seq_df.index[i], 'Trimmed_antiterm_struct'] = a_struct
-        seq_df.at[seq_df.index[i], 'Trimmed_term_struct'] = t_struct
-        counter += 1
-
-    print("Trimmed sequences: " + str(counter))
+    trimmed = seq_df['FASTA_sequence'].notna() & seq_df['whole_term_structure'].notna() & seq_df['folded_antiterm_structure'].notna() & seq_df['antiterm_end'].notna()
+    sequences = seq_df.loc[trimmed, 'FASTA_sequence'].tolist()
+    tbox_starts = seq_df.loc[trimmed, 'Tbox_start'].astype(int).to_numpy()
+    term_ends = seq_df.loc[trimmed, 'term_end'].astype(int).to_numpy() #min(term_end_regex(seq,int(seq_df['antiterm_end'][i]) + 10),int(seq_df['term_end'][i]))
+    seq_df.loc[trimmed, 'term_end'] = term_ends.astype(seq_df['term_end'].dtype) #update term_end (keeping the column type)
+    
+    lengths = np.array([len(seq) for seq in sequences], dtype = int)
+    errors = (tbox_starts < -1) | (term_ends > lengths) #note these are 1-indexed
+    if errors.any():
+        print('Error: %d T-boxes are outside of their sequence' % errors.sum())
+    done = trimmed.copy()
+    done[trimmed] = ~errors
+    rows = (~errors).nonzero()[0]
+    a_structs = seq_df.loc[done, 'folded_antiterm_structure'].tolist()
+    t_structs = seq_df.loc[done, 'whole_term_structure'].tolist()
+    columns = ['Trimmed_sequence', 'Trimmed_antiterm_struct', 'Trimmed_term_struct']
+    seq_df.loc[done, columns] = pd.DataFrame([trim_tbox(sequences[row], a_struct, t_struct, tbox_starts[row], term_ends[row]) for row, a_struct, t_struct in zip(rows, a_structs, t_structs)],
+                                             index = seq_df.index[done], columns = columns)
+    
+    print("Trimmed sequences: " + str(done.sum()))
     return seq_df
 
-#The main function to predict T-boxes
-def tbox_predict(INFERNAL_file, predictions_file, fasta_file = None, score_cutoff = 15):
-    score_cutoff = int(score_cutoff) #makes it an int, if it was passed as a string
-
-    #Read the input file into a dataframe
-    tbox_all_DF = read_INFERNAL(INFERNAL_file)
+#Predict the features of each translational T-box in a dataframe of INFERNAL hits
+def predict_features(tbox_all_DF, fasta_file, score_cutoff):
     #Initialize the dataframe columns for prediction output
     tbox_all_DF['s1_start'] = -1
     tbox_all_DF['s1_loop_start'] = -1
@@ -729,72 +442,69 @@ def tbox_predict(INFERNAL_file, predictions_file, fasta_file = None, score_cutof
     tbox_all_DF['type'] = "Translational"
     tbox_all_DF['source'] = fasta_file
     #tbox_all_DF['FASTA_sequence'] = ""
-    
-    downstream_bases = 0
-        
-    #Predict the t-boxes
-    for i, name in enumerate(tbox_all_DF['Name']):
-        print(name) #Write to log
-        
-        #Predict the features. Use offset of 1 to convert 0-indexed Python format to standard sequence format
-        tbox = tbox_features_translational(tbox_all_DF['Sequence'][i], tbox_all_DF['Structure'][i], offset = 1)
-        
-        #Assign output to dataframe
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_start'] = tbox[0]
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_loop_start'] = tbox[1]
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_loop_end'] = tbox[2]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'codon'] = tbox[3]
-        tbox_all_DF.at[tbox_all_DF.index[i], 's1_end'] = tbox[4]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'antiterm_start'] = tbox[5]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'discriminator'] = tbox[6]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'antiterm_end'] = tbox[7]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'codon_region'] = tbox[8]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'warnings'] += tbox[9]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'discrim_start'] = tbox[10]
-        tbox_all_DF.at[tbox_all_DF.index[i], 'discrim_end'] += tbox[11]
-
-        #Make the hash string
-        #hasher = hashlib.sha256(tbox_all_DF['Sequence'][i].encode('utf-8'))
-        #hash =  str(base64.urlsafe_b64encode(hasher.digest()))
-        #tbox_all_DF.at[tbox_all_DF.index[i],'hash_string'] = hash[2:12]
         
-        #Check the score
-        if tbox_all_DF.at[tbox_all_DF.index[i], 'Score'] < score_cutoff:
-            tbox_all_DF.at[tbox_all_DF.index[i], 'warnings'] += "LOW_SCORE;"
+    #Predict the features for all T-boxes. Use offset of 1 to convert 0-indexed Python format to standard sequence format
+    features = features_batch(PROFILE, tbox_all_DF['Sequence'], tbox_all_DF['Structure'], offset = 1)
+    
+    #Assign output to dataframe, one column at a time
+    for column in FEATURE_COLUMNS:
+        values = pd.Series(features[column], index = tbox_all_DF.index, dtype = tbox_all_DF[column].dtype)
+        if column in ('warnings', 'discrim_end'): #These are added to the initial values
+            tbox_all_DF[column] = tbox_all_DF[column] + values
+        else:
+            tbox_all_DF[column] = values
+    
+    #Check the score
+    low_score = tbox_all_DF['Score'] < score_cutoff
+    tbox_all_DF.loc[low_score, 'warnings'] = tbox_all_DF.loc[low_score, 'warnings'] + "LOW_SCORE;"
+    return tbox_all_DF
+
+#Predict the features and thermodynamics of T-boxes merged with their FASTA records (run once per T-box, see predict_unique)
+def predict_tboxes(tboxes, fasta_file, score_cutoff, jobs = 1, temperatures = (), ensemble = False):
+    #Predict the features of the rows with hits
+    tboxes = predict_hit_features(lambda hits: predict_features(hits, fasta_file, score_cutoff), tboxes)
+    
+    #Set the terminator end
+    tboxes['term_end'] = tboxes['Tbox_end']
     
-    #Deduplicate
+    #Calculate derived features and remap locations relative to fasta
+    derived = tbox_derive(tboxes)
+    print("Starting thermo calculations")
+    return run_thermo_parallel(run_thermo, derived, jobs, temperatures, ensemble)
+
+#The main function to predict T-boxes
+#If chunksize is given, the INFERNAL hits are streamed and processed chunksize hits at a time
+#jobs is the number of processes used to parse the INFERNAL file and to run the thermodynamic calculations
+#If alignment_file (cmsearch -A output) is given, INFERNAL_file is the cmsearch --tblout table
+def tbox_predict(INFERNAL_file, predictions_file, fasta_file = None, score_cutoff = 15, chunksize = None, jobs = 1,
+                 alignment_file = None, temperatures = (), ensemble = False):
+    score_cutoff = int(score_cutoff) #makes it an int, if it was passed as a string
+    if chunksize is not None:
+        return tbox_predict_chunks(INFERNAL_file, predictions_file, fasta_file, score_cutoff, int(chunksize), jobs,
+                                   alignment_file, temperatures, ensemble)
+
+    #Read the input file into a dataframe
+    tbox_all_DF = read_INFERNAL(INFERNAL_file, jobs, alignment_file)
+    #Deduplicate, before predicting the features
     tbox_all_DF.drop_duplicates(subset = 'Sequence', keep = 'first', inplace = True) #Drop duplicate T-boxes
     tbox_all_DF.reset_index(drop=True, inplace = True)
     
-    #Write output (debug)
-    tbox_all_DF.to_csv(predictions_file, index = False, header = True)
-    
     print("Adding FASTA sequence data")
     
     #Get FASTA sequences from the master file
     #Perform the fasta processing (if enabled)
     if fasta_file is not None:
-        fastas = {'Name':[], 'FASTA_sequence':[]}
         #Read the fasta file
-        with open(fasta_file) as f:
-            for fasta in SeqIO.parse(f,'fasta'):
-                name, sequence = fasta.id, str(fasta.seq)
-                fastas['Name'].append(name)
-                fastas['FASTA_sequence'].append(sequence)
+        fasta_DF = read_fasta(fasta_file)
         #Merge with T-box dataframe
-        fasta_DF = pd.DataFrame(fastas)
         #fasta_DF.to_csv('test_fasta.csv', index = True, header = True)
         tbox_all_DF = pd.merge(fasta_DF, tbox_all_DF, on = 'Name', how = 'left') #Left merge to preserve all FASTA sequences
     
-    #Set the terminator end
-    tbox_all_DF['term_end'] = tbox_all_DF['Tbox_end']
-    
-    #Calculate derived features and remap locations relative to fasta
-    derived = tbox_derive(tbox_all_DF)
+    #Predict the features, derived features and thermodynamics once for each distinct T-box
+    #(for example, identical T-boxes in several strains)
+    thermo = predict_unique(lambda tboxes: predict_tboxes(tboxes, fasta_file, score_cutoff, jobs, temperatures, ensemble), tbox_all_DF)
     #Checkpoint
-    derived.to_csv(predictions_file, index = False, header = True)
-    print("Starting thermo calculations")
-    thermo = run_thermo(derived)
+    thermo.to_csv(predictions_file, index = False, header = True)
     
     #Trim to terminator end (placeholder function, does nothing for now)
     thermo = trim(thermo)
@@ -803,9 +513,43 @@ def tbox_predict(INFERNAL_file, predictions_file, fasta_file = None, score_cutof
     thermo.to_csv(predictions_file, index = False, header = True)
     return 0
 
+#Streaming version of tbox_predict, for INFERNAL outputs too large to hold in memory
+#Each chunk of hits goes through the whole prediction and is appended to the output (see predict_chunks)
+#Only FASTA sequences with hits are written, and duplicates are removed across chunks
+def tbox_predict_chunks(INFERNAL_file, predictions_file, fasta_file, score_cutoff, chunksize, jobs = 1,
+                        alignment_file = None, temperatures = (), ensemble = False):
+    fasta_index = None
+    if fasta_file is not None:
+        fasta_index = index_fasta(fasta_file)
+    seen_sequences = set() #T-box sequences already written
+    
+    #Prediction of one chunk of hits
+    def predict_chunk(tbox_all_DF):
+        #Deduplicate, including T-boxes from earlier chunks, before predicting the features
+        tbox_all_DF = tbox_all_DF[~tbox_all_DF['Sequence'].isin(seen_sequences)]
+        tbox_all_DF = tbox_all_DF.drop_duplicates(subset = 'Sequence', keep = 'first').reset_index(drop = True)
+        seen_sequences.update(tbox_all_DF['Sequence'])
+        
+        if fasta_index is not None:
+            #Only the fasta records with hits in this chunk are read
+            fasta_DF = select_fasta(fasta_file, tbox_all_DF['Name'], index = fasta_index)
+            tbox_all_DF = pd.merge(fasta_DF, tbox_all_DF, on = 'Name', how = 'inner')
+        if len(tbox_all_DF) == 0:
+            return None
+        
+        #Predict the features, derived features and thermodynamics, and trim
+        thermo = predict_unique(lambda tboxes: predict_tboxes(tboxes, fasta_file, score_cutoff, jobs, temperatures, ensemble), tbox_all_DF)
+        return trim(thermo)
+    
+    return predict_chunks(predict_chunk, INFERNAL_file, predictions_file, chunksize, jobs, alignment_file)
+
 #Get arguments from command line and run the prediction
-if len(sys.argv) > 5 or len(sys.argv) < 3:
-    print("Error: incorrect number of arguments: %d" % len(sys.argv))
-    print(sys.argv)
-else:
-    tbox_predict(*sys.argv[1:len(sys.argv)])
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Predict translational T-box features from INFERNAL output')
+    parser.add_argument('INFERNAL_file', help = 'cmsearch output file (or --tblout table, with --alignment)')
+    parser.add_argument('predictions_file', help = 'output .csv file')
+    parser.add_argument('fasta_file', nargs = '?', default = None, help = 'fasta file searched by cmsearch')
+    parser.add_argument('score_cutoff', nargs = '?', default = 15, help = 'INFERNAL score cutoff (default 15)')
+    add_common_arguments(parser)
+    args = parser.parse_args()
+    tbox_predict(args.INFERNAL_file, args.predictions_file, args.fasta_file, args.score_cutoff, **apply_common_arguments(parser, args))